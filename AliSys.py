@@ -7,6 +7,7 @@ from analysis_classes import Calibration
 from analysis_classes import NoiseAnalysis
 from analysis_classes import MainAnalysis
 from analysis_classes.utilities import save_all_plots, save_dict, read_meas_files
+from analysis_classes.run_info import is_usable
 import matplotlib.pyplot as plt
 
 def main(args):
@@ -23,6 +24,10 @@ def main(args):
     meas_files = read_meas_files(cfg)
     it = 0
     for ped, cal, run in meas_files:
+        # Do not start the expensive analysis for empty or broken runs, the check only reads
+        if run and cfg.get("check_run_files", True) and not is_usable(run):
+            print("Skipping run {}, see the log for details".format(run))
+            continue
         it+=1
 
         ped_data = NoiseAnalysis(ped, configs=cfg)
@@ -47,7 +52,9 @@ def main(args):
 
         if cfg.get("Output_folder", "") and cfg.get("Output_name", "") and cfg.get("Save_output", False):
             if cfg["Output_name"] == "generic":
-                fileName = os.path.basename(os.path.splitext(run)[0])
+                # A run split into several files is named after its first file
+                first_file = run[0] if isinstance(run, list) else run
+                fileName = os.path.basename(os.path.splitext(first_file)[0])
             else:
                 fileName = cfg["Output_name"]
             save_all_plots(fileName, cfg["Output_folder"], dpi=300)
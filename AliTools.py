@@ -0,0 +1,181 @@
+"""Command line tools around the ALiBaVa files, which do not need the full
+analysis. Type python AliTools.py --help to see all tools"""
+from argparse import ArgumentParser
+import os
+import sys
+import json
+from analysis_classes.converter import convert_files, COMPRESSIONS
+from analysis_classes.run_info import describe
+from analysis_classes.benchmarks import BENCHMARKS, BenchmarkFailure
+from analysis_classes.utilities import create_dictionary
+
+
+def convert(args):
+    """Converts ALiBaVa binary files to hdf5 files"""
+    stats = convert_files(args.files, output_folder=args.output_folder,
+                          processes=args.processes, compression=args.compression,
+                          chunk_events=args.chunk_events)
+    total_events = sum(stat["events"] for stat in stats)
+    total_MB = sum(stat["input_MB"] for stat in stats)
+    decode_time = sum(stat["decode_s"] for stat in stats)
+    write_time = sum(stat["write_s"] for stat in stats)
+    for stat in stats:
+        print("{file}: {events} events -> {output} ({input_MB:.1f} MB -> {output_MB:.1f} MB), "
+              "decode {decode_MBps:.1f} MB/s, write {write_MBps:.1f} MB/s".format(**stat))
+    print("Converted {} files with {} events, decode {:.1f} MB/s, write {:.1f} MB/s"
+          .format(len(stats), total_events, total_MB/max(decode_time, 1e-9),
+                  total_MB/max(write_time, 1e-9)))
+
+
+def describe_files(args):
+    """Prints the header, event count, scan points and timing of run files"""
+    infos = [describe(path, bins=args.bins, create_index=args.create_index)
+             for path in args.files]
+    if args.json:
+        print(json.dumps(infos, indent=2))
+        return
+    for info in infos:
+        print("{path} ({format}, {size:.1f} MB)".format(size=(info["file_size"] or 0)/1e6, **info))
+        if not info["valid"]:
+            print("    BROKEN: {}".format(info["error"]))
+            continue
+        print("    Events: {numevents}, channels: {numchan}".format(**info))
+        for key, value in info["header"].items():
+            print("    {}: {}".format(key, value))
+        if info["scan_values"] is not None and len(info["scan_values"]):
+            print("    Scan points: {} ({} - {})".format(len(info["scan_values"]),
+                                                       info["scan_values"][0],
+                                                       info["scan_values"][-1]))
+        if info["time_histogram"] and info["numevents"]:
+            print("    Timing: {min} - {max}".format(**info["time_histogram"]))
+
+
+def zerosuppress(args):
+    """Writes zero suppressed versions of the measurement runs"""
+    from analysis_classes import NoiseAnalysis
+    from analysis_classes.zero_suppression import zero_suppress_run
+    cfg = create_dictionary(args.config)
+    noise = NoiseAnalysis(args.pedestal or cfg["Pedestal_file"], configs=cfg)
+    for run in args.files:
+        output = None
+        if args.output_folder:
+            name = os.path.splitext(os.path.basename(run))[0] + "_zs.hdf5"
+            output = os.path.join(os.path.normpath(args.output_folder), name)
+        stat = zero_suppress_run(run, noise, cfg, output=output, threshold=args.threshold,
+                                 margin=args.margin)
+        print("{file}: {events} events -> {output} ({output_MB:.1f} MB), "
+              "{stored_channels} channels stored".format(**stat))
+
+
+def sweep(args):
+    """Clusters a run with a grid of cuts, every chunk is preprocessed only once"""
+    from analysis_classes import NoiseAnalysis
+    from analysis_classes.threshold_sweep import threshold_sweep, write_sweep_csv
+    cfg = create_dictionary(args.config)
+    noise = None
+    if args.pedestal or cfg.get("Pedestal_file"):
+        noise = NoiseAnalysis(args.pedestal or cfg["Pedestal_file"], configs=cfg)
+    table = threshold_sweep(args.run, cfg, noise, SN_cuts=args.SN_cut, SN_ratios=args.SN_ratio,
+                            SN_clusters=args.SN_cluster)
+    print("SN_cut SN_ratio SN_cluster   clusters  mean size  seed MPV  noise occupancy  sizes")
+    for row in table:
+        print("{:6g} {:8g} {:10g} {:10d} {:10.2f} {:9.1f} {:16.2e}  {}".format(
+            row["SN_cut"], row["SN_ratio"], row["SN_cluster"], row["clusters"],
+            row["mean_clustersize"], row["seed_MPV"], row["noise_occupancy"],
+            " ".join(str(size) for size in row["sizes"])))
+    if args.output:
+        write_sweep_csv(table, args.output)
+
+
+def bench(args):
+    """Runs the benchmarks of the analysis kernels on synthetic data, exits with
+    1 if a kernel does not give the results of its reference"""
+    failed = []
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark {}, possible are {}"
+                             .format(name, ", ".join(sorted(BENCHMARKS))))
+        try:
+            results = BENCHMARKS[name](numevents=args.events, repeat=args.repeat)
+        except BenchmarkFailure as err:
+            print("{} FAILED: {}".format(name, err))
+            failed.append(name)
+            continue
+        print(name)
+        for case, result in results.items():
+            print("    {}: {}".format(case, ", ".join("{} {:.4g}".format(key, value)
+                                                      for key, value in result.items())))
+    if failed:
+        sys.exit("Failed benchmarks: {}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+
+    PARSER = ArgumentParser()
+    SUBPARSERS = PARSER.add_subparsers(dest="tool")
+    SUBPARSERS.required = True
+
+    CONVERT = SUBPARSERS.add_parser("convert", help="Convert ALiBaVa binary files to hdf5 files")
+    CONVERT.add_argument("files", nargs="+", help="The binary files to convert")
+    CONVERT.add_argument("--output_folder", default="",
+                         help="Folder for the hdf5 files, default is next to the binary files")
+    CONVERT.add_argument("--compression", default="lzf", choices=sorted(COMPRESSIONS),
+                         help="Compression filter of the hdf5 datasets")
+    CONVERT.add_argument("--chunk_events", type=int, default=1024,
+                         help="Number of events per hdf5 chunk")
+    CONVERT.add_argument("--processes", type=int, default=1,
+                         help="Number of files converted in parallel")
+    CONVERT.set_defaults(func=convert)
+
+    DESCRIBE = SUBPARSERS.add_parser("describe",
+                                     help="Show header, event count, scan points and timing of run files")
+    DESCRIBE.add_argument("files", nargs="+", help="hdf5 or binary run files")
+    DESCRIBE.add_argument("--bins", type=int, default=100,
+                          help="Number of bins of the timing histogram")
+    DESCRIBE.add_argument("--create_index", action="store_true",
+                          help="Write the index sidecar of binary files if there is none")
+    DESCRIBE.add_argument("--json", action="store_true",
+                          help="Print everything (including the timing histogram) as json")
+    DESCRIBE.set_defaults(func=describe_files)
+
+    ZS = SUBPARSERS.add_parser("zerosuppress",
+                               help="Write zero suppressed hdf5 files of measurement runs")
+    ZS.add_argument("files", nargs="+", help="The measurement runs")
+    ZS.add_argument("--config", required=True,
+                    help="Analysis config file (isBinary, Chips, Noise_cut, ...)")
+    ZS.add_argument("--pedestal", default="",
+                    help="Pedestal file, default is the Pedestal_file of the config")
+    ZS.add_argument("--threshold", type=float, default=2.5,
+                    help="Minimum SN of stored channels, must not exceed SN_cut*SN_ratio "
+                         "of later analyses")
+    ZS.add_argument("--margin", type=int, default=1,
+                    help="Number of neighbours stored on each side of a channel above threshold")
+    ZS.add_argument("--output_folder", default="",
+                    help="Folder for the output files, default is next to the runs")
+    ZS.set_defaults(func=zerosuppress)
+
+    SWEEP = SUBPARSERS.add_parser("sweep",
+                                  help="Cluster a run with every combination of the given cuts")
+    SWEEP.add_argument("run", help="The measurement run (also zero suppressed)")
+    SWEEP.add_argument("--config", required=True,
+                       help="Analysis config file, its cuts are used for cuts which are not given")
+    SWEEP.add_argument("--pedestal", default="",
+                       help="Pedestal file, default is the Pedestal_file of the config")
+    SWEEP.add_argument("--SN_cut", type=float, nargs="+", help="SN_cut values")
+    SWEEP.add_argument("--SN_ratio", type=float, nargs="+", help="SN_ratio values")
+    SWEEP.add_argument("--SN_cluster", type=float, nargs="+", help="SN_cluster values")
+    SWEEP.add_argument("--output", default="", help="Write the summary table to this csv file")
+    SWEEP.set_defaults(func=sweep)
+
+    BENCH = SUBPARSERS.add_parser("bench", help="Benchmark the analysis kernels on synthetic data")
+    BENCH.add_argument("benchmarks", nargs="*", default=sorted(BENCHMARKS),
+                       help="The benchmarks to run ({}), default all"
+                       .format(", ".join(sorted(BENCHMARKS))))
+    BENCH.add_argument("--events", type=int, default=10000,
+                       help="Number of synthetic events")
+    BENCH.add_argument("--repeat", type=int, default=3,
+                       help="Repetitions, the best time is reported")
+    BENCH.set_defaults(func=bench)
+
+    ARGS = PARSER.parse_args()
+    ARGS.func(ARGS)
@@ -41,38 +41,21 @@ class ChargeSharing:
         self.results_dict = {}
         # Get clustersizes of 2 and only events which show only one cluster in its data (just to be sure
 
-        # Indizes of events with the desired clusternumbers
-        indizes_clusters = np.nonzero(self.data["base"]["Numclus"] == 1)
-        # Take the desired clusters
-        clusters_raw = np.take(self.data["base"]["Clustersize"], indizes_clusters)
-        clusters_flattend = np.concatenate(clusters_raw).ravel()  # so that they are easy accessible
-        # Now take only the events with clustersize 2
-        indizes_clustersize = np.nonzero(clusters_flattend == 2)
-        # Here we need to do a little detour, since we have derived indizes from Clustersize we do not have the same
-        # Index order as we need, therefore we need to get indizes from indizes_clusters to get the indizes
-        # from the real data
-        indizes = np.take(indizes_clusters, indizes_clustersize)[0]
-
-        # Data containing the al and ar values as list entries data[0] --> al
-        # Take the data from the Signal data
-        raw = np.take(self.data["base"]["Signal"], indizes)
-        raw = np.reshape(np.concatenate(raw), (len(raw), self.main.numChan))
-        # Find the channels with the hits
-        hits = np.concatenate(np.take(self.data["base"]["Clusters"], indizes))
-        al = np.zeros(len(indizes))  # Amplitude left and right
-        ar = np.zeros(len(indizes))
-        strl = np.zeros(len(indizes)) # Strips hits for left side
-        strr = np.zeros(len(indizes)) # Strips hits for left side
-        # Order the hits assecnding (they are channel numbers)
-        il = np.min(hits, axis=1)  # Indizes of left and right
-        ir = np.max(hits, axis=1)
-        # final_data = np.zeros((len(indizes), 2))
-
-        for i, event, ali, ari, l, r in zip(range(len(al)), raw, al, ar, il, ir):
-            al[i] = event[l]  # So always the left strip is choosen
-            ar[i] = event[r]  # Same with the right strip
-            strl[i] = l
-            strr[i] = r
+        # Clusters of size 2 of the events with only one cluster, from the cluster table
+        results = self.data["base"]
+        table = results.cluster_table
+        selected = np.nonzero(np.logical_and(table["size"] == self.clustersize,
+                                             results.numclus[table["event"]] == 1))[0]
+        pairs = table[selected]
+        # Left and right strip of the clusters and their amplitudes, the cluster
+        # channels start with the seed
+        strl = pairs["first"]
+        strr = pairs["last"]
+        entries = results.channel_indptr[selected]
+        seed_left = results.cluster_channels[entries] == strl
+        signals = results.channel_signal
+        al = np.where(seed_left, signals[entries], signals[entries+1])
+        ar = np.where(seed_left, signals[entries+1], signals[entries])
 
         # Convert ADC to actual energy
         al = self.main.calibration.convert_ADC_to_e(al, strl)
@@ -5,7 +5,6 @@ import warnings
 import time
 import numpy as np
 from scipy.optimize import curve_fit
-from tqdm import tqdm
 import pylandau
 from joblib import Parallel, delayed
 from .utilities import set_attributes
@@ -50,8 +49,6 @@ class Langau:
         self.data = self.main.outputdata.copy()
         self.results_dict = {}  # Containing all data processed
         self.pedestal = self.main.pedestal
-        self.pool = self.main.Pool
-        self.poolsize = self.main.process_pool
         self.numClusters = self.numClus
         self.Ecut = self.energyCutOff
         self.plotfit = self.fitLangau
@@ -63,21 +60,14 @@ class Langau:
     def run(self):
         """Runs the routines to generate all langau specific data"""
 
-        # Here events with only one cluster are choosen or two, you decide
-        indNumClus = self.get_num_clusters(self.data, self.numClusters)
-        indizes = np.concatenate(indNumClus)
-
-        # Slice the data from the bas analysis for further calculations
-        valid_events_clustersize = np.take(self.data["base"]["Clustersize"], indizes)
-        valid_events_clusters = np.take(self.data["base"]["Clusters"], indizes)
-        valid_events_Signal = np.take(self.data["base"]["Signal"],indizes)
+        # Here clusters of events with only one cluster are choosen or two, you decide
+        results = self.data["base"]
+        table = results.cluster_table
         self.results_dict["Clustersize"] = []
 
-        # TODO: here a non numba optimized version is used. We should use numba here!
         # Calculate the energy deposition PER Clustersize and add it to self.results_dict["Clustersize"]
-        self.cluster_analysis(valid_events_Signal,
-                              valid_events_clusters,
-                              valid_events_clustersize)
+        self.cluster_analysis(results, np.nonzero(np.isin(results.numclus[table["event"]],
+                                                          self.numClusters))[0])
 
         # With all the data from every clustersize add all together and fit the main langau to it
         finalE = np.zeros(0)
@@ -109,21 +99,18 @@ class Langau:
 
         # Seed cut langau, taking only the bare hit channels which are above seed cut levels
         if self.seed_cut_langau:
-            seed_cut_channels = self.data["base"]["Channel_hit"]
-            signals = self.data["base"]["Signal"]
-            seedcutADC = []
-            seedcutChannels = []
-            for i, signal in enumerate(tqdm(signals, desc="(langau SC) Processing events")):
-                if signal[seed_cut_channels[i]].any():
-                    seedcutADC.append(signal[seed_cut_channels[i]])
-                    seedcutChannels.append(seed_cut_channels[i])
-
+            # All hits of the events with at least one non zero hit signal
+            hit_event = np.repeat(np.arange(len(results)), np.diff(results.hit_indptr))
+            seedcutADC = results.hit_signal
+            nonzero = np.bincount(hit_event, weights=seedcutADC != 0, minlength=len(results)) > 0
+            seedcutADC = seedcutADC[nonzero[hit_event]]
+            seedcutChannels = results.hit_channels[nonzero[hit_event]]
 
             if self.Charge_scale:
                 self.log.info("Converting ADC to electrons for SC Langau...")
-                converted = self.main.calibration.convert_ADC_to_e(np.concatenate(seedcutADC), np.concatenate(seedcutChannels))
+                converted = self.main.calibration.convert_ADC_to_e(seedcutADC, seedcutChannels)
             else:
-                converted = np.absolute(np.concatenate(seedcutADC))
+                converted = np.absolute(seedcutADC)
             finalE = np.array(converted, dtype=np.float32)
 
             # get rid of 0 events
@@ -171,45 +158,37 @@ class Langau:
 
         return self.results_dict.copy()
 
-    def cluster_analysis(self, valid_events_Signal,
-                         valid_events_clusters, valid_events_clustersize):
+    def cluster_analysis(self, results, clusters):
         """Calculates the energies for different cluster sizes
-         (like a Langau per clustersize) - non optimized version """
-        #TODO: Formerly in the numba function!!! We should use numba here not native python!!!
-        for size in tqdm(self.cluster_size_list, desc="(langau) Processing clustersize"):
-            # get the events with the different clustersizes
-            ClusInd = [[], []]
-            for i, event in enumerate(valid_events_clustersize):
-                for j, clus in enumerate(event):
-                    if clus == size:
-                        ClusInd[0].extend([i])
-                        ClusInd[1].extend([j])
-
-            signal_clst_event = np.zeros([len(ClusInd[0]), size])
-            noise_clst_event = np.zeros([len(ClusInd[0]), size])
-            channels_hit_event = np.zeros([len(ClusInd[0]), size])
-            #for i, ind in enumerate(tqdm(ClusInd[0], desc="(langau) Processing event")):
-            for i, ind in enumerate(ClusInd[0]):
-                y = ClusInd[1][i]
-                # Signal calculations
-                signal_clst_event[i] = np.take(valid_events_Signal[ind], valid_events_clusters[ind][y])
-                # Noise Calculations
-                noise_clst_event[i] = np.take(self.main.noise, valid_events_clusters[ind][y])  # Get the Noise of an event
-                # Save channels at which the hit happend
-                channels_hit_event[i] = np.array(valid_events_clusters[ind][y])
+         (like a Langau per clustersize)
+
+        :param results: The EventResults of the base analysis
+        :param clusters: Indizes of the clusters (in results.cluster_table) which should be considered
+        """
+        table = results.cluster_table
+        for size in self.cluster_size_list:
+            # get the clusters with this size, their channels are gathered from the CSR arrays
+            selected = clusters[table["size"][clusters] == size]
+            entries = results.channel_indptr[selected][:, None] + np.arange(size)
+            channels_hit_event = results.cluster_channels[entries]
+            # Signal calculations
+            signal_clst_event = results.channel_signal[entries]
+            # Noise Calculations
+            noise_clst_event = self.main.noise[channels_hit_event]
 
             # Todo: Due to the sum of all channels prior to conversion a need to choose a channel for
             # the gain. Therefore, in the future it would be good to separately calculate the gain for
             # every channel and then build the sum. But the error should be minimal.
 
             try:
-                totalE = np.zeros([len(channels_hit_event[0]), len(channels_hit_event)])
-                for part in range(len(channels_hit_event[0])):
-                    if self.Charge_scale:
-                        totalE[part] = self.main.calibration.convert_ADC_to_e(signal_clst_event[:,part], channels_hit_event[:,part])
-                    else:
-                        totalE[part] = np.absolute(signal_clst_event[:,part])
-                totalE = np.sum(totalE, axis=0)
+                if not len(selected):
+                    raise ValueError("No clusters of size {}".format(size))
+                # Every channel of the clusters with its own gain, the conversion keeps the order
+                if self.Charge_scale:
+                    totalE = np.sum(self.main.calibration.convert_ADC_to_e(signal_clst_event,
+                                                                           channels_hit_event), axis=1)
+                else:
+                    totalE = np.sum(np.absolute(signal_clst_event), axis=1)
 
 
                 # eError is a list containing electron signal noise
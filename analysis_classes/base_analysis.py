@@ -1,8 +1,12 @@
 """This file contains the basis analysis class for the ALiBaVa analysis"""
 #pylint: disable=C0103
 import logging
+from time import time, sleep
 import numpy as np
-from analysis_classes.nb_analysis_funcs import parallel_event_processing
+from analysis_classes.nb_analysis_funcs import parallel_event_processing, \
+    cluster_preprocessed_events, PreprocessBuffers
+from analysis_classes.event_results import EventResults
+from analysis_classes.event_source import EventSource, ArrayEventSource, DEFAULT_CHUNK_SIZE
 
 class BaseAnalysis:
     """BaseAnalysis handles the basic clustering analysis of all passed events.
@@ -29,7 +33,7 @@ class BaseAnalysis:
           event. We will subtract the mean of all channels, to get rid of common mode
           in the event. We then build the ratio between the residual signal vs. the
           noise for EVERY channel. --> We have our SN for every channel.
-          This is all done in the nb_preprocess_all_events function
+          This is all done in the nb_preprocess_events function
         - We then are looking for a so called seed cut. Meaning we are looking for
           channels which show a higher Signal to Noise - SN as the specified one
           in the configs. Next in line we need to get rid of false polarized signals,
@@ -44,21 +48,31 @@ class BaseAnalysis:
           as specified value, otherwise the cluster gets rejected.
           Warning: In reality this is not trivial to do and I therefore refer to the
           dedicated function: nb_clustering
+        - Both steps are compiled and process the events of a chunk in parallel
+          threads, see parallel_event_processing. Events without any channel above
+          the SN cut are found by a fast pre-scan and are not clustered at all
         - Finally all data has been processed and we have finished clustering
 
-        The data structure this algorithm returns you is as follows:
-
-        return is of type numpy.array:
-            [0] = processed signal: shape = (events, channels)
-            [1] = SN: shape = (events, channels)
-            [2] = CMN: shape = (events)
-            [3] = CMsig: shape = (events)
-            [4] = Hitmap: shape = (events, channels)
-            [5] = Channels hit: shape = (hitted channels)
-            [6] = Clusters: shape = (Channels hit shape = (channels in cluster))
-            [7] = Number of Clusters: shape = (events)
-            [8] = Clustersize: shape = (Channels hit: shape = (len(Clusters))
-            [9] = Timing: shape = (events)
+        The data structure this algorithm returns you is an EventResults
+        (see event_results.py) with contiguous arrays per event and the hits
+        and clusters of all events in CSR form. It can still be used like the
+        old Bdata with the labels:
+            Signal: processed signal: shape = (events, channels), only with store_signals
+            SN: shape = (events, channels), only with store_signals
+            CMN: shape = (events)
+            CMsig: shape = (events)
+            Hitmap: hitmap of all events for every event: shape = (events, channels)
+            Channel_hit: shape = (hitted channels)
+            Clusters: shape = (Channels hit shape = (channels in cluster))
+            Numclus: Number of Clusters: shape = (events)
+            Clustersize: shape = (Channels hit: shape = (len(Clusters))
+            Timing: shape = (events)
+        The features of every cluster (seed, size, signal, SN, position, eta, ...)
+        are calculated during the clustering as well, see EventResults.cluster_table.
+        The events are preprocessed into buffers which are reused for every chunk,
+        so only these results grow with the run. The signals of the hits and
+        cluster channels are kept, the signals of the whole events only if
+        store_signals is set (e.g. for the single event plots).
 
 
         # Base Analysis specific params
@@ -70,59 +84,122 @@ class BaseAnalysis:
             - SN_cluster: float - Minimum SN of a cluster to be considered
             - numchan: int - Number of channels
             - max_cluster_size: int - maximum clustersize to look for
+            - clustering: "seeds" or "runs" - clustering engine, see nb_cluster_event_runs
+            - store_signals: bool - Keep the signal and SN of all events, the memory grows with the run
 
     Written by Dominic Bloech
 
     """
 
-    def __init__(self, main, events, timing, logger = None):
+    def __init__(self, main, events, timing=None, logger = None):
         """
 
         :param main: MainAnalysis instance for additional paramerters if needed
-        :param events: The actual events must be of shape = (events, channels)
+        :param events: An EventSource of the run or the actual events, which must be of shape = (events, channels)
         :param timing: an array of all timing for every event (must be the same length
-                       as events parameter!!!
+                       as events parameter!!! Not needed if an EventSource is passed
         :param logger: If you want to pass a specific logger you can do so
         """
         self.log = logger or logging.getLogger(__class__.__name__)
         self.main = main
-        self.events = events
-        self.eventtiming = timing
-        self.prodata = None
-
-
+        if isinstance(events, EventSource):
+            self.events = events
+        else:
+            self.events = ArrayEventSource(events, timing,
+                                           chunk_size=getattr(main, "chunk_size", DEFAULT_CHUNK_SIZE))
+        if self.events.preprocessed and \
+                self.main.SN_cut*self.main.SN_ratio < self.events.threshold:
+            self.log.warning("The neighbour threshold SN_cut*SN_ratio is below the zero "
+                             "suppression threshold %s of the run, clusters may be "
+                             "smaller than on the full data!", self.events.threshold)
+        # The results of all events processed so far, the new chunks are appended
+        self.prodata = EventResults.from_chunks([], self.events.numchan)
+        # The preprocessed current chunk and the clustering scratch, reused for all chunks
+        self.buffers = PreprocessBuffers(self.events.numchan)
+        self.store_signals = getattr(main, "store_signals", False)
+        self.hitmap = np.zeros(self.events.numchan)
+        self.processed_events = 0
+        self.automasked_hits = 0
+        self.skipped_events = 0  # Events without a channel above SN_cut, not clustered
 
     def run(self):
-        """Does the actual event analysis and clustering in optimized python"""
-
-        # Get events with good timing and only process these events
-        gtime = np.nonzero(np.logical_and(self.eventtiming >= self.main.timingWindow[0],
-                                          self.eventtiming <= self.main.timingWindow[1]))
-        #self.eventtiming = self.eventtiming[gtime]
-
-        # Warning: If you have a RS and pulseshape recognition enabled the
-        # timing window has to be set accordingly
-
-        # This should, in theory, use parallelization of the loop over event
-        # but i did not see any performance boost, maybe you can find the bug =)?
-        data, automasked_hits = parallel_event_processing(gtime,
-                                                              self.eventtiming,
-                                                              self.events,
-                                                              self.main.pedestal,
-                                                              np.mean(self.main.CMN),
-                                                              np.mean(self.main.CMsig),
-                                                              self.main.noise,
-                                                              self.main.numChan,
-                                                              self.main.SN_cut,
-                                                              self.main.SN_ratio,
-                                                              self.main.SN_cluster,
-                                                              max_clustersize=self.main.max_cluster_size,
-                                                              masking=self.main.automasking,
-                                                              material=self.main.material,
-                                                              poolsize=self.main.process_pool,
-                                                              Pool=self.main.Pool,
-                                                              noisy_strips=self.main.noise_analysis.noisy_strips)
-        self.prodata = data
-        self.main.automasked_hit = automasked_hits
+        """Does the actual event analysis and clustering in optimized python.
+        The events are processed chunk by chunk as they are delivered by the event source"""
+        return self.process_new_events()
+
+    def update(self):
+        """Looks for new events in the event source (a file which is still written)
+        and processes only these. The results of all events processed so far are returned"""
+        self.events.update()
+        return self.process_new_events()
+
+    def follow(self, poll_interval=1., idle_timeout=30.):
+        """Follows a run which is still written by the DAQ and processes the
+        new events as soon as they appear.
+
+        :param poll_interval: Seconds between two looks at the file
+        :param idle_timeout: Stop if no new events appeared for this many seconds
+        """
+        self.process_new_events()
+        last_event = time()
+        while time() - last_event < idle_timeout:
+            sleep(poll_interval)
+            if self.events.update():
+                last_event = time()
+                self.process_new_events()
+                self.log.info("Events processed: %s", self.processed_events)
+        return self.prodata
+
+    def process_new_events(self):
+        """Processes all events which have not been processed so far, their
+        results are appended to the results of the events processed before"""
+        # Only events with good timing are read from the source and processed
+        for chunk in self.events.chunks(start=self.processed_events,
+                                        timing=self.main.timingWindow):
+            if self.events.preprocessed:
+                # Zero suppressed events are already corrected, only cluster them
+                result = cluster_preprocessed_events(chunk.signal, chunk.SN, chunk.CMN,
+                                                     chunk.CMsig,
+                                                     self.events.noise,
+                                                     self.main.numChan,
+                                                     self.main.SN_cut,
+                                                     self.main.SN_ratio,
+                                                     self.main.SN_cluster,
+                                                     self.main.max_cluster_size,
+                                                     self.main.automasking,
+                                                     self.main.material,
+                                                     np.array(chunk.time),
+                                                     getattr(self.main, "cluster_engine", "seeds"),
+                                                     self.buffers)
+            else:
+                # Warning: If you have a RS and pulseshape recognition enabled the
+                # timing window has to be set accordingly
+                result = parallel_event_processing(chunk.time,
+                                                   chunk.signal,
+                                                   self.main.pedestal,
+                                                   np.mean(self.main.CMN),
+                                                   np.mean(self.main.CMsig),
+                                                   self.main.noise,
+                                                   self.main.numChan,
+                                                   self.main.SN_cut,
+                                                   self.main.SN_ratio,
+                                                   self.main.SN_cluster,
+                                                   max_clustersize=self.main.max_cluster_size,
+                                                   masking=self.main.automasking,
+                                                   material=self.main.material,
+                                                   noisy_strips=self.main.noise_analysis.noisy_strips,
+                                                   cm_settings=getattr(self.main, "cm_settings", None),
+                                                   engine=getattr(self.main, "cluster_engine", "seeds"),
+                                                   buffers=self.buffers)
+            # The preprocessed events are overwritten by the next chunk, extend copies them
+            self.prodata.extend([result if self.store_signals else
+                                 result._replace(signal=None, SN=None)])
+            self.hitmap += result.hitmap
+            self.automasked_hits += int(np.sum(result.automasked))
+            self.skipped_events += result.skipped_events
+        self.processed_events = self.events.numevents
+
+        self.main.automasked_hit = self.automasked_hits
+        self.main.skipped_events = self.skipped_events
 
         return self.prodata
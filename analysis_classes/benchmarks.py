@@ -0,0 +1,582 @@
+"""This file contains benchmarks of the performance critical kernels on
+synthetic data, so changes of the kernels can be compared on any machine
+without measurement files. Type python AliTools.py bench --help to run them."""
+# pylint: disable=C0103
+import logging
+import tracemalloc
+from time import perf_counter
+import numpy as np
+from analysis_classes.nb_analysis_funcs import nb_preprocess_chips_into, \
+    nb_clustering, parallel_event_processing, preprocess_events, cluster_preprocessed_events, \
+    nb_seed_scan, nb_cluster_events, good_strip_mask, PreprocessBuffers, CM_METHODS, CHIP_SIZE, \
+    CLUSTER_ENGINES
+from analysis_classes.base_analysis import BaseAnalysis
+from analysis_classes.calibration import Calibration, fit_gain_curves, charge_step_signals, \
+    FIT_FAILED
+
+LOG = logging.getLogger("benchmarks")
+
+
+class BenchmarkFailure(Exception):
+    """Raised if a benchmarked kernel does not give the results of its reference"""
+
+
+def check(passed, message, *args):
+    """Raises a BenchmarkFailure with the message formatted with args if not passed"""
+    if not passed:
+        raise BenchmarkFailure(message % args)
+
+
+def synthetic_events(numevents=10000, numchan=256, noise=4., hits=0.01, seed=42, width=0):
+    """Raw events with pedestal, noise, a common mode per chip and some hits
+
+    :param numevents: Number of events
+    :param numchan: Number of channels
+    :param noise: Gaussian noise of every channel in ADC
+    :param hits: Fraction of channels with a signal of 60 - 200 ADC
+    :param seed: Seed of the random generator
+    :param width: The signal of every hit is shared with this many neighbours on each side
+    :return: events (float32), pedestal, noise: shape = (events, channels), (channels), (channels)
+    """
+    rng = np.random.RandomState(seed)
+    pedestal = rng.uniform(400., 600., numchan)
+    common_mode = np.repeat(rng.normal(0., 10., (numevents, numchan//CHIP_SIZE)), CHIP_SIZE, axis=1)
+    events = pedestal + common_mode + rng.normal(0., noise, (numevents, numchan))
+    hit = rng.random_sample((numevents, numchan)) < hits
+    signal = np.zeros((numevents, numchan))
+    signal[hit] = rng.uniform(60., 200., np.count_nonzero(hit))
+    for shift in range(1, width+1):
+        signal[:, shift:] += signal[:, :-shift]*(hit[:, :-shift]/(shift+1))
+        signal[:, :-shift] += signal[:, shift:]*(hit[:, shift:]/(shift+1))
+    events += signal
+    return events.astype(np.float32), pedestal, np.full(numchan, noise)
+
+
+def timed(func, *args, repeat=3):
+    """Best wall time of repeat calls of func(*args) in seconds, after one
+    call for the compilation"""
+    func(*args)
+    best = np.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def reference_preprocessing(events, pedestal, meanCMN, meanCMsig, noise, numchan, noisy_strips):
+    """
+    The preprocessing of all events with numpy as it was done before
+    nb_preprocess_events. It calculates the SN for every events per channel
+    and the CMN, CMNsig for every event.
+
+    :param events: All events shape = (events, channels)
+    :param pedestal: The pedestal: shape = (channels)
+    :param meanCMN: The mean CMN
+    :param meanCMsig: The mean CMNsig
+    :param noise: The noise per channel: shape = (channels)
+    :param numchan: The number of channels
+    :param noisy_strips: The noisy strips: shape = (channels)
+    :return: corrsignal - signal without the garbage: shape = (events, channels)
+             SN - Signal to noise: shape = (events)
+             CMN - Common mode for every event: shape = (events)
+             CMsig - Common mode std for every event: shape = (events)
+
+    Written by Dominic Bloech
+    """
+    signal = events - pedestal  # Get the signal from event and subtract pedestal
+
+    # Remove channels which have a signal higher then 5*CMsig+CMN which are not representative
+    removed = np.nonzero(signal[:,] > (5. * meanCMsig + meanCMN))
+    signal[removed[0], removed[1]] = 0 # Set the signals to 0
+    prosignal = signal
+
+    if prosignal.any():
+        # Calculate the mean CMN and CMNsig
+        cmpro = np.mean(prosignal, axis=1)
+        sigpro = np.std(prosignal, axis=1)
+
+        # Subtract the CMN for all channels
+        corrsignal = signal - cmpro[:,None]
+        # Get rid of noisy strips by setting the signal to 0 which are not needed for further calculations
+        corrsignal[:, noisy_strips] = 0
+        # Calculate the actuall SN
+        SN = corrsignal / noise
+
+        return corrsignal, SN, cmpro, sigpro
+    else:
+        return np.zeros(numchan), np.zeros(numchan), 0., 0.  # A default value return if everything fails
+
+
+def bench_common_mode(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3):
+    """Compares the global common mode preprocessing (numpy reference) with the
+    compiled kernel of the per chip robust estimators and checks that these
+    remove the injected common mode of every chip down to a quarter of the noise.
+    The kernel is timed writing into preallocated output arrays.
+
+    :return: dict "<method> (<implementation>)" -> {"events_per_s": float, "residual_cm": float}
+    """
+    events, pedestal, noise = synthetic_events(numevents, numchan)
+    noisy_strips = np.array(noisy_strips, dtype=np.int64)
+    good = good_strip_mask(numchan, noisy_strips)
+    results = {}
+
+    def residual(signal):
+        """Mean abs of the per chip median of the corrected signal"""
+        medians = [np.median(signal[:, chip][:, good[chip]], axis=1)
+                   for chip in np.arange(numchan).reshape(-1, CHIP_SIZE)]
+        return float(np.mean(np.abs(medians)))
+
+    args = (events, pedestal, 0., 0., noise, numchan, noisy_strips)
+    results["global (numpy reference)"] = {
+        "events_per_s": numevents/timed(reference_preprocessing, *args, repeat=repeat),
+        "residual_cm": residual(reference_preprocessing(*args)[0])}
+    out = (np.empty((numevents, numchan), dtype=np.float32),
+           np.empty((numevents, numchan), dtype=np.float32),
+           np.empty(numevents, dtype=np.float32), np.empty(numevents, dtype=np.float32))
+    for method, code in CM_METHODS.items():
+        args = (events, pedestal, noise, good, CHIP_SIZE, code, 2.5, 3, 0.1) + out
+        results["{} (compiled kernel)".format(method)] = {
+            "events_per_s": numevents/timed(nb_preprocess_chips_into, *args, repeat=repeat),
+            "residual_cm": residual(out[0])}
+    for case, result in results.items():
+        LOG.info("Common mode %s: %.0f events/s, residual common mode %.2f ADC",
+                 case, result["events_per_s"], result["residual_cm"])
+    for method in CM_METHODS:
+        residual_cm = results["{} (compiled kernel)".format(method)]["residual_cm"]
+        check(residual_cm < 0.25*np.mean(noise),
+              "The %s common mode leaves a residual common mode of %.2f ADC!", method, residual_cm)
+    return results
+
+
+def reference_event_processing(events, pedestal, noise, noisy_strips, SN_cut=6., SN_ratio=0.5,
+                               SN_cluster=5., max_clustersize=20):
+    """The event processing as it was done before the compiled kernels, event
+    by event in python: numpy preprocessing and nb_clustering of every event
+
+    :return: number of clusters, clusters of every event
+    """
+    signal, SN, _, _ = reference_preprocessing(events, pedestal, 0., 0., noise,
+                                               events.shape[1], noisy_strips)
+    numclus, clusters = [], []
+    for i in range(len(signal)):
+        _, event_clusters, event_numclus, _, _ = nb_clustering(signal[i], SN[i], noise, SN_cut,
+                                                               SN_ratio, SN_cluster, events.shape[1],
+                                                               max_clustersize=max_clustersize)
+        numclus.append(event_numclus)
+        clusters.append([list(cluster) for cluster in event_clusters])
+    return np.array(numclus), clusters
+
+
+def bench_event_processing(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3):
+    """Compares the compiled parallel event processing with the event by event
+    reference and checks that both find the same clusters.
+
+    :return: dict path -> {"events_per_s": float, "clusters": int}
+    """
+    events, pedestal, noise = synthetic_events(numevents, numchan)
+    events = pedestal - (events - pedestal)  # Negative signals like n-in-p sensors
+    noisy_strips = np.array(noisy_strips, dtype=np.int64)
+    timing = np.zeros(numevents, dtype=np.float32)
+    kernel_args = (timing, events, pedestal, 0., 0., noise, numchan, 6., 0.5, 5., 20)
+    result = parallel_event_processing(*kernel_args, noisy_strips=noisy_strips)
+    numclus, clusters = reference_event_processing(events, pedestal, noise, noisy_strips)
+    kernel_clusters = [[result.cluster_channels[result.channel_indptr[c]:result.channel_indptr[c+1]].tolist()
+                        for c in range(result.cluster_indptr[i], result.cluster_indptr[i+1])]
+                       for i in range(numevents)]
+    check(np.array_equal(numclus, result.numclus) and clusters == kernel_clusters,
+          "The compiled event processing does not find the same clusters as the reference!")
+
+    results = {"reference": {"events_per_s": numevents/timed(reference_event_processing, events,
+                                                             pedestal, noise, noisy_strips,
+                                                             repeat=repeat),
+                             "clusters": int(np.sum(numclus))},
+               "compiled": {"events_per_s": numevents/timed(lambda: parallel_event_processing(
+                   *kernel_args, noisy_strips=noisy_strips), repeat=repeat),
+                            "clusters": int(np.sum(result.numclus))}}
+    for path, stats in results.items():
+        LOG.info("Event processing %s: %.0f events/s, %d clusters", path,
+                 stats["events_per_s"], stats["clusters"])
+    return results
+
+
+def cluster_sets(result):
+    """The clusters of a ProcessedChunk as set of (event, channels) with the
+    channels as sorted tuple"""
+    clusters = set()
+    for i in range(len(result.numclus)):
+        for c in range(result.cluster_indptr[i], result.cluster_indptr[i+1]):
+            channels = result.cluster_channels[result.channel_indptr[c]:result.channel_indptr[c+1]]
+            clusters.add((i, tuple(sorted(channels.tolist()))))
+    return clusters
+
+
+def bench_clustering_engines(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3,
+                             widths=(0, 2, 6), max_clustersizes=(5, 20, 80)):
+    """Compares the clustering engines on events with clusters of different
+    widths. The runs engine is cross-checked against the seeds engine with a
+    max_clustersize bigger than all clusters: both must find the same clusters,
+    except close to the sensor edges where the seeds engine stops growing.
+
+    :return: dict "engine width max_clustersize" -> {"events_per_s": float, "clusters": int}
+    """
+    noisy_strips = np.array(noisy_strips, dtype=np.int64)
+    results = {}
+    for width in widths:
+        events, pedestal, noise = synthetic_events(numevents, numchan, hits=0.01/(2*width+1),
+                                                   width=width)
+        events = pedestal - (events - pedestal)  # Negative signals like n-in-p sensors
+        signal, SN, CMN, CMsig = preprocess_events(events, pedestal, 0., 0., noise, numchan,
+                                                   noisy_strips)
+        timing = np.zeros(numevents, dtype=np.float32)
+
+        def cluster(engine, max_clustersize):
+            """Clusters the preprocessed events"""
+            return cluster_preprocessed_events(signal, SN, CMN, CMsig, noise, numchan, 6., 0.5, 5.,
+                                               max_clustersize, True, 1, timing, engine)
+
+        # Cross-check, the differences must all be in events with clusters close to the edges
+        seeds, runs = cluster("seeds", 2*numchan), cluster("runs", 0)
+        edge_events = set()
+        for table in (seeds.cluster_table, runs.cluster_table):
+            edge = np.logical_or(table["first"] < table["size"],
+                                 table["last"] >= numchan - table["size"])
+            edge_events.update(table["event"][edge].tolist())
+        differences = cluster_sets(seeds) ^ cluster_sets(runs)
+        inner = [event for event, _ in differences if event not in edge_events]
+        check(not inner, "The runs clustering differs from the seeds clustering for %s clusters "
+              "of width %s!", len(inner), width)
+        LOG.info("Width %s: %d clusters, %d differ between the engines close to the edges",
+                 width, len(runs.cluster_table), len(differences) - len(inner))
+
+        for engine in CLUSTER_ENGINES:
+            for max_clustersize in max_clustersizes if engine == "seeds" else max_clustersizes[:1]:
+                results["{} {} {}".format(engine, width, max_clustersize)] = {
+                    "events_per_s": numevents/timed(cluster, engine, max_clustersize, repeat=repeat),
+                    "clusters": int(np.sum(cluster(engine, max_clustersize).numclus))}
+    for name, stats in results.items():
+        LOG.info("Clustering engine, width, max_clustersize %s: %.0f events/s, %d clusters",
+                 name, stats["events_per_s"], stats["clusters"])
+    return results
+
+
+def bench_seed_scan(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3,
+                    occupancies=(0.0005, 0.002, 0.01)):
+    """Compares the clustering of all events with the clustering of only the
+    events found by the seed pre-scan (including the scan) for different hit
+    occupancies, and checks that both give the same results.
+
+    :return: dict "all/scanned occupancy" -> {"events_per_s": float, "skipped": int}
+    """
+    noisy_strips = np.array(noisy_strips, dtype=np.int64)
+    results = {}
+    for occupancy in occupancies:
+        events, pedestal, noise = synthetic_events(numevents, numchan, hits=occupancy)
+        events = pedestal - (events - pedestal)  # Negative signals like n-in-p sensors
+        signal, SN, _, _ = preprocess_events(events, pedestal, 0., 0., noise, numchan, noisy_strips)
+        args = (signal, SN, noise, 6., 0.5, 5., 20, True, 1, 0)
+        scratch = PreprocessBuffers(numchan).cluster_scratch(numevents)
+
+        def scanned():
+            """Clustering of the candidates of the pre-scan"""
+            return nb_cluster_events(*args, np.nonzero(nb_seed_scan(SN, 6.))[0], *scratch)
+
+        every = nb_cluster_events(*args, np.arange(numevents), *scratch)
+        check(all(np.array_equal(a, b) for a, b in zip(every, scanned())),
+              "The clustering with the seed pre-scan differs from the clustering of all events!")
+        skipped = numevents - int(np.count_nonzero(nb_seed_scan(SN, 6.)))
+        results["all {}".format(occupancy)] = {
+            "events_per_s": numevents/timed(nb_cluster_events, *args, np.arange(numevents),
+                                            *scratch, repeat=repeat),
+            "skipped": 0}
+        results["scanned {}".format(occupancy)] = {
+            "events_per_s": numevents/timed(scanned, repeat=repeat), "skipped": skipped}
+    for name, stats in results.items():
+        LOG.info("Clustering %s: %.0f events/s, %d events skipped", name,
+                 stats["events_per_s"], stats["skipped"])
+    return results
+
+
+def bench_preprocess_allocations(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3,
+                                 chunk_size=1000, hits=0.004):
+    """Checks with tracemalloc that BaseAnalysis.process_new_events processes the
+    chunks of a run in buffers which are reused for every chunk, and compares it
+    with the processing of every chunk into new arrays. The synthetic run has
+    about one hit per event, so the clustering runs on most events. tracemalloc
+    also sees the allocations inside the compiled kernels.
+    - Besides the chunk buffers of the analysis and the event source, the run
+      may only keep its results, at most a quarter of the float32 signal and SN
+      of all events (which are only kept with store_signals)
+    - Temporarily at most a tenth of the float32 signal and SN of a chunk may
+      be allocated, besides the results of the chunk which are copied into the
+      results of the run
+    - The clustering kernel may only allocate its results and per event
+      counters, its temporary allocations are bounded by a twentieth of this chunk size
+
+    :return: dict "common mode outputs" -> {"events_per_s": float, "allocated_MB": float,
+                                            "kept_MB": float},
+             allocated_MB is the peak allocation, kept_MB what is still allocated afterwards
+    """
+    events, pedestal, noise = synthetic_events(numevents, numchan, hits=hits)
+    events = pedestal - (events - pedestal)  # Negative signals like n-in-p sensors
+    timing = np.zeros(numevents, dtype=np.float32)
+    noisy_strips = np.array(noisy_strips, dtype=np.int64)
+    run_MB = 2*numevents*numchan*4/1e6
+    chunk_MB = 2*chunk_size*numchan*4/1e6
+    results = {}
+
+    def traced(func, *args):
+        """Result, peak and still allocated MB of func(*args)"""
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = func(*args)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result, (peak - baseline)/1e6, (current - baseline)/1e6
+
+    for method, cm_settings in (("global", None), ("median", (CM_METHODS["median"], 2.5, 3, 0.1))):
+        main = type("Main", (), {"timingWindow": None, "pedestal": pedestal, "CMN": np.zeros(1),
+                                 "CMsig": np.zeros(1), "noise": noise, "numChan": numchan,
+                                 "SN_cut": 6., "SN_ratio": 0.5, "SN_cluster": 5.,
+                                 "max_cluster_size": 20, "automasking": True, "material": 1,
+                                 "noise_analysis": type("Noise", (), {"noisy_strips": noisy_strips}),
+                                 "cm_settings": cm_settings, "cluster_engine": "seeds",
+                                 "chunk_size": chunk_size})
+
+        def new_arrays():
+            """Processes every chunk into new arrays"""
+            return [parallel_event_processing(timing[first:first+chunk_size],
+                                              events[first:first+chunk_size], pedestal, 0., 0.,
+                                              noise, numchan, 6., 0.5, 5., 20,
+                                              noisy_strips=noisy_strips, cm_settings=cm_settings)
+                    for first in range(0, numevents, chunk_size)]
+
+        def process_run(stop=numevents):
+            """Processes the first stop events like the MainAnalysis"""
+            analysis = BaseAnalysis(main, events[:stop], timing[:stop])
+            analysis.process_new_events()
+            return analysis
+
+        for outputs, func in (("new", new_arrays), ("run", process_run)):
+            seconds = timed(func, repeat=repeat)
+            analysis, allocated_MB, kept_MB = traced(func)
+            results["{} {}".format(method, outputs)] = {"events_per_s": numevents/seconds,
+                                                        "allocated_MB": allocated_MB,
+                                                        "kept_MB": kept_MB}
+        # The chunk buffers of the analysis and of the event source
+        buffers = analysis.buffers
+        buffers_MB = sum(getattr(buffers, name).nbytes for name in
+                         ("signal", "SN", "CMN", "CMsig", "hits", "clusters", "sizes"))/1e6
+        buffers_MB += sum(buffer.nbytes for buffer in analysis.events.buffers(0))/1e6
+        run = results["{} run".format(method)]
+        kept_MB = run["kept_MB"] - buffers_MB
+        check(kept_MB < 0.25*run_MB, "The %s run processing keeps %.2f MB besides the chunk "
+              "buffers, the signal and SN of the run are %.2f MB!", method, kept_MB, run_MB)
+        # In a run of one chunk everything besides the buffers and the results is temporary
+        _, allocated_MB, kept_MB = traced(process_run, chunk_size)
+        temporary_MB = allocated_MB - kept_MB - (kept_MB - buffers_MB)
+        check(temporary_MB < 0.1*chunk_MB, "The %s run processing allocated %.2f MB "
+              "temporarily for chunks of %.2f MB!", method, temporary_MB, chunk_MB)
+
+    # The clustering kernel on one chunk with the scratch arrays of the buffers
+    signal, SN, _, _ = preprocess_events(events[:chunk_size], pedestal, 0., 0., noise, numchan,
+                                         noisy_strips, out=buffers.views(chunk_size))
+    candidates = np.nonzero(nb_seed_scan(SN, 6.))[0]
+    args = (signal, SN, noise, 6., 0.5, 5., 20, True, 1, 0, candidates,
+            *buffers.cluster_scratch(len(candidates)))
+    seconds = timed(nb_cluster_events, *args, repeat=repeat)
+    kernel_results, allocated_MB, kept_MB = traced(nb_cluster_events, *args)
+    temporary_MB = allocated_MB - sum(result.nbytes for result in kernel_results)/1e6
+    results["cluster kernel"] = {"events_per_s": chunk_size/seconds,
+                                 "allocated_MB": allocated_MB, "kept_MB": kept_MB}
+    check(temporary_MB < 0.05*chunk_MB, "The clustering kernel allocated %.2f MB besides its "
+          "results for chunks of %.2f MB!", temporary_MB, chunk_MB)
+    for name, stats in results.items():
+        LOG.info("Processing %s: %.0f events/s, %.3f MB allocated, %.3f MB kept", name,
+                 stats["events_per_s"], stats["allocated_MB"], stats["kept_MB"])
+    return results
+
+
+def reference_gain_fit(mean_sig, sig_std, pulses, fit_range, degree, noisy_channels):
+    """The gain curve fit as it was done before fit_gain_curves, channel by
+    channel with np.polyfit. Failed fits give zeros like there."""
+    coeff = np.zeros((mean_sig.shape[1], degree+1))
+    for i in range(mean_sig.shape[1]):
+        if i in noisy_channels:
+            continue
+        signal, std = mean_sig[:, i], sig_std[:, i]
+        if signal[0] <= fit_range[0] and signal[-1] >= fit_range[0]:
+            xminarg = np.argwhere(signal <= fit_range[0])[-1][0]
+            xmaxarg = np.argwhere(signal <= fit_range[1])[-1][0]
+        else:
+            xminarg, xmaxarg = 0, len(signal)
+        while xminarg < xmaxarg and signal[xminarg]*0.4 <= std[xminarg]:
+            xminarg += 1
+        if xminarg < xmaxarg:
+            coeff[i] = np.polyfit(signal[xminarg:xmaxarg], pulses[xminarg:xmaxarg], deg=degree)
+    return coeff
+
+
+def bench_gain_fit(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3,
+                   numpulses=64, degrees=(1, 2, 5), fit_range=(20., 200.)):
+    """Compares the batched gain curve fit of all channels with the fit
+    channel by channel on a synthetic charge scan and checks that both give
+    the same gain curves.
+
+    :param numevents: Events per pulse of the synthetic charge scan
+    :return: dict "loop/batched degree" -> {"channels_per_s": float, "max_deviation_e": float}
+    """
+    rng = np.random.RandomState(42)
+    pulses = np.linspace(0., 64000., numpulses+1)
+    gain = rng.uniform(200., 280., numchan)  # electrons per ADC
+    curve = pulses[:, None]/gain - 2e-9*pulses[:, None]**2
+    sig_std = np.abs(rng.normal(4., 0.5, (numpulses+1, numchan)))
+    sig_std[:3] *= 5.  # The first pulses are noisy
+    mean_sig = curve + rng.normal(0., 1., curve.shape)*sig_std/np.sqrt(numevents/numpulses)
+    mean_sig, sig_std = mean_sig[1:], sig_std[1:]  # The first pulse is not fitted
+    noisy_strips = np.array(noisy_strips, dtype=np.int64)
+    results = {}
+    for degree in degrees:
+        args = (mean_sig, sig_std, pulses, fit_range, degree, noisy_strips)
+        reference = reference_gain_fit(*args)
+        coeff, _, _, flags = fit_gain_curves(*args)
+        deviation = max((np.max(np.abs(np.polyval(reference[i], mean_sig[:, i]) -
+                                       np.polyval(coeff[i], mean_sig[:, i])))
+                         for i in range(numchan) if not flags[i] & FIT_FAILED), default=0.)
+        check(deviation <= 1., "The batched gain fit of degree %s differs by %.3g electrons "
+              "from the fit of every channel!", degree, deviation)
+        results["loop {}".format(degree)] = {
+            "channels_per_s": numchan/timed(reference_gain_fit, *args, repeat=repeat),
+            "max_deviation_e": 0.}
+        results["batched {}".format(degree)] = {
+            "channels_per_s": numchan/timed(fit_gain_curves, *args, repeat=repeat),
+            "max_deviation_e": deviation}
+    for name, stats in results.items():
+        LOG.info("Gain fit %s: %.0f channels/s, max deviation %.3g e", name,
+                 stats["channels_per_s"], stats["max_deviation_e"])
+    return results
+
+
+def reference_ADC_conversion(coeff, signals, channels):
+    """The ADC to electron conversion per channel as it was done before
+    nb_polyval_channels, the results are ordered by channel"""
+    result = np.array([])
+    for ch in np.unique(channels):
+        result = np.append(result, np.polyval(coeff[ch], np.take(np.abs(signals),
+                                                                 np.nonzero(channels == ch))))
+    return np.absolute(result)
+
+
+def bench_ADC_conversion(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3,
+                         hits_per_event=1000, degree=5, table_step=0.5, table_tolerance=1.):
+    """Compares the order preserving ADC to electron conversion with the gain
+    curve of every channel with the conversion channel by channel. Both give
+    the same values, the old one ordered by channel. The conversion with the
+    tabulated gain curves is compared as well, it must not deviate more from
+    the polynomials than ADC_table_deviation and the channels whose tables
+    deviate more than table_tolerance must be converted with the polynomials.
+
+    :param numevents: Number of events, with hits_per_event hits each (1e7 hits by default)
+    :return: dict "loop/polynomials/tables" -> {"hits_per_s": float, "max_deviation_e": float}
+    """
+    rng = np.random.RandomState(42)
+    noise_analysis = type("Noise", (), {"pedestal": np.zeros(numchan),
+                                        "noisy_strips": np.array(noisy_strips, dtype=np.int64)})
+    calibration = Calibration(Noise_calc=noise_analysis,
+                              configs={"use_charge_cal": False, "numChan": numchan,
+                                       "calibrate_gain_to": "negative", "ADC_table_step": table_step,
+                                       "ADC_table_tolerance": table_tolerance,
+                                       "Gain_params": [0.]*(degree+1)})
+    calibration.channel_coeff = rng.normal(0., 1e-12, (numchan, degree+1))
+    calibration.channel_coeff[:, -3] = rng.normal(0., 0.05, numchan)
+    calibration.channel_coeff[:, -2] = rng.uniform(200., 280., numchan)
+    calibration.meancoeff = np.mean(calibration.channel_coeff, axis=0)
+    signals = rng.normal(0., 100., numevents*hits_per_event)
+    channels = rng.randint(0, numchan, len(signals))
+
+    # Noisy channels are converted with the mean gain curve
+    coeff = calibration.channel_coeff.copy()
+    coeff[noise_analysis.noisy_strips] = calibration.meancoeff
+    converted = calibration.convert_ADC_to_e(signals, channels)
+    start = perf_counter()  # The loop takes seconds for 1e7 hits, it is timed only once
+    reference = reference_ADC_conversion(coeff, signals, channels)
+    loop_seconds = perf_counter() - start
+    check(np.allclose(converted[np.argsort(channels, kind="stable")], reference, rtol=1e-12),
+          "The compiled ADC to electron conversion differs from the conversion per channel!")
+    results = {"loop": {"hits_per_s": len(signals)/loop_seconds, "max_deviation_e": 0.},
+               "polynomials": {"hits_per_s": len(signals)/timed(calibration.convert_ADC_to_e,
+                                                                 signals, channels, repeat=repeat),
+                               "max_deviation_e": 0.}}
+
+    # The largest signals are beyond the tables and evaluated with the polynomials
+    calibration.build_ADC_tables(max_ADC=np.percentile(np.abs(signals), 99.9))
+    deviation = np.abs(calibration.convert_ADC_to_e(signals, channels) - converted)
+    table_deviation = calibration.ADC_table_deviation
+    allowed = np.where(table_deviation <= table_tolerance, table_deviation, 0.)
+    check(np.all(deviation <= allowed[channels]*(1+1e-6) + 1e-6), "The tabulated ADC to "
+          "electron conversion deviates more than ADC_table_deviation from the polynomials!")
+    results["tables"] = {"hits_per_s": len(signals)/timed(calibration.convert_ADC_to_e,
+                                                          signals, channels, repeat=repeat),
+                         "max_deviation_e": np.max(deviation)}
+    for name, stats in results.items():
+        LOG.info("ADC to electron conversion %s: %.3g hits/s, max deviation %.3g e", name,
+                 stats["hits_per_s"], stats["max_deviation_e"])
+    return results
+
+
+def reference_charge_step(signals, pedestal):
+    """Mean and std of the negative pulses of a charge scan step as they were
+    calculated before charge_step_signals"""
+    signals = signals - pedestal
+    raw_half = np.mean(signals[0::2], axis=0)
+    raw_half_std = np.std(signals[0::2], axis=0)
+    raw_half2 = np.mean(signals[1::2], axis=0)
+    raw_half2_std = np.std(signals[1::2], axis=0)
+    return (np.abs(np.hstack(list(zip(raw_half[0::2], raw_half2[1::2])))),
+            np.hstack(list(zip(raw_half_std[0::2], raw_half2_std[1::2]))))
+
+
+def bench_charge_scan(numevents=10000, numchan=256, noisy_strips=(5, 130), repeat=3,
+                      steps=32):
+    """Compares the reduction of the steps of a charge scan by
+    charge_step_signals with the reduction of the even/odd events and
+    channels one after the other and checks that both give the same values.
+
+    :param numevents: Number of events of the charge scan
+    :return: dict "loop/reshape" -> {"steps_per_s": float}
+    """
+    events, pedestal, _ = synthetic_events(numevents, numchan)
+    step_events = numevents//steps
+    step_signals = [events[first:first+step_events]
+                    for first in range(0, steps*step_events, step_events)]
+
+    def scan(reduction):
+        """Reduces all steps like the charge calibration"""
+        return [reduction(signals) for signals in step_signals]
+
+    def reshaped(signals):
+        """The new reduction of the negative pulses"""
+        return charge_step_signals(signals, pedestal, -1)
+
+    def per_half(signals):
+        """The old reduction of the negative pulses"""
+        return reference_charge_step(signals, pedestal)
+
+    for (mean, std), (ref_mean, ref_std) in zip(scan(reshaped), scan(per_half)):
+        check(np.allclose(mean, ref_mean, rtol=1e-9) and np.allclose(std, ref_std, rtol=1e-9),
+              "The reshaped charge scan reduction differs from the reduction per half!")
+    results = {"loop": {"steps_per_s": steps/timed(scan, per_half, repeat=repeat)},
+               "reshape": {"steps_per_s": steps/timed(scan, reshaped, repeat=repeat)}}
+    for name, stats in results.items():
+        LOG.info("Charge scan reduction %s: %.0f steps/s", name, stats["steps_per_s"])
+    return results
+
+
+BENCHMARKS = {"common_mode": bench_common_mode,
+              "event_processing": bench_event_processing,
+              "clustering_engines": bench_clustering_engines,
+              "seed_scan": bench_seed_scan,
+              "preprocess_allocations": bench_preprocess_allocations,
+              "gain_fit": bench_gain_fit,
+              "ADC_conversion": bench_ADC_conversion,
+              "charge_scan": bench_charge_scan}
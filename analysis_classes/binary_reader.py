@@ -0,0 +1,439 @@
+"""This file contains the decoder for ALiBaVa binary files. Instead of reading
+every data block with f.read and unpacking it with struct, the file is memory
+mapped and the fixed size 0xcafe0002 blocks are interpreted as a numpy
+structured dtype. This way all events are decoded in bulk."""
+# pylint: disable=C0103,C0301
+import logging
+import os
+import struct
+import sys
+from multiprocessing import Pool, shared_memory
+import numpy as np
+
+LOG = logging.getLogger("binary_reader")
+
+# Both byte orders of the 0xcafe0002 block header are seen in the wild
+BLOCK_MAGIC = (b'\x02\x00\xfe\xca', b'\xca\xfe\x00\x02')
+BLOCK_MAGIC_INT = np.frombuffer(b"".join(BLOCK_MAGIC), dtype="=u4")
+BLOCK_HEADER_SIZE = 8  # magic (4 bytes) + blocksize (4 bytes)
+
+# Positions (relative to the start of the block payload) of the two signal
+# halves. There is garbage data between and in front of them which is cut out
+SIGNAL_OFFSETS = (18 + 32, 18 + 32 + 2*130 + 28)
+MIN_BLOCKSIZE = SIGNAL_OFFSETS[1] + 2*128
+
+# The time masks are derived exactly like in the original struct based decoder
+# so that the decoded timings stay the same
+TIME_MASK_HIGH = int.from_bytes(b'0xFFFF0000', byteorder=sys.byteorder) & 0xFFFFFFFF
+TIME_MASK_LOW = int.from_bytes(b'0xFFFF', byteorder=sys.byteorder) & 0xFFFFFFFF
+
+# Sidecar file with the block offsets, see build_index
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+
+def block_dtype():
+    """Returns the structured numpy dtype of a single data block including
+    the 8 byte block header. The itemsize only covers the decoded part, the
+    actual stride between blocks is given by the blocksize in the file."""
+    return np.dtype({"names": ["magic", "blocksize", "clock", "coded_time",
+                               "temperature", "signal1", "signal2"],
+                     "formats": ["=u4", "=u4", "=u4", "=u4", "=u2",
+                                 ("=i2", 128), ("=i2", 128)],
+                     "offsets": [0, 4,
+                                 BLOCK_HEADER_SIZE + 8,
+                                 BLOCK_HEADER_SIZE + 12,
+                                 BLOCK_HEADER_SIZE + 16,
+                                 BLOCK_HEADER_SIZE + SIGNAL_OFFSETS[0],
+                                 BLOCK_HEADER_SIZE + SIGNAL_OFFSETS[1]],
+                     "itemsize": BLOCK_HEADER_SIZE + MIN_BLOCKSIZE})
+
+
+def map_file(filepath):
+    """Memory maps a file as uint8 array. Empty files are returned as an empty
+    array, since they cannot be mapped."""
+    if not os.path.getsize(os.path.normpath(filepath)):
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(os.path.normpath(filepath), dtype=np.uint8, mode="r")
+
+
+def read_binary_header(buf):
+    """Parses the file header of an ALiBaVa binary file.
+
+    :param buf: The memory mapped file (uint8 array)
+    :return: dict with start time, run type, header string, pedestal, noise and
+             the byte offset of the first data block
+    """
+    header = bytes(buf[0:16])
+    Starttime = struct.unpack("II", header[0:8])[0]  # Is a uint32
+    Runtype = struct.unpack("i", header[8:12])[0]  # int32
+    Headerlength = struct.unpack("I", header[12:16])[0]
+    pos = 16
+    Header = bytes(buf[pos:pos+Headerlength]).decode("Utf-8")
+    pos += Headerlength
+    Pedestal = np.frombuffer(bytes(buf[pos:pos+8*256]), dtype="=f8").astype(np.float32)
+    pos += 8*256
+    Noise = np.frombuffer(bytes(buf[pos:pos+8*256]), dtype="=f8").astype(np.float32)
+    pos += 8*256
+    return {"start": Starttime, "runtype": Runtype, "header": Header,
+            "pedestal": Pedestal, "noise": Noise, "data_offset": pos}
+
+
+def scan_values(Header):
+    """Disect the header for the correct informations for the scan values"""
+    points = Header.split("|")[1].split(";")
+    params = [x.strip("\x00") for x in points]
+
+    # Alibava binary have (unfortunately) a non consistend header format
+    # Therefore, we have to distinguish between the two formats --> len(params) = 4 --> Calibration
+    # len(params) = 2 --> Eventfile
+    if len(params) >= 4: # Cal file
+        return np.arange(int(params[1]), int(params[2]), int(params[3]))  # aka xdata
+    if len(params) == 2: # Events file
+        return np.arange(0, int(params[0]), step=1)  # aka xdata
+    return None
+
+
+def _blockheader_at(buf, pos):
+    """Returns the blocksize if a valid block header is found at pos, else None"""
+    if bytes(buf[pos:pos+4]) not in BLOCK_MAGIC:
+        return None
+    return struct.unpack("I", bytes(buf[pos+4:pos+8]))[0]
+
+
+def _resync(buf, pos):
+    """Slow path for damaged regions. Searches in 4 byte steps (like the
+    original sequential reader) for the next complete block.
+
+    :return: position of the next block header or None if the end of the file is reached
+    """
+    start = pos
+    while pos + BLOCK_HEADER_SIZE <= len(buf):
+        blocksize = _blockheader_at(buf, pos)
+        if blocksize is not None:
+            if pos + BLOCK_HEADER_SIZE + blocksize > len(buf):
+                # An incomplete block is only possible at the end of the file
+                LOG.debug("Incomplete data block at byte %s is ignored", pos)
+                return None
+            if blocksize >= MIN_BLOCKSIZE:
+                if pos != start:
+                    LOG.warning("Damaged data region between byte %s and %s skipped", start, pos)
+                return pos
+        pos += 4
+    LOG.debug("Persumably end of binary file reached at byte %s", pos)
+    return None
+
+
+def find_data_blocks(buf, data_offset):
+    """Finds all complete data blocks of the file. As long as the blocks have
+    the same size this is done on a strided view over all blocks at once. Only
+    if a block does not fit the pattern the slow resync path is used.
+
+    Warning Alibava Binary calibration files have no indicatior how many events are really inside the file.
+    Therefore, the file has to be scanned until the end is reached --> Advantage: Damaged files can be read as well
+
+    :param buf: The memory mapped file (uint8 array)
+    :param data_offset: Byte offset of the first data block
+    :return: offsets of all block headers (int64), blocksizes (uint32)
+    """
+    dtype = block_dtype()
+    offsets, sizes = [], []
+    pos = _resync(buf, data_offset)
+    while pos is not None:
+        blocksize = _blockheader_at(buf, pos)
+        stride = BLOCK_HEADER_SIZE + blocksize
+        count = (len(buf) - pos) // stride
+        blocks = np.ndarray((count,), dtype=dtype, buffer=buf, offset=pos, strides=(stride,))
+        valid = np.isin(blocks["magic"], BLOCK_MAGIC_INT)
+        valid &= blocks["blocksize"] == blocksize
+        good = count if valid.all() else int(np.argmin(valid))
+        offsets.append(pos + stride*np.arange(good, dtype=np.int64))
+        sizes.append(np.full(good, blocksize, dtype=np.uint32))
+        pos = _resync(buf, pos + stride*good)
+
+    if not offsets:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+    return np.concatenate(offsets), np.concatenate(sizes)
+
+
+def _segments(offsets):
+    """Splits the block offsets into segments with a constant stride, so that
+    every segment can be decoded from a strided view of the file.
+    Returns a list of (start index, stop index, stride)"""
+    numblocks = len(offsets)
+    diffs = np.diff(offsets)
+    # Indizes in diffs where the stride changes
+    changes = np.nonzero(diffs[1:] != diffs[:-1])[0] + 1
+    segments = []
+    start = 0
+    while start < numblocks:
+        if start == numblocks - 1:
+            segments.append((start, numblocks, 1))
+            break
+        nextchange = np.searchsorted(changes, start + 1)
+        stop = changes[nextchange] + 1 if nextchange < len(changes) else numblocks
+        segments.append((start, int(stop), int(diffs[start])))
+        start = int(stop)
+    return segments
+
+
+def decode_blocks(buf, offsets, out=None):
+    """Decodes signal, clock, time and temperature of the data blocks at the
+    passed offsets in bulk.
+
+    :param buf: The memory mapped file (uint8 array)
+    :param offsets: Byte offsets of the block headers (see find_data_blocks)
+    :param out: Optional dict with preallocated arrays to decode into. Possible
+                keys are signal (events, 256), time, temperature and clock (events).
+                Only the passed fields are decoded.
+    :return: dict with the decoded arrays
+    """
+    numevents = len(offsets)
+    if out is None:
+        out = {"signal": np.zeros((numevents, 256), dtype=np.float32),
+               "temperature": np.zeros(numevents, dtype=np.float32),
+               "time": np.zeros(numevents, dtype=np.float32),
+               "clock": np.zeros(numevents, dtype=np.float32)}
+    dtype = block_dtype()
+    for start, stop, stride in _segments(np.asarray(offsets)):
+        blocks = np.ndarray((stop-start,), dtype=dtype, buffer=buf,
+                            offset=int(offsets[start]), strides=(stride,))
+        if "clock" in out:
+            out["clock"][start:stop] = blocks["clock"]
+        if "time" in out:
+            coded_time = blocks["coded_time"].astype(np.int64)
+            ipart = (coded_time & TIME_MASK_HIGH) >> 16
+            fpart = np.sign(ipart)*(coded_time & TIME_MASK_LOW)
+            out["time"][start:stop] = 100*ipart+fpart
+        if "temperature" in out:
+            out["temperature"][start:stop] = 0.12*blocks["temperature"]-39.8
+        if "signal" in out:
+            out["signal"][start:stop, :128] = blocks["signal1"]
+            out["signal"][start:stop, 128:] = blocks["signal2"]
+    return out
+
+
+class BlockTail:
+    """Follows a binary file which is still written by the DAQ. It remembers
+    the position after the last complete data block and hands out only the
+    blocks which have been completed since the last poll. A partially written
+    block at the end of the file is left alone until it is complete.
+    Warning: The file header has to be written already."""
+    def __init__(self, filepath, position=None):
+        """
+        :param filepath: Path to the binary file
+        :param position: Byte offset after the last already known block, default is the first data block
+        """
+        self.filepath = filepath
+        self.buf = map_file(filepath)
+        self.file_header = read_binary_header(self.buf)
+        self.position = self.file_header["data_offset"] if position is None else int(position)
+
+    def poll(self):
+        """Returns the offsets and sizes of all data blocks which have been
+        completed since the last poll (may be empty)"""
+        if os.path.getsize(os.path.normpath(self.filepath)) != len(self.buf):
+            # The file has grown, map it again so the new blocks are visible
+            self.buf = map_file(self.filepath)
+        offsets, sizes = find_data_blocks(self.buf, self.position)
+        if len(offsets):
+            self.position = int(offsets[-1]) + BLOCK_HEADER_SIZE + int(sizes[-1])
+        return offsets, sizes
+
+
+def index_path(filepath):
+    """Path of the index sidecar file of a binary file"""
+    return os.path.normpath(filepath) + INDEX_SUFFIX
+
+
+def build_index(filepath, save=True):
+    """Scans the binary file once for all data blocks and (optionally) writes
+    the result as sidecar file next to it. The index holds the block offsets
+    and sizes, the parsed file header and the scan values. It is validated
+    by the size and modification time of the binary file.
+
+    :param filepath: Path to the binary file
+    :param save: Write the sidecar file
+    :return: The index as dict
+    """
+    stat = os.stat(os.path.normpath(filepath))
+    buf = map_file(filepath)
+    fheader = read_binary_header(buf)
+    offsets, sizes = find_data_blocks(buf, fheader["data_offset"])
+    values = scan_values(fheader["header"])
+    index = {"version": INDEX_VERSION,
+             "file_size": stat.st_size,
+             "file_mtime": stat.st_mtime_ns,
+             "offsets": offsets,
+             "sizes": sizes,
+             "numevents": len(offsets),
+             "start": fheader["start"],
+             "runtype": fheader["runtype"],
+             "header": fheader["header"],
+             "pedestal": fheader["pedestal"],
+             "noise": fheader["noise"],
+             "data_offset": fheader["data_offset"],
+             "scan_values": values}
+    if save:
+        tosave = dict(index)
+        tosave["has_scan_values"] = values is not None
+        tosave["scan_values"] = values if values is not None else np.zeros(0)
+        tmp = index_path(filepath) + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(f, **tosave)
+            os.replace(tmp, index_path(filepath))
+            LOG.info("Written block index: %s", index_path(filepath))
+        except OSError as err:
+            LOG.warning("Could not write block index for %s: %s", filepath, err)
+    return index
+
+
+def load_index(filepath):
+    """Loads the index sidecar of the binary file, without touching the
+    payload of the file.
+
+    :return: The index as dict or None if there is no valid index
+    """
+    try:
+        stat = os.stat(os.path.normpath(filepath))
+        with np.load(index_path(filepath), allow_pickle=False) as f:
+            index = {key: f[key] for key in f.files}
+    except (OSError, ValueError):
+        return None
+
+    if int(index["version"]) != INDEX_VERSION or int(index["file_size"]) != stat.st_size \
+            or int(index["file_mtime"]) != stat.st_mtime_ns:
+        LOG.info("Block index of %s is outdated", filepath)
+        return None
+
+    for key in ["version", "file_size", "file_mtime", "numevents", "start",
+                "runtype", "data_offset"]:
+        index[key] = int(index[key])
+    index["header"] = str(index["header"])
+    if not index.pop("has_scan_values"):
+        index["scan_values"] = None
+    return index
+
+
+def get_index(filepath, create=True):
+    """Returns the index of the binary file, the sidecar file is used if it is
+    valid, otherwise the file is scanned.
+
+    :param filepath: Path to the binary file
+    :param create: Write the sidecar file if there was no valid one
+    """
+    index = load_index(filepath)
+    if index is None:
+        index = build_index(filepath, save=create)
+    return index
+
+
+def read_binary_events(filepath, start=0, stop=None, index=None, out=None):
+    """Random access to the events start to stop of a binary file. Disjoint
+    ranges can be decoded independently (e.g. in different processes).
+
+    :param filepath: Path to the binary file
+    :param start: First event
+    :param stop: Last event (exclusive), None for all
+    :param index: The index of the file, see get_index. By default the index
+                  sidecar is used if present, it is not written
+    :param out: Optional dict with preallocated arrays (see decode_blocks)
+    :return: dict with signal, time, temperature and clock
+    """
+    index = index or get_index(filepath, create=False)
+    return decode_blocks(map_file(filepath), index["offsets"][start:stop], out=out)
+
+
+class _SharedArray:
+    """Exposes a shared memory block as float32 numpy array. The arrays keep
+    this object and therefore the shared memory alive, it is unmapped when
+    the last array using it is gone."""
+    def __init__(self, block, shape):
+        self.block = block
+        self.__array_interface__ = {"shape": shape,
+                                    "typestr": np.dtype(np.float32).str,
+                                    "data": (np.frombuffer(block.buf, dtype=np.uint8).ctypes.data, False),
+                                    "version": 3}
+
+
+def _decode_shared(args):
+    """Decodes the blocks at offsets into the shared memory arrays starting
+    with event first. Runs in the worker processes of decode_parallel"""
+    filepath, shared, offsets, first = args
+    blocks, out = [], {}
+    for field, (name, shape) in shared.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        out[field] = np.ndarray(shape, dtype=np.float32, buffer=block.buf)[first:first+len(offsets)]
+    decode_blocks(map_file(filepath), offsets, out=out)
+    del out
+    for block in blocks:
+        block.close()
+    return len(offsets)
+
+
+def decode_parallel(filepath, offsets, processes):
+    """Decodes the blocks at offsets with several processes. The offsets are
+    split into contiguous ranges of events, which the workers decode directly
+    into shared memory arrays, so the event order is preserved and the decoded
+    data is neither pickled nor concatenated.
+
+    :param filepath: Path to the binary file
+    :param offsets: Byte offsets of the block headers (see find_data_blocks)
+    :param processes: Number of worker processes
+    :return: dict with signal, time, temperature and clock, see decode_blocks
+    """
+    numevents = len(offsets)
+    shapes = {"signal": (numevents, 256), "temperature": (numevents,),
+              "time": (numevents,), "clock": (numevents,)}
+    blocks, shared, out = [], {}, {}
+    for field, shape in shapes.items():
+        block = shared_memory.SharedMemory(create=True, size=max(4*int(np.prod(shape)), 1))
+        blocks.append(block)
+        shared[field] = (block.name, shape)
+        out[field] = np.asarray(_SharedArray(block, shape))
+
+    try:
+        bounds = np.linspace(0, numevents, processes+1).astype(np.int64)
+        arguments = [(filepath, shared, offsets[first:last], first)
+                     for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+        with Pool(processes=processes) as pool:
+            pool.map(_decode_shared, arguments, chunksize=1)
+    finally:
+        for block in blocks:
+            block.unlink()
+    return out
+
+
+def read_binary_Alibava(filepath, use_index=True, processes=1):
+    """Reads binary alibava files and returns a dict with the same layout as
+    the hdf5 files
+
+    :param filepath: Path to the binary file
+    :param use_index: Use the index sidecar file of the binary file if present, it is
+                      not written (only the event sources with binary_index write it)
+    :param processes: Number of processes which decode the file in parallel
+    """
+    buf = map_file(filepath)
+    if use_index:
+        fheader = get_index(filepath, create=False)
+        offsets = fheader["offsets"]
+    else:
+        fheader = read_binary_header(buf)
+        offsets, _ = find_data_blocks(buf, fheader["data_offset"])
+    LOG.info("Events read: %s", len(offsets))
+
+    dic = {"header": {"noise": fheader["noise"],
+                      "pedestal": fheader["pedestal"],
+                      "Attribute:setup": None},
+           "events": {"header": fheader["header"]},
+           "scan": {"start": fheader["start"],
+                    "end": None,
+                    "value": scan_values(fheader["header"]), # Values of cal files for example. eg. 32 pulses for a charge scan steps should be here
+                    "attribute:scan_definition": None}}
+    if processes > 1 and len(offsets) >= processes:
+        dic["events"].update(decode_parallel(filepath, offsets, processes))
+    else:
+        dic["events"].update(decode_blocks(buf, offsets))
+    return dic
@@ -1,9 +1,169 @@
 """This file contains the class for the ALiBaVa calibration"""
 #pylint: disable=C0103,C0301,R0913,R0902
 import logging
+import os
 import numpy as np
 from scipy.interpolate import CubicSpline
-from .utilities import read_binary_Alibava, import_h5
+from .utilities import set_attributes
+from .event_source import open_event_source
+from .result_cache import ResultCache
+from .nb_analysis_funcs import nb_polyval_channels, nb_table_channels, good_strip_mask
+
+# The config keys the charge calibration depends on
+CALIBRATION_CACHE_KEYS = ("charge_cal_polynom", "range_ADC_fit", "calibrate_gain_to", "numChan",
+                          "ADC_table_step")
+# The config keys and cached results of the delay scan
+DELAY_CACHE_KEYS = ("calibrate_gain_to", "numChan")
+DELAY_CACHED_ATTRIBUTES = ("delay_values", "meansig_delay", "pulse_shape", "peak_delay",
+                           "channel_peak_delay")
+DELAY_POINTS_PER_STEP = 20  # Points per delay step of the interpolated pulse shapes
+# The results of the charge calibration which are cached
+CACHED_ATTRIBUTES = ("pulses", "meansig_charge", "sig_std", "offset", "mean_sig_all_ch",
+                     "mean_std_all_ch", "meancoeff", "channel_coeff", "noisy_channels",
+                     "channel_fit_rms", "channel_fit_points", "channel_fit_flags",
+                     "ADC_table", "ADC_table_step", "ADC_table_deviation")
+
+# Flags of the gain curve fit of every channel (bits of channel_fit_flags)
+FIT_NOISY = 1  # Noisy/masked channel, not fitted
+FIT_RANGE = 2  # range_ADC_fit is not inside the signals of the channel, all pulses are used
+FIT_NO_POINTS = 4  # No pulse with a small enough std, the fit failed
+FIT_NOT_FINITE = 8  # Not finite signals in the fit range, the fit failed
+FIT_FEW_POINTS = 16  # Less pulses than coefficients, the fit is underdetermined
+FIT_FAILED = FIT_NO_POINTS | FIT_NOT_FINITE
+
+
+def charge_step_signals(signals, pedestal, polarity):
+    """Mean and std of the signals of one step of the charge scan for every
+    channel. The pulses alternate in polarity from event to event and from
+    channel to channel, so the events are grouped by a reshape to
+    (events/2, 2, channels/2, 2) and all groups are reduced at once.
+
+    :param signals: The raw signals of the step: shape = (events, channels)
+    :param pedestal: The pedestal of every channel
+    :param polarity: -1: only the negative pulses (even channels of even events and odd
+                     channels of odd events), 1: only the positive pulses, 0: both
+    :return: abs mean and std of the signals of every channel: shape = (channels), (channels)
+    """
+    events, numchan = signals.shape
+    if not polarity:
+        signals = np.abs(signals - pedestal)
+        return np.mean(signals, axis=0), np.std(signals, axis=0)
+    if events % 2 or numchan % 2:
+        # The even and odd events do not fit into a reshape, reduce them one after the other
+        mean = np.stack([np.mean(signals[first::2], axis=0, dtype=np.float64) for first in (0, 1)])
+        std = np.stack([np.std(signals[first::2], axis=0, dtype=np.float64) for first in (0, 1)])
+        mean, std = mean.reshape(2, numchan//2, 2), std.reshape(2, numchan//2, 2)
+    else:
+        grouped = signals.reshape(events//2, 2, numchan//2, 2)
+        mean = np.mean(grouped, axis=0, dtype=np.float64)
+        std = np.std(grouped, axis=0, dtype=np.float64)
+    # Event parity of the wanted pulses of the even and odd channels
+    parity = [0, 1] if polarity == -1 else [1, 0]
+    return np.abs(mean[parity, :, [0, 1]].T.ravel() - pedestal), std[parity, :, [0, 1]].T.ravel()
+
+
+def _last_index(mask):
+    """Index of the last True of every row of a 2D mask"""
+    return mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+
+
+def fit_gain_curves(mean_sig, sig_std, pulses, fit_range, degree, skip=()):
+    """Fits the gain curves (pulse vs. ADC signal) of all channels at once.
+    The fit range of every channel is found with masks: from the last pulse
+    with a signal <= fit_range[0] (or the first one after it with std < 40 %
+    of the signal) to the last pulse with a signal <= fit_range[1] (exclusive).
+    All least squares fits are then solved together with the pseudo inverses
+    of the masked Vandermonde matrices, which gives the same results as
+    np.polyfit of every channel.
+
+    :param mean_sig: Mean signal per pulse: shape = (pulses, channels)
+    :param sig_std: Std of the signal per pulse: shape = (pulses, channels)
+    :param pulses: The injected charge, the signal of pulse k is fitted to pulses[k]
+    :param fit_range: [min, max] ADC range of the fit
+    :param degree: Degree of the polynomial
+    :param skip: Channels which are not fitted
+    :return: coeff: shape = (channels, degree+1), highest power first, 0 for failed fits
+             rms: RMS of the fit residuals in electrons: shape = (channels)
+             points: Number of fitted pulses: shape = (channels)
+             flags: Bits FIT_*: shape = (channels)
+    """
+    signal = np.asarray(mean_sig, dtype=np.float64).T
+    std = np.asarray(sig_std, dtype=np.float64).T
+    numchan, numpulses = signal.shape
+    index = np.arange(numpulses)
+    flags = np.zeros(numchan, dtype=np.int64)
+    flags[np.asarray(skip, dtype=np.int64)] |= FIT_NOISY
+    fitted = flags == 0
+
+    # Range of every channel: last pulse <= fit_range[0] to last pulse <= fit_range[1]
+    in_range = np.logical_and(signal[:, 0] <= fit_range[0], signal[:, -1] >= fit_range[0])
+    flags[np.logical_and(fitted, ~in_range)] |= FIT_RANGE
+    first = np.where(in_range, _last_index(signal <= fit_range[0]), 0)
+    stop = np.where(in_range, _last_index(signal <= fit_range[1]), numpulses)
+    # The first pulses can have a huge std, start at the first one with a small enough std
+    std_ok = np.logical_and(~(signal*0.4 <= std), index >= first[:, None])
+    first = np.where(std_ok.any(axis=1), np.argmax(std_ok, axis=1), numpulses)
+    flags[np.logical_and(fitted, first >= stop)] |= FIT_NO_POINTS
+
+    mask = np.logical_and(index >= first[:, None], index < stop[:, None])
+    x = np.where(mask, signal, 0.)
+    y = np.where(mask, np.asarray(pulses, dtype=np.float64)[:numpulses], 0.)
+    flags[np.logical_and(fitted, ~np.all(np.isfinite(x), axis=1))] |= FIT_NOT_FINITE
+    fitted &= (flags & FIT_FAILED) == 0
+    mask &= fitted[:, None]
+    x[~mask] = 0.
+    y[~mask] = 0.
+    points = np.sum(mask, axis=1)
+    flags[np.logical_and(fitted, points < degree+1)] |= FIT_FEW_POINTS
+
+    # Least squares with scaled columns and the rcond of np.polyfit
+    vander = np.where(mask[:, :, None], x[:, :, None]**np.arange(degree, -1, -1), 0.)
+    scale = np.sqrt(np.sum(vander**2, axis=1))
+    scale[scale == 0] = 1.
+    inverse = np.linalg.pinv(vander/scale[:, None, :],
+                             rcond=np.maximum(points, 1)*np.finfo(np.float64).eps)
+    coeff = np.einsum("cpk,ck->cp", inverse, y)/scale
+    coeff[~fitted] = 0.
+    residuals = np.einsum("ckp,cp->ck", vander, coeff) - y
+    rms = np.sqrt(np.sum(residuals**2, axis=1)/np.maximum(points, 1))
+    return coeff, rms, points, flags
+
+
+def gain_curve_tables(coeff, max_ADC, step):
+    """Tabulates the gain curves of all channels for the conversion by linear
+    interpolation. The deviation of the interpolation from a polynomial p is
+    at most step**2/8*max|p''| over the table range.
+
+    :param coeff: Polynomial coefficients of every channel, highest power first: shape = (channels, degree+1)
+    :param max_ADC: The tables cover 0 to at least max_ADC
+    :param step: Step of the tables in ADC
+    :return: table: values at 0, step, 2*step, ...: shape = (channels, entries)
+             deviation: maximum deviation of the interpolation in electrons: shape = (channels)
+    """
+    x = np.arange(int(np.ceil(max_ADC/step)) + 2)*step
+    table = np.zeros((len(coeff), len(x)))
+    for column in np.asarray(coeff, dtype=np.float64).T:
+        table = table*x + column[:, None]
+    # The second derivative of the polynomials on the table points
+    degree = coeff.shape[1] - 1
+    second = np.zeros_like(table)
+    for power, column in zip(range(degree, 1, -1), np.asarray(coeff, dtype=np.float64).T):
+        second = second*x + power*(power-1)*column[:, None]
+    return table, step**2/8*np.max(np.abs(second), axis=1)
+
+
+def pulse_shape_peaks(delays, signals):
+    """Delays of the maxima of pulse shapes, interpolated with cubic splines
+    with DELAY_POINTS_PER_STEP points per delay step
+
+    :param delays: The increasing delays of the scan steps
+    :param signals: The mean signal of every step: shape = (steps, channels)
+    :return: Delay of the maximum of every channel: shape = (channels)
+    """
+    grid = np.linspace(delays[0], delays[-1], (len(delays)-1)*DELAY_POINTS_PER_STEP + 1)
+    return grid[np.argmax(CubicSpline(delays, signals, axis=0)(grid), axis=0)]
+
+
 
 class Calibration:
     """This class handles everything concerning the calibration.
@@ -23,6 +183,26 @@ class Calibration:
         - The gain is the conversion factor between ADCs and electrons. It is
           defined as the gradient of the signal in ADCs vs. pulse height
           characteristic for each channel.
+
+    If ADC_table_step of the configs is set (default 0, disabled), the gain
+    curves of all channels are tabulated from 0 ADC to the highest signal of
+    the charge scan with this step and convert_ADC_to_e looks the signals up
+    with linear interpolation. The maximum deviation from the gain curve of
+    every channel is ADC_table_deviation, channels which deviate more than
+    ADC_table_tolerance electrons (default 1) are still converted with their
+    polynomial. The tables are cached with the calibration.
+
+    Delay Scan:
+        - The test pulses are sampled with different delays, the mean signal
+          of the pulses of every step is the pulse shape of the channel.
+        - The peak of the pulse shape of every channel (channel_peak_delay)
+          and of the mean over all good channels (peak_delay) are found from
+          the cubic spline interpolation. timing_window gives the delays
+          around the peak where the pulse shape is above a fraction of its
+          maximum, MainAnalysis uses it as timingWindow if auto_timing_window
+          is set in the configs.
+        - The delay scan is Delay_scan of the configs, or the passed file if
+          use_charge_cal is False. Its results are cached like the charge scan.
     """
     def __init__(self, file_path="", Noise_calc=None,
                  configs=None, logger=None):
@@ -47,14 +227,21 @@ class Calibration:
         self.meansig_charge = []  # mean signal per channel per pulse
         self.sig_std = []  # std signal per channel per pulse
         self.charge_sig = None  # Standard deviation of all charge calibartions
-        self.delay_cal = []
+        self.delay_cal = None  # Cubic spline of the pulse shape over all good channels
+        self.delay_values = []  # The delays of the delay scan steps in ns
         self.meansig_delay = []  # mean per pulse per channel
+        self.pulse_shape = None  # mean signal of all good channels per delay
+        self.peak_delay = None  # delay of the maximum of the pulse shape
+        self.channel_peak_delay = None  # delay of the maximum of every channel, nan for noisy channels
         self.isBinary = configs.get("isBinary", "False")
         self.use_gain_per_channel = configs.get("use_gain_per_channel", True)
         self.numChan = configs.get("numChan", 256)
         self.degpoly = configs.get("charge_cal_polynom", 5)
         self.range = configs.get("range_ADC_fit", [])
         self.offset = 0 # offset of adc to e conversion
+        self.ADC_table = None  # gain curve of every channel at 0, step, 2*step, ... ADC
+        self.ADC_table_step = 0.
+        self.ADC_table_deviation = None  # maximum deviation of the tables in electrons
         self.ADC_sig = None
         self.configs = configs
         self.mean_sig_all_ch = []
@@ -68,13 +255,19 @@ class Calibration:
                           "Warning: This can cause serious miscalculations when converting ADC to electrons!")
             self.polarity = 0
 
+        # A list of delay scans (one per run) is only used as the passed file
+        delay_path = self.configs.get("Delay_scan", "")
+        delay_path = delay_path if isinstance(delay_path, str) else ""
         if not self.configs["use_charge_cal"]:
             self.use_predefined_cal_params()
-            #self.delay_calibration_calc(file_path)
+            # The passed file is the delay scan in this case
+            delay_path = file_path
         elif file_path == "":
             self.use_predefined_cal_params()
         else:
             self.charge_calibration_calc(file_path)
+        if delay_path:
+            self.delay_calibration_calc(delay_path)
 
     def use_predefined_cal_params(self):
         """Uses the predefined calibration parameters from the calibration file"""
@@ -83,39 +276,81 @@ class Calibration:
         self.ADC_sig = 1.
         self.charge_sig = 1.
         self.chargecoeff = [np.array(self.configs["Gain_params"]) for i in range(256)]
+        self.channel_coeff = np.tile(np.array(self.configs["Gain_params"], dtype=np.float64),
+                                     (self.numChan, 1))
         #self.gain_calc()
         # So every strip has the same gain
 
 
     def delay_calibration_calc(self, delay_path):
-        """Analyzes delay scan"""
+        """Analyzes the delay scan: the pulse shape of every channel and the
+        delays of their maxima"""
         self.log.info("Loading delay file: %s", delay_path)
-        if not self.isBinary:
-            self.delay_data = import_h5(delay_path)
+        # The delay scan is optional, the analysis goes on without it
+        if not os.path.isfile(delay_path):
+            self.log.error("The delay scan file %s does not exist, the pulse shape is not "
+                           "available", delay_path)
+            return
+        cache = ResultCache.from_configs(self.configs)
+        cache_key = cache.key("DelayScan", delay_path, self.configs, DELAY_CACHE_KEYS,
+                              self.pedestal, self.noisy_channels)
+        state = cache.get(cache_key)
+        if state is not None:
+            self.log.info("Using the cached delay scan of %s", delay_path)
+            set_attributes(self, state)
         else:
-            self.delay_data = read_binary_Alibava(delay_path)
-
-        pulses = np.array(self.delay_data["scan"]["value"][:])  # aka xdata
-
-        # Sometime it happens, that h5py does not read correctly
-        # TODO: write a more pythonic and pretty version of this
-        if not len(pulses):
-            self.log.error("A HDF5 read error! Loaded empty array. Restart python")
-
-        signals = np.array(
-            self.delay_data["events"]["signal"][:]) - self.pedestal  # signals per pulse, CMN is a single value
-        signals = np.delete(signals, self.noisy_channels, axis=1)
-        sigppulse = int(len(signals) / len(pulses))  # How many signals per pulses
-
-        start = 0
-        for i in range(sigppulse, len(signals) + sigppulse, sigppulse):
-            self.meansig_delay.append(np.mean(signals[start:i], axis=1))
-            start = i
-
-        # Interpolate and get some extrapolation data from polynomial fit (from alibava)
-        self.meansig_delay = np.mean(self.meansig_delay, axis=1)
-        self.delay_cal = CubicSpline(pulses, self.meansig_delay)
-        # print("Coefficients of charge fit: {!s}".format(self.chargecoeff))
+            self.delay_data = open_event_source(delay_path, self.configs)
+            if not self.delay_data:
+                self.log.error("Unable to read the delay scan file %s, the pulse shape is not "
+                               "available", delay_path)
+                return
+            delays = np.array(self.delay_data.scan_values, dtype=np.float64)  # aka xdata
+            if len(delays) < 2:
+                self.log.error("The delay scan %s has less than two delay steps, the pulse shape "
+                               "is not available", delay_path)
+                return
+
+            # The mean signal of the correct polarity of every step, one step is read at once
+            sigppulse = int(self.delay_data.numevents / len(delays))
+            meansig = [charge_step_signals(chunk.signal, self.pedestal, self.polarity)[0]
+                       for chunk in self.delay_data.chunks(chunk_size=sigppulse)]
+            order = np.argsort(delays, kind="stable")
+            self.delay_values = delays[order]
+            self.meansig_delay = np.array(meansig[:len(delays)])[order]
+
+            # The pulse shape of the good channels and the delays of the maxima
+            good = good_strip_mask(self.meansig_delay.shape[1], self.noisy_channels)
+            self.pulse_shape = np.mean(self.meansig_delay[:, good], axis=1)
+            self.peak_delay = pulse_shape_peaks(self.delay_values, self.pulse_shape)
+            self.channel_peak_delay = np.full(len(good), np.nan)
+            self.channel_peak_delay[good] = pulse_shape_peaks(self.delay_values,
+                                                              self.meansig_delay[:, good])
+            cache.put(cache_key, {name: getattr(self, name) for name in DELAY_CACHED_ATTRIBUTES})
+
+        self.delay_cal = CubicSpline(self.delay_values, self.pulse_shape)
+        self.log.info("Maximum of the pulse shape at %.1f ns, the channels peak between "
+                      "%.1f ns and %.1f ns", self.peak_delay, np.nanmin(self.channel_peak_delay),
+                      np.nanmax(self.channel_peak_delay))
+
+    def timing_window(self, fraction=0.9):
+        """The delays around the peak of the pulse shape of the delay scan where
+        it is above a fraction of its maximum
+
+        :param fraction: Fraction of the maximum of the pulse shape
+        :return: [min, max] in ns or None without delay scan
+        """
+        if self.delay_cal is None:
+            return None
+        delays = self.delay_values
+        grid = np.linspace(delays[0], delays[-1], (len(delays)-1)*DELAY_POINTS_PER_STEP + 1)
+        shape = self.delay_cal(grid)
+        peak = int(np.argmax(shape))
+        below = shape < fraction*shape[peak]
+        before = np.nonzero(below[:peak])[0]
+        after = np.nonzero(below[peak:])[0]
+        first = before[-1] + 1 if len(before) else 0
+        last = peak + after[0] - 1 if len(after) else len(grid) - 1
+        return [float(grid[first]), float(grid[last])]
 
     def charge_calibration_calc(self, charge_path):
         """Analyze the calibration scan and calculate conversion parameters
@@ -124,10 +359,16 @@ class Calibration:
         # Loading the file------------------------------------------------------
         # Charge scan
         self.log.info("Loading charge calibration file: %s", charge_path)
-        if not self.isBinary:
-            self.charge_data = import_h5(charge_path)
-        else:
-            self.charge_data = read_binary_Alibava(charge_path)
+        # The results depend on the pedestal and noisy strips of the pedestal run as well
+        cache = ResultCache.from_configs(self.configs)
+        cache_key = cache.key(__class__.__name__, charge_path, self.configs, CALIBRATION_CACHE_KEYS,
+                              self.pedestal, self.noisy_channels)
+        state = cache.get(cache_key)
+        if state is not None:
+            self.log.info("Using the cached charge calibration of %s", charge_path)
+            set_attributes(self, state)
+            return
+        self.charge_data = open_event_source(charge_path, self.configs)
 
         # Look if data is valid------------------------------------------------------
         if not self.charge_data:
@@ -135,44 +376,22 @@ class Calibration:
         else:
             # Process data ----------------------------------------------------------
             # list of injected test pulse values aka x-data
-            self.pulses = np.array(self.charge_data["scan"]["value"][:])
+            self.pulses = np.array(self.charge_data.scan_values)
 
             # Sometime it happens, that h5py does not read correctly
             if not len(self.pulses):
                 self.log.error("A HDF5 read error! Loaded empty array. "
                                "Restart python")
 
-            # signals per pulse subtracted by pedestals and excluding noisy channels
-            signals = np.array(self.charge_data["events"]["signal"][:]) - self.pedestal
-            # signals = np.delete(signals, self.noisy_channels, axis=1)
             # Calculate size of pulse group to obtain number of injected signals per pulse step
-            sigppulse = int(len(signals) / len(self.pulses))
-
-            start = 0
+            sigppulse = int(self.charge_data.numevents / len(self.pulses))
 
             # summarize signals of each pulse group by calculating the mean
-            # signals of each pulse group per channel
-            for i in range(sigppulse, len(signals) + sigppulse, sigppulse):
-                raw_half = np.mean(signals[start:i][0::2], axis=0)
-                raw_half_std = np.std(signals[start:i][0::2], axis=0)
-                raw_half2 = np.mean(signals[start:i][1::2], axis=0)
-                raw_half2_std = np.std(signals[start:i][1::2], axis=0)
-
-                # Take only the correct polarity of pulses
-                if self.polarity == -1:
-                    meansig_neg_pulses = np.hstack(list(zip(raw_half[0::2], raw_half2[1::2])))
-                    std_neg_pulses = np.hstack(list(zip(raw_half_std[0::2], raw_half2_std[1::2])))
-                    self.meansig_charge.append(np.abs(meansig_neg_pulses))
-                    self.sig_std.append(std_neg_pulses)
-                elif self.polarity == 1:
-                    meansig_pos_pulses = np.hstack(list(zip(raw_half[1::2], raw_half2[0::2])))
-                    std_pos_pulses = np.hstack(list(zip(raw_half_std[1::2], raw_half2_std[0::2])))
-                    self.meansig_charge.append(np.abs(meansig_pos_pulses))
-                    self.sig_std.append(std_pos_pulses)
-                else:
-                    self.meansig_charge.append(np.mean(np.abs(signals[start:i]), axis=0))
-                    self.sig_std.append(np.std(np.abs(signals[start:i]), axis=0))
-                start = i
+            # signals of each pulse group per channel, only one pulse group is read at once
+            for chunk in self.charge_data.chunks(chunk_size=sigppulse):
+                mean, std = charge_step_signals(chunk.signal, self.pedestal, self.polarity)
+                self.meansig_charge.append(mean)
+                self.sig_std.append(std)
             self.meansig_charge = np.array(self.meansig_charge)
             self.sig_std = np.array(self.sig_std)
 
@@ -214,96 +433,113 @@ class Calibration:
             self.log.info("Mean fit coefficients over all channels are: %s", self.meancoeff)
 
             # Calculate the gain curve for EVERY channel-------------------------------------------
-            self.channel_coeff = np.zeros([self.numChan, self.degpoly+1])
-            for i in range(self.numChan):
-                if i not in self.noisy_channels:
-                    #self.log.debug("Fitting channel: {}".format(i))
-                    try:
-                        # Taking the correct channel from the means, this has the length of pulses, and the correct
-                        # polarity is already accored to. Warning first value will always be cutted away,
-                        # to ensure better convergence while fitting!!!
-                        mean_sig = self.meansig_charge[1:,i]
-                        sig_std = self.sig_std[1:, i]
-                        # Find the range for the fit
-                        if mean_sig[0] <= self.range[0] and mean_sig[-1] >= self.range[0]:
-                            xminarg = np.argwhere(mean_sig <= self.range[0])[-1][0]
-                            xmaxarg = np.argwhere(mean_sig <= self.range[1])[-1][0]
-                        else:
-                            self.log.error("Range for charge cal for channel {} may be poorly conditioned!!!".format(i))
-                            xminarg = 0
-                            xmaxarg = len(mean_sig)
-
-                        # In the beginning of the pulses the error can be huge. Therefore, check if std is small enough
-                        # Otherwise search for point, which has a low enough std
-                        std_ok = False
-                        while not std_ok:
-                            if xminarg == xmaxarg:
-                                # Todo: make it possible to run nontheless
-                                self.log.error("Could not find satisfying std value for charge cal in channel {}. This may happen"
-                                               " with bad calibration. Further calculations may fail! This channel"
-                                               " will be added to noisy channels!".format(i))
-                                self.noisy_channels = np.append(self.noisy_channels, [i])
-                            if mean_sig[xminarg]*0.4 <= sig_std[xminarg]:
-                                xminarg += 1
-                            else:
-                                std_ok = True
-                                break
-
-                        self.channel_coeff[i] = np.polyfit(mean_sig[xminarg:xmaxarg],
-                                                            self.pulses[xminarg:xmaxarg],
-                                                            deg=self.degpoly, full=False)
-                    except Exception as err:
-                        if "SVD did not converge" in str(err):
-                            self.log.error("SVD did not converge in Linear Least Squares for channel {}"
-                                           " this channel will be added to noisy channels!".format(i))
-                            self.noisy_channels = np.append(self.noisy_channels, i)
-
-    def convert_ADC_to_e(self, signals_adc, channels=(), use_mean=False, sub_offset=True):
+            # Warning first pulse will always be cutted away, to ensure better convergence while fitting!!!
+            self.channel_coeff, self.channel_fit_rms, self.channel_fit_points, \
+                self.channel_fit_flags = fit_gain_curves(self.meansig_charge[1:], self.sig_std[1:],
+                                                         self.pulses, self.range, self.degpoly,
+                                                         skip=self.noisy_channels)
+            flags = self.channel_fit_flags
+            if np.any(flags & FIT_RANGE):
+                self.log.error("Range for charge cal may be poorly conditioned for the channels: %s",
+                               np.nonzero(flags & FIT_RANGE)[0])
+            failed = np.nonzero(flags & FIT_FAILED)[0]
+            if len(failed):
+                self.log.error("Could not fit the charge cal for the channels %s (no pulses with a "
+                               "satisfying std or not finite signals). This may happen with bad "
+                               "calibration. These channels will be added to noisy channels!", failed)
+                self.noisy_channels = np.append(self.noisy_channels, failed)
+            if np.any(flags & FIT_FEW_POINTS):
+                self.log.warning("The charge cal fit is underdetermined for the channels: %s",
+                                 np.nonzero(flags & FIT_FEW_POINTS)[0])
+            self.build_ADC_tables()
+            cache.put(cache_key, {name: getattr(self, name) for name in CACHED_ATTRIBUTES})
+
+    def _conversion_coeff(self):
+        """The gain curve coefficients of every channel for the conversion, the
+        noisy/masked channels get the mean gain curve
+
+        :return: coeff: shape = (channels, degree+1), masked: bool: shape = (channels)
+        """
+        masked = np.zeros(len(self.channel_coeff), dtype=np.bool_)
+        masked[np.asarray(self.noisy_channels, dtype=np.int64)] = True
+        coeff = np.array(self.channel_coeff, dtype=np.float64)
+        coeff[masked] = self.meancoeff
+        return coeff, masked
+
+    def build_ADC_tables(self, max_ADC=None):
+        """Tabulates the gain curves of all channels for convert_ADC_to_e with
+        the step ADC_table_step of the configs, 0 removes the tables
+
+        :param max_ADC: Range of the tables, default is the highest signal of the charge scan
+        """
+        self.ADC_table_step = self.configs.get("ADC_table_step", 0)
+        if max_ADC is None and len(self.meansig_charge):
+            max_ADC = np.nanmax(np.abs(self.meansig_charge))
+        if not self.ADC_table_step or not max_ADC or not np.isfinite(max_ADC):
+            # Empty tables instead of None, they are cached with the calibration
+            self.ADC_table, self.ADC_table_deviation = np.zeros((0, 0)), np.zeros(0)
+            return
+        self.ADC_table, self.ADC_table_deviation = gain_curve_tables(self._conversion_coeff()[0],
+                                                                     max_ADC, self.ADC_table_step)
+        self.log.info("Tabulated the gain curves up to %.0f ADC in steps of %s ADC, maximum "
+                      "deviation %.3g electrons", max_ADC, self.ADC_table_step,
+                      np.max(self.ADC_table_deviation))
+        tolerance = self.configs.get("ADC_table_tolerance", 1.)
+        exact = np.count_nonzero(self.ADC_table_deviation > tolerance)
+        if exact:
+            self.log.info("The tables of %s channels deviate more than ADC_table_tolerance (%s "
+                          "electrons), their polynomials are used", exact, tolerance)
+
+    def convert_ADC_to_e(self, signals_adc, channels=(), use_mean=False, sub_offset=True,
+                         masked_value=None):
         """
         Convert an array of ADC signals to electron signal
         If the parameter, use_gain_per_channel is True in the configs then channels has to be set!!!
         In this case the gain will be calculated for each channel indipendently. Otherwise the mean
-        gain will be used.
+        gain will be used. The results are in the order of the passed signals.
 
         :param signals_adc: The ADC signal which should be converted to electrons
         :param channels:  Optional parameter, it defines on which channel the corresponding ADC was aquired
         :param use_mean: Use the mean value instead
         :param sub_offset: Subtract the offset or not (I recommend to use the offset)
-        :return:
+        :param masked_value: Result for signals of noisy/masked channels, which have no gain
+                             curve of their own. None converts them with the mean gain curve
+        :return: The signals in electrons: shape = (signals)
         """
 
         # Ensure that all signals are positive, since the cal is done with positive or flipped negative signals
-        signals_adc = np.abs(signals_adc)
+        signals_adc = np.abs(np.asarray(signals_adc, dtype=np.float64))
 
         # use the mean coeff out of all channels -> Fast but can lead to errors if the calibration is not good
         if not self.use_gain_per_channel or use_mean:
             return np.absolute(np.polyval(self.meancoeff, signals_adc))
 
-        # Use gain per channel for calculations. Warning: order of results list is ordered per channel!!!
+        # Use gain per channel for calculations, every signal with the polynomial of its channel
+        channels = np.asarray(channels, dtype=np.int64)
+        if signals_adc.shape != channels.shape:
+            self.log.error("If you want to use gain_per_channel calculations please pass " \
+                                                 "lists of same size. Passed lists did not have same length.")
+            return np.array([])
+        if len(channels) and (channels.min() < 0 or channels.max() >= len(self.channel_coeff)):
+            raise ValueError("Channels out of range of the {} calibrated channels"
+                             .format(len(self.channel_coeff)))
+
+        coeff, masked = self._conversion_coeff()
+        if self.ADC_table is not None and self.ADC_table.size:
+            tabulated = self.ADC_table_deviation <= self.configs.get("ADC_table_tolerance", 1.)
+            result = nb_table_channels(signals_adc.ravel(), channels.ravel(), self.ADC_table,
+                                       self.ADC_table_step, coeff, tabulated)
         else:
-            if len(signals_adc) != len(channels):
-                self.log.error("If you want to use gain_per_channel calculations please pass " \
-                                                     "lists of same size. Passed lists did not have same length.")
-                return np.array([])
-
-            result = np.array([])
-            unique_ch = np.unique(channels).astype(np.int)
-            signals_per_channel = []
-            # Order the signals per channel so calculations can be speed up
-            for ch in unique_ch:
-                signals_per_channel.append(np.take(signals_adc, np.nonzero(channels==ch)))
-
-            for sig, ch in zip(signals_per_channel, unique_ch):
-                result = np.append(result, np.polyval(self.channel_coeff[ch], sig))
-
-            # Subtract the mean Offset to all calculated values if necessary
-            #if sub_offset:
-            #    offset = np.absolute(np.polyval(self.meancoeff, np.mean(self.offset)))
-            #    result = result-offset
-
+            result = nb_polyval_channels(signals_adc.ravel(), channels.ravel(), coeff)
+        if masked_value is not None:
+            result[masked[channels.ravel()]] = masked_value
 
-            return np.absolute(result)
+        # Subtract the mean Offset to all calculated values if necessary
+        #if sub_offset:
+        #    offset = np.absolute(np.polyval(self.meancoeff, np.mean(self.offset)))
+        #    result = result-offset
 
+        return result.reshape(signals_adc.shape)
 
     def gain_calc(self, cut=1.5):
         """Calculates the gain per channel per pulse. Ignores values for
@@ -0,0 +1,124 @@
+"""This file contains the conversion of ALiBaVa binary files to hdf5 files.
+The converted files have the same layout as the hdf5 files written by
+ALiBaVa itself, so they can be analysed with isBinary: False and do not have
+to be decoded again for every analysis."""
+# pylint: disable=C0103,R0913,R0914
+import logging
+import os
+from multiprocessing import Pool
+from time import time
+import numpy as np
+import h5py
+from analysis_classes.binary_reader import map_file, get_index, decode_blocks
+
+LOG = logging.getLogger("converter")
+
+COMPRESSIONS = {"lzf": ("lzf", None), "gzip": ("gzip", 1), "none": (None, None)}
+
+
+def convert_to_hdf5(binary_path, h5_path=None, compression="lzf",
+                    chunk_events=1024, chunk_size=10000):
+    """Converts a ALiBaVa binary file to a hdf5 file with the datasets
+    events/signal, events/time, events/temperature, events/clock and scan/value.
+    The datasets are chunked along the events and compressed with a fast filter.
+
+    :param binary_path: Path to the binary file
+    :param h5_path: Path of the hdf5 file, default is the binary path with .hdf5 extension
+    :param compression: lzf, gzip (level 1) or none
+    :param chunk_events: Number of events per hdf5 chunk
+    :param chunk_size: Number of events decoded and written at once
+    :return: dict with the conversion statistics
+    """
+    if h5_path is None:
+        h5_path = os.path.splitext(os.path.normpath(binary_path))[0] + ".hdf5"
+    filter_name, filter_opts = COMPRESSIONS[compression]
+
+    start = time()
+    buf = map_file(binary_path)
+    index = get_index(binary_path, create=False)  # Only the event sources write the index
+    offsets = index["offsets"]
+    numevents = len(offsets)
+    chunk_events = max(1, min(chunk_events, numevents))
+    decode_time = time() - start
+    write_time = 0.
+
+    # Decode with the raw data types, so that the conversion is lossless
+    buffers = {"signal": np.zeros((min(chunk_size, numevents), 256), dtype=np.int16),
+               "time": np.zeros(min(chunk_size, numevents), dtype=np.float32),
+               "temperature": np.zeros(min(chunk_size, numevents), dtype=np.float32),
+               "clock": np.zeros(min(chunk_size, numevents), dtype=np.uint32)}
+
+    with h5py.File(h5_path, "w") as f:
+        f.attrs["source"] = os.path.basename(binary_path)
+        f.attrs["run_header"] = index["header"]
+        f.attrs["run_type"] = index["runtype"]
+        header = f.create_group("header")
+        header.create_dataset("pedestal", data=index["pedestal"][None, :])
+        header.create_dataset("noise", data=index["noise"][None, :])
+        scan = f.create_group("scan")
+        scan_values = index["scan_values"] if index["scan_values"] is not None else []
+        scan.create_dataset("value", data=np.array(scan_values, dtype=np.float32))
+        scan.attrs["start"] = index["start"]
+
+        events = f.create_group("events")
+        datasets = {}
+        for name, data in buffers.items():
+            datasets[name] = events.create_dataset(name, shape=(numevents,) + data.shape[1:],
+                                                   dtype=data.dtype,
+                                                   chunks=(chunk_events,) + data.shape[1:],
+                                                   compression=filter_name,
+                                                   compression_opts=filter_opts)
+
+        for first in range(0, numevents, chunk_size):
+            last = min(first + chunk_size, numevents)
+            out = {name: data[:last-first] for name, data in buffers.items()}
+            decode_start = time()
+            decode_blocks(buf, offsets[first:last], out=out)
+            write_start = time()
+            for name, data in out.items():
+                datasets[name].write_direct(data, dest_sel=np.s_[first:last])
+            decode_time += write_start - decode_start
+            write_time += time() - write_start
+
+    stats = {"file": binary_path,
+             "output": h5_path,
+             "events": numevents,
+             "input_MB": os.path.getsize(os.path.normpath(binary_path))/1e6,
+             "output_MB": os.path.getsize(h5_path)/1e6,
+             "decode_s": decode_time,
+             "write_s": write_time}
+    stats["decode_MBps"] = stats["input_MB"]/max(decode_time, 1e-9)
+    stats["write_MBps"] = stats["input_MB"]/max(write_time, 1e-9)
+    LOG.info("Converted %s (%s events): decode %.1f MB/s, write %.1f MB/s, %.1f MB -> %.1f MB",
+             binary_path, numevents, stats["decode_MBps"], stats["write_MBps"],
+             stats["input_MB"], stats["output_MB"])
+    return stats
+
+
+def _convert_star(args):
+    """Just a small wrapper for the multiprocessing pool"""
+    binary_path, kwargs = args
+    return convert_to_hdf5(binary_path, **kwargs)
+
+
+def convert_files(binary_paths, output_folder=None, processes=1, **kwargs):
+    """Converts several binary files in parallel
+
+    :param binary_paths: list of paths to the binary files
+    :param output_folder: Folder for the hdf5 files, default is next to the binary files
+    :param processes: Number of files converted in parallel
+    :param kwargs: Passed to convert_to_hdf5
+    :return: list with the statistics of every file
+    """
+    arguments = []
+    for path in binary_paths:
+        options = dict(kwargs)
+        if output_folder:
+            name = os.path.splitext(os.path.basename(path))[0] + ".hdf5"
+            options["h5_path"] = os.path.join(os.path.normpath(output_folder), name)
+        arguments.append((path, options))
+
+    if processes > 1 and len(arguments) > 1:
+        with Pool(processes=min(processes, len(arguments))) as pool:
+            return pool.map(_convert_star, arguments, chunksize=1)
+    return [_convert_star(args) for args in arguments]
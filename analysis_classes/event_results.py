@@ -0,0 +1,279 @@
+"""This file contains the columnar container of the clustering results. The
+per event values are contiguous arrays and the hits and clusters of all
+events are stored flat with offsets (CSR), so analyses can work vectorized
+on all events at once. For the existing plugins and plots the container can
+be used like the Bdata of the BaseAnalysis results."""
+# pylint: disable=C0103,R0902
+import numpy as np
+from analysis_classes.nb_analysis_funcs import CLUSTER_DTYPE
+
+# The labels of the Bdata view, in the order of the old result rows
+LABELS = ["Signal", "SN", "CMN", "CMsig", "Hitmap", "Channel_hit",
+          "Clusters", "Numclus", "Clustersize", "Timing"]
+# The labels of the signals of the whole events, only available if they are stored
+SIGNAL_LABELS = ("Signal", "SN")
+# The CSR offsets and the arrays of the events, hits, clusters and cluster channels,
+# which are appended by EventResults.extend
+INDPTRS = ("hit_indptr", "cluster_indptr", "channel_indptr")
+ENTRIES = ("CMN", "CMsig", "numclus", "automasked", "timing", "hit_channels", "hit_signal",
+           "cluster_channels", "channel_signal", "cluster_table")
+
+
+def _offset_concatenate(indptrs, offsets):
+    """Concatenates CSR offset arrays, the offsets of every part are shifted
+    by the number of entries of the parts before"""
+    parts = [np.zeros(1, dtype=np.int64)]
+    for indptr, offset in zip(indptrs, offsets):
+        parts.append(indptr[1:] + offset)
+    return np.concatenate(parts)
+
+
+def _split(values, indptr):
+    """Splits values (array or list) into the parts given by the CSR offsets"""
+    return [values[first:last] for first, last in zip(indptr[:-1], indptr[1:])]
+
+
+class EventResults:
+    """The clustering results of a run.
+
+    Per event (shape = (events)):
+        CMN, CMsig, numclus, timing, automasked
+        signal, SN: shape = (events, channels), None if the signals of the whole
+            events are not stored (store_signals of the configs)
+    Hits: the channels above SN_cut of event i are
+        hit_channels[hit_indptr[i]:hit_indptr[i+1]], their signals are the same
+        entries of hit_signal
+    Clusters: the clusters of event i are cluster_indptr[i] to cluster_indptr[i+1],
+        the channels of cluster c are cluster_channels[channel_indptr[c]:channel_indptr[c+1]]
+        with the seed channel first, their signals are the same entries of channel_signal
+    hitmap: number of hits of every channel: shape = (channels)
+    cluster_table: one record per cluster (event, seed, seed_SN, first, last,
+        size, signal, noise, SN, position, eta, timing), see CLUSTER_DTYPE
+
+    The Bdata view gives the old object columns:
+        results["Numclus"], results.get("Clusters"), results.keys()
+    Signal and SN are only part of it if the signals of the whole events are stored.
+    """
+    def __init__(self, signal, SN, CMN, CMsig, hitmap, hit_indptr, hit_channels, numclus,
+                 cluster_indptr, channel_indptr, cluster_channels, automasked, timing,
+                 cluster_table=None, hit_signal=None, channel_signal=None):
+        self.signal = signal
+        self.SN = SN
+        self.CMN = np.asarray(CMN, dtype=np.float64)
+        self.CMsig = np.asarray(CMsig, dtype=np.float64)
+        self.hitmap = np.asarray(hitmap, dtype=np.float64)
+        self.hit_indptr = hit_indptr
+        self.hit_channels = hit_channels
+        self.numclus = numclus
+        self.cluster_indptr = cluster_indptr
+        self.channel_indptr = channel_indptr
+        self.cluster_channels = cluster_channels
+        self.automasked = automasked
+        self.timing = np.asarray(timing, dtype=np.float64)
+        self.cluster_table = np.zeros(0, dtype=CLUSTER_DTYPE) if cluster_table is None \
+            else cluster_table
+        self.hit_signal = np.zeros(len(hit_channels)) if hit_signal is None else hit_signal
+        self.channel_signal = np.zeros(len(cluster_channels)) if channel_signal is None \
+            else channel_signal
+        self.labels = LABELS if signal is not None else \
+            [label for label in LABELS if label not in SIGNAL_LABELS]
+        self._columns = {}  # Cache of the Bdata columns
+        self._storage = {}  # The arrays with spare capacity behind the appended arrays
+
+    @classmethod
+    def from_chunks(cls, chunks, numchan=256):
+        """Combines the ProcessedChunk of every chunk of a run. The signal and SN
+        of the whole events are only combined if every chunk contains them.
+
+        :param chunks: List of ProcessedChunk
+        :param numchan: Number of channels, only needed if there are no chunks
+        """
+        if not chunks:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(np.zeros((0, numchan)), np.zeros((0, numchan)), empty, empty,
+                       np.zeros(numchan), np.zeros(1, dtype=np.int64), empty, empty,
+                       np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64), empty,
+                       empty, empty)
+        hit_offsets = np.cumsum([0] + [len(chunk.hit_channels) for chunk in chunks[:-1]])
+        event_offsets = np.cumsum([0] + [len(chunk.numclus) for chunk in chunks[:-1]])
+        cluster_offsets = np.cumsum([0] + [chunk.cluster_indptr[-1] for chunk in chunks[:-1]])
+        channel_offsets = np.cumsum([0] + [len(chunk.cluster_channels) for chunk in chunks[:-1]])
+        table = np.concatenate([chunk.cluster_table for chunk in chunks])
+        table["event"] += np.repeat(event_offsets, [len(chunk.cluster_table) for chunk in chunks])
+        stored = all(chunk.signal is not None for chunk in chunks)
+        preprocessed = [np.concatenate([getattr(chunk, name) for chunk in chunks])
+                        if stored or name in ("CMN", "CMsig") else None
+                        for name in ("signal", "SN", "CMN", "CMsig")]
+        return cls(*preprocessed,
+                   np.sum([chunk.hitmap for chunk in chunks], axis=0),
+                   _offset_concatenate([chunk.hit_indptr for chunk in chunks], hit_offsets),
+                   np.concatenate([chunk.hit_channels for chunk in chunks]),
+                   np.concatenate([chunk.numclus for chunk in chunks]),
+                   _offset_concatenate([chunk.cluster_indptr for chunk in chunks], cluster_offsets),
+                   _offset_concatenate([chunk.channel_indptr for chunk in chunks], channel_offsets),
+                   np.concatenate([chunk.cluster_channels for chunk in chunks]),
+                   np.concatenate([chunk.automasked for chunk in chunks]),
+                   np.concatenate([chunk.timing for chunk in chunks]),
+                   table,
+                   np.concatenate([chunk.hit_signal for chunk in chunks]),
+                   np.concatenate([chunk.channel_signal for chunk in chunks]))
+
+    def extend(self, chunks):
+        """Appends the ProcessedChunk of further chunks of the run, e.g. of a run
+        which is still written. The arrays keep spare capacity, so appending
+        only costs the size of the new chunks and not of all events so far.
+        The signal and SN are dropped if the new chunks do not contain them.
+
+        :param chunks: List of ProcessedChunk
+        """
+        for chunk in chunks:
+            events = len(self)
+            for name in INDPTRS:
+                self._append(name, getattr(chunk, name)[1:] + getattr(self, name)[-1])
+            for name in ENTRIES:
+                self._append(name, getattr(chunk, name))
+            self.cluster_table["event"][len(self.cluster_table) - len(chunk.cluster_table):] += events
+            if self.signal is not None and chunk.signal is not None:
+                self._append("signal", chunk.signal)
+                self._append("SN", chunk.SN)
+            else:
+                self.signal, self.SN = None, None
+                self.labels = [label for label in LABELS if label not in SIGNAL_LABELS]
+            self.hitmap += chunk.hitmap
+        self._columns = {}
+        return self
+
+    def _append(self, name, values):
+        """Appends values to the array name, its storage at least doubles if it is full"""
+        current = getattr(self, name)
+        size = len(current)
+        storage = self._storage.get(name)
+        if storage is None or len(storage) < size + len(values):
+            # Empty arrays take the layout of the first values (e.g. float32 or the cluster table)
+            layout = values if size == 0 else current
+            storage = np.empty((max(size + len(values), 2*size),) + layout.shape[1:],
+                               dtype=layout.dtype)
+            storage[:size] = current
+            self._storage[name] = storage
+        storage[size:size+len(values)] = values
+        setattr(self, name, storage[:size+len(values)])
+
+    def __len__(self):
+        return len(self.numclus)
+
+    @property
+    def numchan(self):
+        """Number of channels"""
+        return len(self.hitmap)
+
+    @property
+    def clustersize(self):
+        """Size of every cluster: shape = (clusters)"""
+        return np.diff(self.channel_indptr)
+
+    @property
+    def cluster_event(self):
+        """Event index of every cluster: shape = (clusters)"""
+        return np.repeat(np.arange(len(self)), self.numclus)
+
+    @property
+    def channel_cluster(self):
+        """Cluster index of every entry of cluster_channels"""
+        return np.repeat(np.arange(len(self.channel_indptr)-1), self.clustersize)
+
+    def hits(self, event):
+        """The channels above SN_cut of an event"""
+        return self.hit_channels[self.hit_indptr[event]:self.hit_indptr[event+1]]
+
+    def clusters(self, event):
+        """The clusters of an event as list of channel arrays"""
+        return [self.cluster_channels[self.channel_indptr[c]:self.channel_indptr[c+1]]
+                for c in range(self.cluster_indptr[event], self.cluster_indptr[event+1])]
+
+    def cluster_sum(self, values=None):
+        """Sum of per channel values of every event over the channels of each
+        cluster, e.g. cluster_sum() is the signal of every cluster
+
+        :param values: shape = (events, channels) or (channels) for values of all events,
+                       None for the signals of the cluster channels (channel_signal)
+        :return: shape = (clusters)
+        """
+        if values is None:
+            members = self.channel_signal
+        elif np.ndim(values) == 2:
+            members = np.asarray(values)[self.cluster_event[self.channel_cluster],
+                                         self.cluster_channels]
+        else:
+            members = np.asarray(values)[self.cluster_channels]
+        return np.bincount(self.channel_cluster, weights=members, minlength=len(self.clustersize))
+
+    def hit_sum(self, values=None):
+        """Sum of per channel values over the channels above SN_cut of every
+        event, e.g. hit_sum() is the seed signal of every event
+
+        :param values: shape = (events, channels), None for the signals of the hits (hit_signal)
+        :return: shape = (events)
+        """
+        hit_event = np.repeat(np.arange(len(self)), np.diff(self.hit_indptr))
+        weights = self.hit_signal if values is None \
+            else np.asarray(values)[hit_event, self.hit_channels]
+        return np.bincount(hit_event, weights=weights, minlength=len(self))
+
+    # The Bdata view -------------------------------------------------------------
+    def keys(self):
+        """Returns the labels of the Bdata view"""
+        return self.labels
+
+    def __getitem__(self, label):
+        return self.get(label)
+
+    def get(self, label):
+        """The column of the old result rows with this label"""
+        if label not in self._columns:
+            self._columns[label] = self._column(label)
+        return self._columns[label]
+
+    def _column(self, label):
+        """Builds a column of the Bdata view"""
+        if label in SIGNAL_LABELS and self.signal is None:
+            raise KeyError("The signals of the whole events are not stored, "
+                           "set store_signals in the configs for {}".format(label))
+        if label == "Numclus":
+            return self.numclus
+        if label == "Timing":
+            return self.timing
+        if label == "CMN":
+            return self.CMN
+        if label == "CMsig":
+            return self.CMsig
+        if label == "Signal":
+            return self._object_column([row for row in self.signal])
+        if label == "SN":
+            return self._object_column([row for row in self.SN])
+        if label == "Hitmap":
+            return self._object_column([self.hitmap]*len(self))
+        if label == "Channel_hit":
+            return self._object_column(_split(self.hit_channels, self.hit_indptr))
+        if label == "Clustersize":
+            return self._object_column(_split(self.clustersize, self.cluster_indptr))
+        if label == "Clusters":
+            return self._object_column(_split(_split(self.cluster_channels, self.channel_indptr),
+                                              self.cluster_indptr))
+        raise KeyError(label)
+
+    @staticmethod
+    def _object_column(items):
+        """1D object array of the items (which may be arrays themselves)"""
+        column = np.empty(len(items), dtype=object)
+        for i, item in enumerate(items):
+            column[i] = item
+        return column
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_columns"] = {}
+        state["_storage"] = {}
+        return state
+
+    def __repr__(self):
+        return "EventResults({} events, {} clusters)".format(len(self), len(self.clustersize))
@@ -0,0 +1,405 @@
+"""This file contains the event sources. An event source hides whether a run
+is stored as hdf5 or as ALiBaVa binary file and hands out the events in chunks
+of fixed size. The chunks are read into float32 buffers which are reused for
+every chunk, therefore the memory consumption is bounded by the chunk size and
+not by the length of the run."""
+# pylint: disable=C0103,R0902
+import logging
+import os
+from collections import namedtuple
+import numpy as np
+from analysis_classes.utilities import import_h5
+from analysis_classes.nb_analysis_funcs import good_strip_mask
+from analysis_classes.binary_reader import map_file, read_binary_header, \
+    find_data_blocks, decode_blocks, scan_values, get_index, BlockTail, BLOCK_HEADER_SIZE
+
+# A chunk of events:
+#   index - event numbers of the chunk inside the run: shape = (events)
+#   signal - raw ADC signals: shape = (events, channels)
+#   time - timing of the events: shape = (events)
+# Warning: signal and time are views into the reused buffers of the source. They
+# are overwritten with the next chunk, copy them if you need to keep them!
+EventChunk = namedtuple("EventChunk", ["index", "signal", "time"])
+
+# A chunk of a zero suppressed run, the signal is already pedestal and common
+# mode corrected, channels which have been suppressed are 0:
+#   SN - signal to noise, a view into a reused buffer like signal: shape = (events, channels)
+#   CMN, CMsig - common mode and its std of the events: shape = (events)
+SparseChunk = namedtuple("SparseChunk", ["index", "signal", "time", "SN", "CMN", "CMsig"])
+
+# Value of the format attribute of zero suppressed hdf5 files
+SPARSE_FORMAT = "zero_suppressed"
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class EventSource:
+    """Base class of all event sources. Subclasses have to set numevents,
+    numchan and scan_values and implement read_chunk and read_field.
+    Sources of preprocessed events (zero suppressed files) set preprocessed.
+
+    Usage:
+        for chunk in source.chunks():
+            do_something(chunk.signal, chunk.time)
+    """
+    preprocessed = False
+
+    def __init__(self, path="", chunk_size=DEFAULT_CHUNK_SIZE, logger=None):
+        self.log = logger or logging.getLogger(__class__.__name__)
+        self.path = path
+        self.chunk_size = int(chunk_size)
+        self.numevents = 0
+        self.numchan = 256
+        self.scan_values = None
+        self._signal_buffer = None
+        self._time_buffer = None
+
+    def __len__(self):
+        return self.numevents
+
+    def __repr__(self):
+        return '<{} "{}" ({} events)>'.format(type(self).__name__,
+                                              os.path.basename(str(self.path)),
+                                              self.numevents)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Releases the file handles of the source"""
+
+    def update(self):
+        """Looks for events which have been added to the file since the source
+        was opened (e.g. by a DAQ which is still writing).
+        :return: Number of new events"""
+        return 0
+
+    def read_chunk(self, start, stop, signal, time):
+        """Reads the events start to stop into the passed buffers"""
+        raise NotImplementedError
+
+    def read_field(self, field, start=0, stop=None):
+        """Returns a per event field (time, temperature, clock) of the events
+        start to stop as float32 array. These are small compared to the signal."""
+        raise NotImplementedError
+
+    def read_rows(self, rows, signal, time):
+        """Reads only the events with the (sorted) event numbers rows into the
+        passed buffers. Neighbouring events are read together as one range."""
+        for first, last, position in contiguous_ranges(rows):
+            size = last-first
+            self.read_chunk(first, last, signal[position:position+size],
+                            time[position:position+size])
+
+    def buffers(self, size):
+        """Returns the reusable signal and time buffers with at least size entries"""
+        if self._signal_buffer is None or len(self._signal_buffer) < size:
+            self._signal_buffer = np.zeros((size, self.numchan), dtype=np.float32)
+            self._time_buffer = np.zeros(size, dtype=np.float32)
+        return self._signal_buffer, self._time_buffer
+
+    def chunks(self, start=0, stop=None, chunk_size=None, timing=None):
+        """Generator over all events from start to stop in chunks of chunk_size events.
+        If a timing window is passed, the timing of the events is read first and
+        only the signals of events inside the window are read. The chunks then
+        contain chunk_size events with good timing and chunk.index holds their
+        event numbers.
+
+        :param start: First event
+        :param stop: Last event (exclusive), None for all events
+        :param chunk_size: Overwrites the chunk size of the source
+        :param timing: [min, max] - Only events inside this timing window (inclusive)
+        :return: EventChunk
+        """
+        stop = self.numevents if stop is None else min(stop, self.numevents)
+        chunk_size = int(chunk_size or self.chunk_size)
+        if timing is not None:
+            yield from self._timing_chunks(start, stop, chunk_size, timing)
+            return
+        signal, time = self.buffers(min(chunk_size, max(stop-start, 0)))
+        for first in range(start, stop, chunk_size):
+            last = min(first+chunk_size, stop)
+            size = last-first
+            self.read_chunk(first, last, signal[:size], time[:size])
+            yield EventChunk(np.arange(first, last), signal[:size], time[:size])
+
+    def _timing_chunks(self, start, stop, chunk_size, timing):
+        """Chunks of the events inside the timing window, see chunks"""
+        if start >= stop:
+            return
+        eventtiming = self.read_field("time", start, stop)
+        rows = np.nonzero(np.logical_and(eventtiming >= timing[0],
+                                         eventtiming <= timing[1]))[0] + start
+        self.log.debug("%s of %s events inside the timing window", len(rows), stop-start)
+        signal, time = self.buffers(min(chunk_size, len(rows)))
+        for first in range(0, len(rows), chunk_size):
+            selected = rows[first:first+chunk_size]
+            size = len(selected)
+            self.read_rows(selected, signal[:size], time[:size])
+            yield EventChunk(selected, signal[:size], time[:size])
+
+
+class H5EventSource(EventSource):
+    """Event source for hdf5 files written by ALiBaVa. Reads directly from the
+    datasets into the float32 buffers with h5py's read_direct"""
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE, logger=None):
+        super().__init__(path, chunk_size, logger)
+        self.file = import_h5(path)
+        if self.file:
+            self.numevents, self.numchan = self.file["events"]["signal"].shape
+            self.scan_values = np.array(self.file["scan"]["value"][:])
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def read_chunk(self, start, stop, signal, time):
+        self.file["events"]["signal"].read_direct(signal, source_sel=np.s_[start:stop])
+        self.file["events"]["time"].read_direct(time, source_sel=np.s_[start:stop])
+
+    def read_field(self, field, start=0, stop=None):
+        return np.array(self.file["events"][field][start:stop], dtype=np.float32)
+
+
+class BinaryEventSource(EventSource):
+    """Event source for ALiBaVa binary files. The file is memory mapped and
+    only the blocks of the requested chunk are decoded. The block offsets are
+    taken from the index sidecar file if present"""
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE, use_index=True, logger=None):
+        super().__init__(path, chunk_size, logger)
+        self.buf = map_file(path)
+        if use_index:
+            self.file_header = get_index(path)
+            self.offsets, self.sizes = self.file_header["offsets"], self.file_header["sizes"]
+        else:
+            self.file_header = read_binary_header(self.buf)
+            self.offsets, self.sizes = find_data_blocks(self.buf, self.file_header["data_offset"])
+        self.numevents = len(self.offsets)
+        self.scan_values = scan_values(self.file_header["header"])
+        self.tail = None
+
+    def close(self):
+        self.buf = None
+        self.tail = None
+
+    def update(self):
+        if self.tail is None:
+            # Continue after the last complete block known so far
+            position = self.offsets[-1] + BLOCK_HEADER_SIZE + self.sizes[-1] \
+                if self.numevents else self.file_header["data_offset"]
+            self.tail = BlockTail(self.path, position=position)
+        new_offsets, new_sizes = self.tail.poll()
+        if len(new_offsets):
+            self.buf = self.tail.buf
+            self.offsets = np.append(self.offsets, new_offsets)
+            self.sizes = np.append(self.sizes, new_sizes)
+            self.numevents = len(self.offsets)
+        return len(new_offsets)
+
+    def read_chunk(self, start, stop, signal, time):
+        decode_blocks(self.buf, self.offsets[start:stop],
+                      out={"signal": signal, "time": time})
+
+    def read_rows(self, rows, signal, time):
+        # Every block is decoded on its own anyway, no need to build ranges
+        decode_blocks(self.buf, self.offsets[rows],
+                      out={"signal": signal, "time": time})
+
+    def read_field(self, field, start=0, stop=None):
+        offsets = self.offsets[start:stop]
+        out = {field: np.zeros(len(offsets), dtype=np.float32)}
+        return decode_blocks(self.buf, offsets, out=out)[field]
+
+
+class SparseEventSource(EventSource):
+    """Event source for zero suppressed hdf5 files, see zero_suppression.py.
+    Only the channels which survived the zero suppression are stored in CSR
+    form (events/indptr, events/channel, events/signal). The chunks contain the
+    corrected signals with all suppressed channels set to 0 together with the
+    SN and the common mode of every event. The SN is 0 for the noisy/masked
+    strips of the header and for strips without a finite, positive noise."""
+    preprocessed = True
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE, logger=None):
+        super().__init__(path, chunk_size, logger)
+        self.file = import_h5(path)
+        if self.file:
+            events = self.file["events"]
+            self.numchan = int(self.file.attrs["numchan"])
+            self.numevents = len(events["time"])
+            self.scan_values = np.array(self.file["scan"]["value"][:])
+            self.threshold = self.file.attrs["threshold"]
+            self.noise = np.array(self.file["header"]["noise"][:])
+            self.noisy_strips = np.array(self.file["header"]["noisy_strips"][:], dtype=np.int64)
+            self.good = np.logical_and(good_strip_mask(self.numchan, self.noisy_strips),
+                                       np.isfinite(self.noise))
+            self.good[self.good] = self.noise[self.good] > 0
+            self.indptr = np.array(events["indptr"][:])
+            self.CMN = np.array(events["CMN"][:])
+            self.CMsig = np.array(events["CMsig"][:])
+        self._SN_buffer = None
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def read_chunk(self, start, stop, signal, time):
+        first, last = self.indptr[start], self.indptr[stop]
+        rows = np.repeat(np.arange(stop-start), np.diff(self.indptr[start:stop+1]))
+        signal[:] = 0
+        signal[rows, self.file["events"]["channel"][first:last]] = \
+            self.file["events"]["signal"][first:last]
+        self.file["events"]["time"].read_direct(time, source_sel=np.s_[start:stop])
+
+    def read_field(self, field, start=0, stop=None):
+        return np.array(self.file["events"][field][start:stop], dtype=np.float32)
+
+    def chunks(self, start=0, stop=None, chunk_size=None, timing=None):
+        """See EventSource.chunks, the chunks are SparseChunks"""
+        for chunk in super().chunks(start, stop, chunk_size, timing):
+            size = len(chunk.index)
+            if self._SN_buffer is None or len(self._SN_buffer) < size:
+                # The strips which are not good are never written and stay 0
+                self._SN_buffer = np.zeros((size, self.numchan), dtype=np.float32)
+            SN = self._SN_buffer[:size]
+            np.divide(chunk.signal, self.noise, out=SN, where=self.good)
+            yield SparseChunk(chunk.index, chunk.signal, chunk.time, SN,
+                              self.CMN[chunk.index], self.CMsig[chunk.index])
+
+
+class ArrayEventSource(EventSource):
+    """Event source for events which are already in memory (or any other
+    sliceable array like object)"""
+    def __init__(self, signal, time, scan_values=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, logger=None):
+        super().__init__("memory", chunk_size, logger)
+        self.signal = signal
+        self.time = time
+        self.numevents, self.numchan = np.shape(signal)
+        self.scan_values = scan_values
+
+    def read_chunk(self, start, stop, signal, time):
+        signal[:] = self.signal[start:stop]
+        time[:] = self.time[start:stop]
+
+    def read_field(self, field, start=0, stop=None):
+        if field != "time":
+            raise KeyError("Only the timing is available for in memory events")
+        return np.array(self.time[start:stop], dtype=np.float32)
+
+
+class ChainedEventSource(EventSource):
+    """Event source for a run which is split into several files. The files
+    are exposed as one continuous stream of events without copying them, the
+    event numbers continue over the file boundaries"""
+    def __init__(self, sources, chunk_size=DEFAULT_CHUNK_SIZE, logger=None):
+        super().__init__([source.path for source in sources], chunk_size, logger)
+        if len({source.numchan for source in sources}) > 1:
+            raise ValueError("The files of the run have different numbers of channels")
+        self.sources = sources
+        self.numchan = sources[0].numchan
+        self.scan_values = sources[0].scan_values
+        self._update_boundaries()
+
+    def __repr__(self):
+        return '<{} "{}" ({} files, {} events)>'.format(type(self).__name__,
+                                                        os.path.basename(str(self.sources[0].path)),
+                                                        len(self.sources), self.numevents)
+
+    def _update_boundaries(self):
+        """The first event of every source in the chained event numbers"""
+        self.first_events = np.cumsum([0] + [source.numevents for source in self.sources])
+        self.numevents = int(self.first_events[-1])
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+    def update(self):
+        # Only the last file of a run can still be written
+        new_events = self.sources[-1].update()
+        self._update_boundaries()
+        return new_events
+
+    def _split(self, start, stop):
+        """Yields the source, the local start/stop and the position in the
+        requested range for every source the range start to stop touches"""
+        for i, source in enumerate(self.sources):
+            first = max(start, self.first_events[i])
+            last = min(stop, self.first_events[i+1])
+            if first < last:
+                yield source, first-self.first_events[i], last-self.first_events[i], first-start
+
+    def read_chunk(self, start, stop, signal, time):
+        for source, first, last, position in self._split(start, stop):
+            size = last-first
+            source.read_chunk(first, last, signal[position:position+size],
+                              time[position:position+size])
+
+    def read_rows(self, rows, signal, time):
+        bounds = np.searchsorted(rows, self.first_events)
+        for i, source in enumerate(self.sources):
+            if bounds[i] < bounds[i+1]:
+                source.read_rows(rows[bounds[i]:bounds[i+1]] - self.first_events[i],
+                                 signal[bounds[i]:bounds[i+1]], time[bounds[i]:bounds[i+1]])
+
+    def read_field(self, field, start=0, stop=None):
+        stop = self.numevents if stop is None else min(stop, self.numevents)
+        return np.concatenate([np.zeros(0, dtype=np.float32)] +
+                              [source.read_field(field, first, last)
+                               for source, first, last, _ in self._split(start, stop)])
+
+
+def contiguous_ranges(rows):
+    """Coalesces sorted event numbers into ranges of consecutive events.
+
+    :param rows: sorted array of event numbers
+    :return: array of shape (ranges, 3) with first event, last event (exclusive)
+             and the position of the first event in rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if not len(rows):
+        return np.zeros((0, 3), dtype=np.int64)
+    breaks = np.nonzero(np.diff(rows) != 1)[0] + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(rows)]))
+    return np.column_stack((rows[starts], rows[ends-1]+1, starts))
+
+
+def open_event_source(path, configs):
+    """Opens the correct event source for the file. If a list of files is
+    passed, the files are treated as one run and chained together. Zero
+    suppressed hdf5 files are recognized by their format attribute.
+
+    Config params:
+        - isBinary: bool - Whether or not the input file is AliBaVa binary or HDF5
+        - chunk_size: int - Number of events read from the file at once
+        - binary_index: bool - Use (and write) the block index sidecar files of binary files
+
+    :return: EventSource or False if the file could not be read
+    """
+    chunk_size = configs.get("chunk_size", DEFAULT_CHUNK_SIZE)
+    if isinstance(path, (list, tuple)):
+        if len(path) == 1:
+            return open_event_source(path[0], configs)
+        sources = [open_event_source(part, configs) for part in path]
+        if any(source is False for source in sources):
+            return False
+        return ChainedEventSource(sources, chunk_size=chunk_size)
+    if configs.get("isBinary", False):
+        source = BinaryEventSource(path, chunk_size=chunk_size,
+                                   use_index=configs.get("binary_index", True))
+    else:
+        h5file = import_h5(path)
+        if not h5file:
+            return False
+        sparse = h5file.attrs.get("format", "") == SPARSE_FORMAT
+        h5file.close()
+        if sparse:
+            source = SparseEventSource(path, chunk_size=chunk_size)
+        else:
+            source = H5EventSource(path, chunk_size=chunk_size)
+    return source
@@ -3,12 +3,12 @@ run data"""
 #pylint: disable=R0902,R0915,C0103,C0301
 
 import logging
-from multiprocessing import Pool
 from time import time
 import numpy as np
 from .base_analysis import BaseAnalysis
-from .utilities import Bdata, read_binary_Alibava, load_plugins
-from .utilities import import_h5
+from .utilities import load_plugins
+from .event_source import open_event_source
+from .nb_analysis_funcs import common_mode_settings, clustering_engine, set_threads
 
 class MainAnalysis:
     # COMMENT: the __init__ should be split up at least into 2 methods
@@ -24,10 +24,25 @@ class MainAnalysis:
            Afterwards if conducts all analysis specified in the configs file.
            It does not have any fancy algorithms in it.
 
+        :param path: Path to the run file or a list of files which form one run
+
         Config params:
             - isBinary: bool - Whether or not the input file is AliBaVa binary or HDF5
             - additional_analysis: list - containing the names of the analysises which should be done
-            - Processes: int number of pool size for multiprocessing
+            - Processes: int - Old multiprocessing pool size, used as threads if these are not set
+            - threads: int - Threads of the compiled event processing, 0 for all cores
+            - chunk_size: int - Number of events which are read and processed at once
+            - store_signals: bool - Keep the signal and SN of all events (single event plots),
+                                    otherwise only the signals of the hits and clusters are kept
+            - common_mode: str - "global" or the per chip estimator "mean", "median", "trimmed"
+            - clustering: str - Clustering engine, "seeds" grows the clusters around the seeds,
+                                "runs" finds them in one scan independent of max_cluster_size
+            - follow_run: bool - The run file is still written, process new events as they appear
+            - follow_poll_interval: float - Seconds between two looks for new events
+            - follow_timeout: float - Stop following if no new events appeared for this many seconds
+            - auto_timing_window: float - Fraction of the maximum of the pulse shape of the delay
+                                          scan, the events with a timing where the pulse shape
+                                          is above it are processed instead of timingWindow (0 to disable)
 
         """
 
@@ -36,10 +51,7 @@ class MainAnalysis:
         self.start = time()
 
         self.log.info("Loading event file(s): %s", path)
-        if not configs.get("isBinary", False):
-            self.data = import_h5(path)
-        else:
-            self.data = read_binary_Alibava(path)
+        self.data = open_event_source(path, configs)
 
         self.outputdata = {}
         self.results = self.outputdata
@@ -54,6 +66,16 @@ class MainAnalysis:
         self.CMsig = self.noise_analysis.CMsig
         self.noise = self.noise_analysis.noise
 
+        # Only the events near the maximum of the pulse shape of the delay scan
+        if configs.get("auto_timing_window", 0):
+            window = self.calibration.timing_window(configs["auto_timing_window"]) \
+                if self.calibration is not None else None
+            if window is None:
+                self.log.warning("No delay scan for the automatic timing window, using "
+                                 "the timingWindow %s", self.timingWindow)
+            else:
+                self.log.info("Timing window from the delay scan: %.1f - %.1f ns", *window)
+                self.timingWindow = window
 
         # Load some crucial parameters from the config
         # Get the additional anlysises which should be done
@@ -61,6 +83,11 @@ class MainAnalysis:
         if not self.add_analysis:
             self.add_analysis = []
 
+        # Common mode per chip or over all channels
+        self.cm_settings = common_mode_settings(configs)
+        # Clustering engine of the event processing
+        self.cluster_engine = clustering_engine(configs)
+
         # Material decision
         self.material = configs.get("sensor_type", "n-in-p")
         if self.material == "n-in-p":
@@ -68,13 +95,12 @@ class MainAnalysis:
         else:
             self.material = 0  # Easier to handle
 
-        # Create a pool for multiprocessing
-        self.process_pool = configs.get("Processes", 1)  # How many workers
-        self.Pool = Pool(processes=self.process_pool)
+        # Threads of the compiled event processing, the results do not depend on it.
+        # There is no process pool anymore, Processes > 1 is used as threads if these are not set
+        processes = configs.get("Processes", 1)
+        set_threads(configs.get("threads", processes if processes > 1 else 0))
 
         self.log.info("Processing file ...")
-        self.events = np.array(self.data["events"]["signal"][:], dtype=np.float32)
-        self.timing = np.array(self.data["events"]["time"][:], dtype=np.float32)
 
         try:
             file = str(self.data).split('"')[1].split('.')[0]
@@ -86,14 +112,17 @@ class MainAnalysis:
                                     "noise": self.noise}
 
         # Start the base analysis with clustering
-        _object = BaseAnalysis(self, self.events, self.timing)
-        results = _object.run()
+        _object = BaseAnalysis(self, self.data)
+        if configs.get("follow_run", False):
+            # The run is still written, process new events until no new ones arrive
+            results = _object.follow(configs.get("follow_poll_interval", 1.),
+                                     configs.get("follow_timeout", 30.))
+        else:
+            results = _object.run()
 
-        self.outputdata["base"] = Bdata(results,
-                                        labels=["Signal", "SN", "CMN", "CMsig",
-                                                "Hitmap", "Channel_hit",
-                                                "Clusters", "Numclus",
-                                                "Clustersize", "Timing"])
+        # EventResults, which can be used like a Bdata with the labels Signal,
+        # SN, CMN, CMsig, Hitmap, Channel_hit, Clusters, Numclus, Clustersize, Timing
+        self.outputdata["base"] = results
 
         # Now process additional analysis stated in the config file
         # Load all plugins
@@ -110,18 +139,18 @@ class MainAnalysis:
             "            ~~~~~~~~~~~~~~~~                                             \n"
             "                                                                         \n"
             "            Events processed:  {events!s}                                \n"
-            "            Total events:      42                          \n"
+            "            Total events:      {total!s}                                 \n"
+            "            Events without seed (not clustered): {skipped!s}             \n"
+            "            Automasked hits:   {automasked!s}                            \n"
             "            Time taken:        {time!s}                                  \n"
             "                                                                         \n"
             "*************************************************************************\n"\
-            .format(automasked=42,
-                    events=len(self.outputdata["base"]["Signal"]),
+            .format(automasked=getattr(self, "automasked_hit", 0),
+                    events=len(self.outputdata["base"]),
+                    total=self.data.numevents,
+                    skipped=getattr(self, "skipped_events", 0),
                     time=round((time() - self.start), 1)))
 
-        # Close the pool
-        self.Pool.close()
-        self.Pool.join()
-
 
     def configure_configs(self, configs):
         """Takes every parent entry in the configs dict and makes a object for
@@ -1,5 +1,7 @@
 """This files contains analysis function optimizes by numba jit capabilities"""
 #pylint: disable=E1111,C0103
+from collections import namedtuple
+import numba
 from numba import jit, prange
 import numpy as np
 
@@ -8,86 +10,478 @@ gil = True # Use gil or not
 Fast = True # Use fastmath
 parallel = True # Use parallel execution
 
-jit(nogil=gil, cache=True, nopython=True, fastmath=Fast)
-def event_process_function_multithread(args):
-    """Just a small wrapper foe the multiprocessing function
-
-    Written by Dominic Bloech
+# Results of the compiled event processing of a chunk of events. The hits and
+# clusters of all events are stored flat (CSR), the hits of event i are
+# hit_channels[hit_indptr[i]:hit_indptr[i+1]], its clusters are the clusters
+# cluster_indptr[i] to cluster_indptr[i+1] and the channels of cluster c are
+# cluster_channels[channel_indptr[c]:channel_indptr[c+1]]. hit_signal and
+# channel_signal are the corrected signals of the entries of hit_channels and
+# cluster_channels, so the signals of the whole events (signal, SN) are not
+# needed to analyse the hits and clusters. skipped_events is the number of
+# events without seed candidates, which were not clustered
+ProcessedChunk = namedtuple("ProcessedChunk", ["signal", "SN", "CMN", "CMsig", "hitmap",
+                                               "hit_indptr", "hit_channels", "hit_signal",
+                                               "numclus", "cluster_indptr", "channel_indptr",
+                                               "cluster_channels", "channel_signal",
+                                               "automasked", "timing", "cluster_table",
+                                               "skipped_events"])
+# One record per cluster, calculated during the clustering:
+#   event: index of the event, seed: seed channel, seed_SN: SN of the seed,
+#   first/last: first and last channel, size: number of channels,
+#   signal: summed ADC, noise: summed noise, SN: cluster SN as used for the SN_cluster cut,
+#   position: centre of gravity of the abs signals in channels,
+#   eta: abs right/(abs left + abs right) signal of the seed and its larger neighbour
+#        (inside the cluster if it has more than one channel), nan without neighbour,
+#   timing: timing of the event
+CLUSTER_DTYPE = np.dtype([("event", np.int64), ("seed", np.int64), ("seed_SN", np.float64),
+                          ("first", np.int64), ("last", np.int64), ("size", np.int64),
+                          ("signal", np.float64), ("noise", np.float64), ("SN", np.float64),
+                          ("position", np.float64), ("eta", np.float64), ("timing", np.float64)])
+EVENT_BLOCK = 64  # Events per block of the parallel loops, fixes the order of all reductions
+# The clustering engines: "seeds" grows the clusters around every seed channel by
+# channel (nb_cluster_event), "runs" finds them in one scan (nb_cluster_event_runs)
+CLUSTER_ENGINES = {"seeds": 0, "runs": 1}
+
+def set_threads(threads=0):
+    """Sets the number of threads of the parallel kernels, 0 uses all cores"""
+    available = numba.config.NUMBA_NUM_THREADS
+    numba.set_num_threads(min(threads, available) if threads > 0 else available)
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel)
+def nb_preprocess_events(events, pedestal, meanCMN, meanCMsig, noise, good, signal, SN, CMN, CMsig):
     """
-    events, pedestal, meanCMN, meanCMsig, noise, numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize, masking, material, noisy_strips = args
-    return event_process_function(events, pedestal, meanCMN, meanCMsig, noise,
-                           numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                           masking, material, noisy_strips)
-
-jit(nogil=gil, parallel=parallel, nopython=True, fastmath=Fast)
-def event_process_function(events, pedestal, meanCMN, meanCMsig, noise,
-                           numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                           masking, material, noisy_strips, event_timings):
-    """
-    This function simply handles the preprocessing of all events, like garbage clean up and then clustering
-    :param events:
-    :param pedestal:
-    :param meanCMN:
-    :param meanCMsig:
-    :param noise:
-    :param numchan:
-    :param SN_cut:
-    :param SN_ratio:
-    :param SN_cluster:
-    :param max_clustersize:
-    :param masking:
-    :param material:
-    :param noisy_strips:
-    :param event_timings:
-    :return:
+    Preprocesses all events in parallel and writes the results into the passed
+    arrays (the numpy version is reference_preprocessing in benchmarks).
+    Signals above 5*meanCMsig+meanCMN are set to 0, the common mode of every
+    event is the mean over all channels, the strips which are not good are set to 0.
+    :param events: The raw events: shape = (events, channels)
+    :param pedestal: The pedestal: shape = (channels)
+    :param meanCMN: The mean CMN
+    :param meanCMsig: The mean CMNsig
+    :param noise: The noise per channel: shape = (channels)
+    :param good: Bool array, True for the good strips: shape = (channels)
+    :param signal: Output, corrected signal: shape = (events, channels)
+    :param SN: Output, signal to noise: shape = (events, channels)
+    :param CMN: Output, common mode of every event: shape = (events)
+    :param CMsig: Output, common mode std of every event: shape = (events)
+    """
+    nevents, numchan = events.shape
+    cut = 5.*meanCMsig + meanCMN
+    for i in prange(nevents):
+        total = 0.
+        for ch in range(numchan):
+            value = events[i, ch] - pedestal[ch]
+            if value > cut:
+                value = 0.
+            signal[i, ch] = value
+            total += value
+        cm = total/numchan
+        square = 0.
+        for ch in range(numchan):
+            square += (signal[i, ch] - cm)**2
+        CMN[i] = cm
+        CMsig[i] = np.sqrt(square/numchan)
+        for ch in range(numchan):
+            if good[ch]:
+                signal[i, ch] -= cm
+            else:
+                signal[i, ch] = 0.
+            SN[i, ch] = signal[i, ch]/noise[ch]
+
+@jit(nopython=True, cache=True, nogil=gil)
+def nb_cluster_event(event, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize,
+                     masking, material, used, hits, clusters, sizes):
+    """
+    The clustering of nb_clustering for one event without any allocations, the
+    results are written into the passed scratch arrays (all numchan long).
+    :param used: Scratch array for the used channels
+    :param hits: Output, the channels above SN_cut
+    :param clusters: Output, the channels of all clusters one after the other
+    :param sizes: Output, the size of every cluster
+    :return: number of hits, number of clusters, number of cluster channels, automasked hits
+    """
+    numchan = len(event)
+    SNval = SN_cut*SN_ratio
+    offset = int(max_clustersize*0.5)
+    numhits = 0
+    automasked = 0
+    for ch in range(numchan):
+        if masking:
+            # Only the correct polarity is valid, material 1: negative signals (p-type)
+            wrong = event[ch] > 0 if material else event[ch] < 0
+            used[ch] = not (event[ch] < 0 if material else event[ch] > 0)
+        else:
+            wrong = False
+            used[ch] = False
+        if abs(SN[ch]) > SN_cut:
+            hits[numhits] = ch
+            numhits += 1
+            if wrong:
+                automasked += 1
+
+    numclus = 0
+    numchannels = 0
+    for h in range(numhits):
+        ch = hits[h]
+        if used[ch]:
+            continue
+        used[ch] = True
+        first = numchannels
+        clusters[numchannels] = ch
+        numchannels += 1
+        right_stop = False
+        left_stop = False
+        for i in range(1, offset+1):
+            if 0 < ch-i and ch+i < numchan:
+                if not right_stop:
+                    if abs(SN[ch+i]) > SNval and not used[ch+i]:
+                        clusters[numchannels] = ch+i
+                        used[ch+i] = True
+                        numchannels += 1
+                    else:
+                        right_stop = True
+                if not left_stop:
+                    if abs(SN[ch-i]) > SNval and not used[ch-i]:
+                        clusters[numchannels] = ch-i
+                        used[ch-i] = True
+                        numchannels += 1
+                    else:
+                        left_stop = True
+
+        # Look if the cluster SN is big enough to be counted as clusters
+        Scluster = 0.
+        Ncluster = 0.
+        for k in range(first, numchannels):
+            Scluster += event[clusters[k]]
+            Ncluster += noise[clusters[k]]
+        if abs(Scluster)/np.sqrt(abs(Ncluster)) > SN_cluster:
+            sizes[numclus] = numchannels - first
+            numclus += 1
+        else:
+            numchannels = first  # Rejected, its channels stay used
+    return numhits, numclus, numchannels, automasked
 
-    Written by Dominic Bloech
+@jit(nopython=True, cache=True, nogil=gil)
+def nb_cluster_event_runs(event, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize,
+                          masking, material, used, hits, clusters, sizes):
     """
+    The "runs" clustering engine, same arguments and results as nb_cluster_event.
+    The clusters are found in one scan over the channels: a cluster candidate is
+    a run of neighbouring channels with abs(SN) > SN_cut*SN_ratio (and the correct
+    polarity if masking), it is a cluster if it contains a hit above SN_cut and
+    passes the SN_cluster cut. The seed is the channel with the highest abs(SN),
+    the other channels follow in ascending order. The cost does not depend on
+    the cluster sizes, max_clustersize is not used: runs are never cut.
+    Up to max_clustersize and away from the sensor edges this gives the same
+    clusters as nb_cluster_event, which grows the clusters around the seeds.
+    """
+    numchan = len(event)
+    SNval = SN_cut*SN_ratio
+    numhits = 0
+    automasked = 0
+    numclus = 0
+    numchannels = 0
+    start = -1  # First channel of the current run, -1 outside of runs
+    seed = -1
+    for ch in range(numchan+1):
+        absSN = abs(SN[ch]) if ch < numchan else 0.
+        inside = absSN > SNval
+        if inside and masking:
+            # Only the correct polarity is valid, material 1: negative signals (p-type)
+            inside = event[ch] < 0 if material else event[ch] > 0
+        if absSN > SN_cut:
+            hits[numhits] = ch
+            numhits += 1
+            if masking and (event[ch] > 0 if material else event[ch] < 0):
+                automasked += 1
+        if inside:
+            if start < 0:
+                start = ch
+                seed = -1
+            if absSN > SN_cut and (seed < 0 or absSN > abs(SN[seed])):
+                seed = ch
+        elif start >= 0:
+            # End of a run, it is a cluster if it has a seed and enough SN
+            if seed >= 0:
+                Scluster = 0.
+                Ncluster = 0.
+                for k in range(start, ch):
+                    Scluster += event[k]
+                    Ncluster += noise[k]
+                if abs(Scluster)/np.sqrt(abs(Ncluster)) > SN_cluster:
+                    clusters[numchannels] = seed
+                    numchannels += 1
+                    for k in range(start, ch):
+                        if k != seed:
+                            clusters[numchannels] = k
+                            numchannels += 1
+                    sizes[numclus] = ch - start
+                    numclus += 1
+            start = -1
+    return numhits, numclus, numchannels, automasked
+
+@jit(nopython=True, cache=True, nogil=gil)
+def nb_cluster_features(event, SN, noise, channels, features):
+    """
+    Calculates the features of one cluster, see CLUSTER_DTYPE
+    :param event: The signal of the event: shape = (channels)
+    :param SN: The SN of the event: shape = (channels)
+    :param noise: The noise: shape = (channels)
+    :param channels: The channels of the cluster, seed first
+    :param features: Output, the columns 1 to 10 of CLUSTER_DTYPE are filled
+    """
+    numchan = len(event)
+    seed = channels[0]
+    first = seed
+    last = seed
+    signal = 0.
+    cluster_noise = 0.
+    abssum = 0.
+    weighted = 0.
+    for ch in channels:
+        first = min(first, ch)
+        last = max(last, ch)
+        signal += event[ch]
+        cluster_noise += noise[ch]
+        abssum += abs(event[ch])
+        weighted += ch*abs(event[ch])
+
+    # The larger neighbour of the seed, inside the cluster if possible
+    low = first if last > first else 0
+    high = last if last > first else numchan-1
+    neighbour = -1
+    if seed > low:
+        neighbour = seed-1
+    if seed < high and (neighbour < 0 or abs(event[seed+1]) > abs(event[neighbour])):
+        neighbour = seed+1
+    eta = np.nan
+    if neighbour >= 0:
+        left = abs(event[min(seed, neighbour)])
+        right = abs(event[max(seed, neighbour)])
+        if left + right > 0:
+            eta = right/(left + right)
+
+    features[1] = seed
+    features[2] = SN[seed]
+    features[3] = first
+    features[4] = last
+    features[5] = len(channels)
+    features[6] = signal
+    features[7] = cluster_noise
+    features[8] = abs(signal)/np.sqrt(abs(cluster_noise))
+    features[9] = weighted/abssum if abssum > 0 else seed
+    features[10] = eta
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel)
+def nb_seed_scan(SN, SN_cut):
+    """
+    Pre-scan of the events for seed candidates, the scan of an event stops at
+    the first channel with abs(SN) > SN_cut. Events without such a channel have
+    no hits and no clusters and do not need to be clustered.
+    :param SN: The SN of the events: shape = (events, channels)
+    :param SN_cut: The SN_cut from the config
+    :return: bool array, True for the candidates: shape = (events)
+    """
+    nevents, numchan = SN.shape
+    candidates = np.zeros(nevents, dtype=np.bool_)
+    for i in prange(nevents):
+        for ch in range(numchan):
+            if abs(SN[i, ch]) > SN_cut:
+                candidates[i] = True
+                break
+    return candidates
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel)
+def nb_cluster_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize,
+                      masking, material, engine, candidates, hits, clusters, sizes):
+    """
+    Clusters the candidate events in parallel, see nb_clustering for the
+    algorithm. The events are processed in blocks of EVENT_BLOCK candidates, so
+    the results do not depend on the number of threads. All other events have
+    no hits and clusters.
+    :param engine: The clustering engine, see CLUSTER_ENGINES
+    :param candidates: Indizes of the events with a channel above SN_cut (see nb_seed_scan)
+    :param hits, clusters, sizes: int32 scratch arrays with a row for every candidate:
+                                  shape = (>= candidates, channels), see PreprocessBuffers
+    :return: hitmap, hit_indptr, hit_channels, hit_signal, numclus, cluster_indptr,
+             channel_indptr, cluster_channels, channel_signal, automasked (see ProcessedChunk) and
+             the cluster features: shape = (clusters, 11), see CLUSTER_DTYPE
+    """
+    nevents, numchan = signal.shape
+    ncandidates = len(candidates)
+    nblocks = (ncandidates + EVENT_BLOCK - 1)//EVENT_BLOCK
+    # Pass 1: cluster every candidate into its own row of the scratch arrays
+    numhits = np.zeros(nevents, dtype=np.int64)
+    numclus = np.zeros(nevents, dtype=np.int64)
+    numchannels = np.zeros(nevents, dtype=np.int64)
+    automasked = np.zeros(nevents, dtype=np.int64)
+    block_hitmaps = np.zeros((nblocks, numchan), dtype=np.int64)
+    for block in prange(nblocks):
+        used = np.empty(numchan, dtype=np.bool_)
+        for j in range(block*EVENT_BLOCK, min((block+1)*EVENT_BLOCK, ncandidates)):
+            i = candidates[j]
+            if engine == 1:
+                numhits[i], numclus[i], numchannels[i], automasked[i] = \
+                    nb_cluster_event_runs(signal[i], SN[i], noise, SN_cut, SN_ratio, SN_cluster,
+                                          max_clustersize, masking, material, used, hits[j],
+                                          clusters[j], sizes[j])
+            else:
+                numhits[i], numclus[i], numchannels[i], automasked[i] = \
+                    nb_cluster_event(signal[i], SN[i], noise, SN_cut, SN_ratio, SN_cluster,
+                                     max_clustersize, masking, material, used, hits[j],
+                                     clusters[j], sizes[j])
+            for h in range(numhits[i]):
+                block_hitmaps[block, hits[j, h]] += 1
+    hitmap = block_hitmaps.sum(axis=0)
+
+    # Pass 2: copy the rows into the flat arrays
+    hit_indptr = np.zeros(nevents+1, dtype=np.int64)
+    hit_indptr[1:] = np.cumsum(numhits)
+    cluster_indptr = np.zeros(nevents+1, dtype=np.int64)
+    cluster_indptr[1:] = np.cumsum(numclus)
+    event_channels = np.zeros(nevents+1, dtype=np.int64)
+    event_channels[1:] = np.cumsum(numchannels)
+    hit_channels = np.empty(hit_indptr[-1], dtype=np.int64)
+    hit_signal = np.empty(hit_indptr[-1], dtype=np.float64)
+    cluster_channels = np.empty(event_channels[-1], dtype=np.int64)
+    channel_signal = np.empty(event_channels[-1], dtype=np.float64)
+    cluster_sizes = np.empty(cluster_indptr[-1], dtype=np.int64)
+    for j in prange(ncandidates):
+        i = candidates[j]
+        for h in range(numhits[i]):
+            hit_channels[hit_indptr[i]+h] = hits[j, h]
+            hit_signal[hit_indptr[i]+h] = signal[i, hits[j, h]]
+        for k in range(numchannels[i]):
+            cluster_channels[event_channels[i]+k] = clusters[j, k]
+            channel_signal[event_channels[i]+k] = signal[i, clusters[j, k]]
+        cluster_sizes[cluster_indptr[i]:cluster_indptr[i+1]] = sizes[j, :numclus[i]]
+    channel_indptr = np.zeros(len(cluster_sizes)+1, dtype=np.int64)
+    channel_indptr[1:] = np.cumsum(cluster_sizes)
+
+    # Pass 3: the features of every cluster, columns as in CLUSTER_DTYPE without the timing
+    features = np.empty((len(cluster_sizes), 11), dtype=np.float64)
+    for j in prange(ncandidates):
+        i = candidates[j]
+        for c in range(cluster_indptr[i], cluster_indptr[i+1]):
+            nb_cluster_features(signal[i], SN[i], noise,
+                                cluster_channels[channel_indptr[c]:channel_indptr[c+1]], features[c])
+            features[c, 0] = i
+    return hitmap, hit_indptr, hit_channels, hit_signal, numclus, cluster_indptr, \
+        channel_indptr, cluster_channels, channel_signal, automasked, features
+
+class PreprocessBuffers:
+    """Arrays which are reused for all chunks of a run: the outputs of
+    preprocess_events and the scratch arrays of the clustering (nb_cluster_events).
+    The processing of a chunk then only allocates its (small) results. The
+    arrays only grow if a bigger chunk (or more seed candidates) is requested.
+
+    Usage:
+        buffers = PreprocessBuffers(numchan)
+        for chunk in source.chunks():
+            result = parallel_event_processing(..., buffers=buffers)
+    """
+    def __init__(self, numchan, capacity=0, dtype=np.float32):
+        """
+        :param numchan: Number of channels
+        :param capacity: Number of events the arrays are allocated for at first
+        :param dtype: dtype of the signal and SN arrays, float64 doubles the memory
+        """
+        self.numchan = numchan
+        self.signal = np.empty((capacity, numchan), dtype=dtype)
+        self.SN = np.empty((capacity, numchan), dtype=dtype)
+        self.CMN = np.empty(capacity, dtype=np.float64)
+        self.CMsig = np.empty(capacity, dtype=np.float64)
+        self.hits = np.empty((0, numchan), dtype=np.int32)
+        self.clusters = np.empty((0, numchan), dtype=np.int32)
+        self.sizes = np.empty((0, numchan), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.signal)
+
+    def views(self, size):
+        """The signal, SN, CMN and CMsig arrays for a chunk of size events,
+        the out parameter of preprocess_events. They are overwritten by the next chunk."""
+        if size > len(self):
+            for name in ("signal", "SN", "CMN", "CMsig"):
+                old = getattr(self, name)
+                setattr(self, name, np.empty((size,) + old.shape[1:], dtype=old.dtype))
+        return self.signal[:size], self.SN[:size], self.CMN[:size], self.CMsig[:size]
+
+    def cluster_scratch(self, size):
+        """The hits, clusters and sizes scratch arrays of nb_cluster_events for
+        size seed candidates"""
+        if size > len(self.hits):
+            for name in ("hits", "clusters", "sizes"):
+                setattr(self, name, np.empty((size, self.numchan), dtype=np.int32))
+        return self.hits, self.clusters, self.sizes
+
+def preprocess_events(events, pedestal, meanCMN, meanCMsig, noise, numchan, noisy_strips,
+                      cm_settings=None, out=None):
+    """
+    Subtracts pedestal and common mode from the events and calculates the SN
+    :param cm_settings: Settings of the per chip common mode (see common_mode_settings),
+                        None for the global common mode
+    :param out: signal, SN, CMN, CMsig arrays the results are written to, e.g.
+                PreprocessBuffers.views, None allocates new (float32) arrays
+    :return: signal, SN: shape = (events, channels), CMN, CMsig: shape = (events)
+    """
+    good = good_strip_mask(numchan, noisy_strips)
+    if out is None:
+        out = PreprocessBuffers(numchan, len(events)).views(len(events))
+    if cm_settings is not None:
+        nb_preprocess_chips_into(events, pedestal, noise, good, CHIP_SIZE, *cm_settings, *out)
+    else:
+        nb_preprocess_events(events, pedestal, meanCMN, meanCMsig, noise, good, *out)
+    return out
 
-    # Generate the output array
-    prodata = np.zeros((len(events), 10), dtype=np.object)
-    index = 0
-    # Generate the hitmap
-    hitmap = np.zeros(numchan)
-
-    # Preprocess all events for the clustering algorithm
-    signal, SN, CMN, CMsig = nb_preprocess_all_events(events, pedestal, meanCMN,
-                                                   meanCMsig, noise, numchan, noisy_strips)
-
-    # Pass all events to the clustering algorithm
-    for i in prange(0, len(events)):
-        channels_hit, clusters, numclus, clustersize, automasked_hits = nb_clustering(signal[i], SN[i], noise, SN_cut,
-                                                                                      SN_ratio, SN_cluster, numchan,
-                                                                                      max_clustersize=max_clustersize,
-                                                                                      masking=masking,
-                                                                                      material=material)
-        # Build the hitmap for this event
-        for channel in channels_hit:
-            hitmap[channel] += 1
-
-        # Add the results to the results array for every event
-        prodata[index]=np.array([
-            signal[i],
-            SN[i],
-            CMN,
-            CMsig,
-            hitmap,
-            channels_hit,
-            clusters,
-            numclus,
-            clustersize,
-            event_timings[i]])
-        index +=1
-    return prodata
-
-jit(nogil=gil, parallel=parallel, nopython=True, fastmath=Fast)
-def parallel_event_processing(goodtiming, timings, events, pedestal, meanCMN, meanCMsig, noise,
-                              numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize = 5,
-                              masking=True, material=1, poolsize = 1, Pool=None, noisy_strips = []):
-    """
-    This function handles all logic to distribute the event processing and clustering to several cores
-    to speed up the calculations. It does not do anything complicated.
-    :param goodtiming: Array containing the indizes of evetns with good timing
+def cluster_preprocessed_events(signal, SN, CMN, CMsig, noise, numchan, SN_cut,
+                                SN_ratio, SN_cluster, max_clustersize, masking,
+                                material, event_timings, engine="seeds", buffers=None):
+    """
+    Clusters events which are already preprocessed (pedestal and common mode
+    corrected), e.g. the events of a zero suppressed file.
+    :param signal: The corrected signals: shape = (events, channels)
+    :param SN: The SN: shape = (events, channels)
+    :param CMN: The common mode of the events
+    :param CMsig: The common mode std of the events
+    :param event_timings: The timing of the events
+    :param engine: The clustering engine, "seeds" or "runs" (see CLUSTER_ENGINES)
+    :param buffers: PreprocessBuffers whose clustering scratch arrays are reused,
+                    None allocates them
+    :return: ProcessedChunk, which keeps the passed arrays (pass copies of reused buffers)
+    """
+    # Only events with a channel above SN_cut can have hits and clusters
+    candidates = np.nonzero(nb_seed_scan(SN, SN_cut))[0]
+    scratch = (buffers or PreprocessBuffers(numchan)).cluster_scratch(len(candidates))
+    *results, features = nb_cluster_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster,
+                                           max_clustersize, masking, material,
+                                           CLUSTER_ENGINES[engine], candidates, *scratch)
+    return ProcessedChunk(signal, SN, CMN, CMsig, *results, timing=event_timings,
+                          cluster_table=cluster_table(features, event_timings),
+                          skipped_events=len(SN) - len(candidates))
+
+def cluster_table(features, event_timings):
+    """
+    The cluster records of the features of nb_cluster_events
+    :param features: shape = (clusters, 11)
+    :param event_timings: The timing of the events
+    :return: structured array with CLUSTER_DTYPE: shape = (clusters)
+    """
+    table = np.zeros(len(features), dtype=CLUSTER_DTYPE)
+    for column, name in enumerate(CLUSTER_DTYPE.names[:-1]):
+        table[name] = features[:, column]
+    table["timing"] = np.asarray(event_timings)[table["event"]]
+    return table
+
+def parallel_event_processing(timings, events, pedestal, meanCMN, meanCMsig, noise,
+                              numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize=5,
+                              masking=True, material=1, noisy_strips=(), cm_settings=None,
+                              engine="seeds", out=None, buffers=None):
+    """
+    Preprocesses and clusters the events with the compiled kernels, which process
+    the events in parallel threads. The results do not depend on the number of
+    threads (see set_threads).
+    :param timings: The timing of the events
     :param events: Array of all events: shape = (events, channels)
     :param pedestal: The pedestal: shape = (channels)
     :param meanCMN: A single value with the mean CMN of all events per channels
@@ -100,56 +494,24 @@ def parallel_event_processing(goodtiming, timings, events, pedestal, meanCMN, me
     :param max_clustersize: Maximum
     :param masking: A boolean of automatic masking should be applied
     :param material: Which base material the sensor is. This is needed for the signal polarity
-    :param poolsize: Poolsize of the multiprocessing
-    :param Pool: The actual muzltiprocessing pool
     :param noisy_strips: All noisy/masked strips from the user
-    :return: The processed data
+    :param cm_settings: Settings of the per chip common mode, None for the global common mode
+    :param engine: The clustering engine, "seeds" or "runs" (see CLUSTER_ENGINES)
+    :param out: Arrays for the preprocessed events, see preprocess_events
+    :param buffers: PreprocessBuffers which are reused for the preprocessed events (if
+                    out is not passed) and the clustering scratch, None allocates new arrays
+    :return: ProcessedChunk
 
     Written by Dominic Bloech
     """
-
-    # Get the number of how many good events there are
-    goodevents = goodtiming[0].shape[0]
-    automasked = 0
-    # Slice out all good events
-    events_good = events[goodtiming[0]].astype(np.float32)
-    eventiming = timings[goodtiming[0]].astype(np.float32)
-
-    # Do in the multiprocessed way if poolsize is greater as one
-    if poolsize > 1:
-        # Split data for the pools
-        splits = int(goodevents/poolsize) # you may loose the last event!!!
-        paramslist = []
-        start = 0
-        for i in range(poolsize):
-            end = splits*(i+1)
-            paramslist.append((events_good[start:end], pedestal, meanCMN, meanCMsig,
-                               noise, numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                               masking, material, noisy_strips, eventiming[start:end]))
-            start=end+1
-
-        # Todo: Currently not working due to performance issues
-        #results = Parallel(n_jobs=poolsize, verbose=1, backend='threading', require="sharedmem")(map(delayed(event_process_function_multithread),
-        #                                                                                           paramslist))
-        results = []
-        for i in prange(poolsize):
-            results.append(event_process_function_multithread(paramslist[i]))
-
-        # Build the correct Hitmap which gets lost during calculations
-        hitmap = np.zeros(numchan)
-        for hmap in results:
-            hitmap += hmap[-1][4]
-        prodata = np.concatenate(results, axis=0)
-        # Set the last hit with the full hitmap # I know this is pretty shitty coding style.
-        prodata[-1][4] = hitmap
-        return prodata, automasked
-
-    else:
-        # If no multiprocessing is needed, simply call the event_process_function
-        prodata = event_process_function(events_good, pedestal, meanCMN,
-                                         meanCMsig, noise, numchan, SN_cut, SN_ratio, SN_cluster,
-                                         max_clustersize, masking, material, noisy_strips, eventiming)
-        return np.array(prodata), automasked
+    if out is None and buffers is not None:
+        out = buffers.views(len(events))
+    signal, SN, CMN, CMsig = preprocess_events(events, pedestal, meanCMN, meanCMsig, noise,
+                                               numchan, noisy_strips, cm_settings, out)
+    return cluster_preprocessed_events(signal, SN, CMN, CMsig, noise, numchan, SN_cut,
+                                       SN_ratio, SN_cluster, max_clustersize, masking,
+                                       material, np.array(timings, dtype=np.float32), engine,
+                                       buffers)
 
 @jit(nopython = True, cache=True, nogil=gil, fastmath=Fast)
 def nb_clustering(event, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_clustersize = 5,
@@ -264,115 +626,255 @@ def nb_clustering(event, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_c
     return channels, clusters_list, numclus, np.array(clustersize), automasked_hit
 
 
-jit(nogil=gil, cache=True, nopython=True)
-def nb_noise_calc(events, pedestal, tot_noise=False):
-    """
-    Noise calculation, normal noise (NN) and common mode noise (CMN)
-    Uses numpy black magic
-    :param events: the events
-    :param pedestal: the pedestal
-    :param tot_noise: bool if you want the tot_noise
-    :return:
+# Estimators of the per chip common mode, see nb_chip_common_mode
+CM_METHODS = {"mean": 0, "median": 1, "trimmed": 2}
+CHIP_SIZE = 128  # Channels per Beetle chip
 
-    Written by Dominic Bloech
+def common_mode_settings(configs):
+    """Returns the settings of the per chip common mode from the configs or
+    None if the global common mode over all channels should be used.
+
+    Config params:
+        - common_mode: "global", "mean" (with sigma clipping), "median" or "trimmed"
+        - common_mode_clip: float - sigma clipping of the mean in units of the std
+        - common_mode_iterations: int - iterations of the sigma clipping
+        - common_mode_trim: float - fraction of the strips cut away on each side for the trimmed mean
+    """
+    method = configs.get("common_mode", "global")
+    if method == "global":
+        return None
+    if method not in CM_METHODS:
+        raise ValueError("Unknown common mode method {}, possible are global, {}"
+                         .format(method, ", ".join(CM_METHODS)))
+    return (CM_METHODS[method], float(configs.get("common_mode_clip", 2.5)),
+            int(configs.get("common_mode_iterations", 3)),
+            float(configs.get("common_mode_trim", 0.1)))
+
+def clustering_engine(configs):
+    """Returns the clustering engine of the configs (config param clustering:
+    "seeds" or "runs", see CLUSTER_ENGINES)"""
+    engine = configs.get("clustering", "seeds")
+    if engine not in CLUSTER_ENGINES:
+        raise ValueError("Unknown clustering engine {}, possible are {}"
+                         .format(engine, ", ".join(CLUSTER_ENGINES)))
+    return engine
+
+@jit(nopython=True, cache=True, nogil=gil)
+def nb_sorted_median(values):
+    """Median of the values, sorts them in place instead of copying them"""
+    values.sort()
+    n = len(values)
+    if n % 2:
+        return values[n//2]
+    return (values[n//2 - 1] + values[n//2])/2.
+
+@jit(nopython=True, cache=True, nogil=gil, fastmath=Fast)
+def nb_robust_mean(values, method, clip, iterations, trim):
+    """
+    Robust common mode and its spread of the signals of one chip in one event
+    :param values: The signals of the good strips of the chip, used as scratch
+                   (sorted/overwritten by the median and the trimmed mean)
+    :param method: 0 - mean with sigma clipping, 1 - median, 2 - trimmed mean
+    :param clip: Strips further away than clip*std from the mean are rejected (method 0)
+    :param iterations: Number of sigma clipping iterations (method 0)
+    :param trim: Fraction of strips cut away on each side (method 2)
+    :return: common mode, spread (std of the used strips, for the median 1.4826*MAD)
     """
-    # Calculate the common mode noise for every channel
-    # Get the signal from event and subtract pedestal
-    cm = np.subtract(events, pedestal, dtype=np.float32)
-    # Calculate the common mode
-    keep = np.array(list(range(0,len(events))))
-    for i in range(3): # Go over 3 times to get even the less dominant outliers
-        CMsig = np.std(cm[keep], axis=1)
-        # Now calculate the mean from the cm to get the actual common mode noise
-        CMnoise = np.mean(cm[keep], axis=1)
-        # Find common mode which is lower/higher than 1 sigma
-        keep = np.where(np.logical_and(CMnoise<(CMnoise+2.5*CMsig), CMnoise>(CMnoise-2.5*CMsig)))[0]
-    # Calculate the noise of channels
-    # Subtract the common mode noise --> Signal[arraylike] - pedestal[arraylike] - Common mode
-    score = np.subtract(cm[keep], CMnoise[keep][:,None], dtype=np.float32)
-    # This is a trick with the dimensions of ndarrays, score = shape[ (x,y) - x,1 ]
-    # is possible otherwise a loop is the only way
-    noise = np.std(score, axis=0)
-    noiseNC = np.std(cm[keep], axis=0)
-    if tot_noise is False:
-        return noise, noiseNC, CMnoise, CMsig
-    # convert score matrix into an 1-d array --> np.concatenate(score, axis=0))
-    return noise, noiseNC, CMnoise, CMsig, np.concatenate(score, axis=0)
-
-#jit(nogil=gil, cache=True)
-#def nb_process_event(events, pedestal, meanCMN, meanCMsig, noise, numchan, noisy_strips):
-#    """Processes single events - This is an old version which has been replaces by"""
-#    #TODO: some elusive error happens here when using jit and njit
-#    # Calculate the common mode noise for every channel
-#    signal = events - pedestal  # Get the signal from event and subtract pedestal
-#
-#    signal[noisy_strips] = 0
-#
-#    # Remove channels which have a signal higher then 5*CMsig+CMN which are not representative
-#    removed = np.nonzero(signal < (5. * meanCMsig + meanCMN))
-#    prosignal = signal[removed]
-#
-#    if prosignal.any():
-#        cmpro = np.mean(prosignal)
-#        sigpro = np.std(prosignal)
-#
-#        corrsignal = signal - cmpro
-#        SN = corrsignal / noise
-#
-#        return corrsignal, SN, cmpro, sigpro
-#    else:
-#        return np.zeros(numchan), np.zeros(numchan), 0., 0.  # A default value return if everything fails
-
-jit(nogil=gil,cache=True, nopython=True, fastmath=Fast)
-def nb_preprocess_all_events(events, pedestal, meanCMN, meanCMsig, noise, numchan, noisy_strips):
-    """
-    Preprocesses all events and makes some clean-up on the signals.
-    It calculates the SN for every events per channel and the CMN, CMNsig for every event.
-    Furthermore it will return you the pure signal without pedestal, CMN etc.
-
-    Warning: This function uses numpy black magic, if you are confused how a calculate things here,
-             Please read a good introduction to numpy array operations =). But simply put I apply an
-             operation usually to a whole array divisions are such a things. Every value in both
-             arrays will be divided separately etc.
-
-    :param events: All events shape = (events, channels)
+    n = len(values)
+    if method == 1:
+        median = nb_sorted_median(values)
+        for k in range(n):
+            values[k] = abs(values[k] - median)
+        return median, 1.4826*nb_sorted_median(values)
+    if method == 2:
+        values.sort()
+        cut = int(trim*n)
+        if 2*cut >= n:
+            cut = (n-1)//2
+        kept = values[cut:n-cut]
+        return np.mean(kept), np.std(kept)
+
+    mean = np.mean(values)
+    std = np.std(values)
+    used = n
+    for _ in range(iterations):
+        total = 0.
+        square = 0.
+        count = 0
+        for value in values:
+            if abs(value - mean) <= clip*std:
+                total += value
+                square += value*value
+                count += 1
+        if count == 0 or count == used:
+            break
+        used = count
+        mean = total/count
+        std = np.sqrt(max(square/count - mean*mean, 0.))
+    return mean, std
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel, fastmath=Fast)
+def nb_chip_common_mode(events, pedestal, good, chip_size, method, clip, iterations, trim):
+    """
+    Common mode of every Beetle chip in every event, calculated only from the
+    good strips of the chip. The events are processed in parallel blocks of
+    EVENT_BLOCK events, every block reuses one scratch array for the signals.
+    :param events: The raw events: shape = (events, channels)
+    :param pedestal: The pedestal: shape = (channels)
+    :param good: Bool array, True for the good strips: shape = (channels)
+    :param chip_size: Number of channels per chip
+    :param method, clip, iterations, trim: See nb_robust_mean
+    :return: CMN, CMsig: shape = (events, chips), 0 for chips without good strips
+    """
+    nevents, numchan = events.shape
+    nchips = numchan//chip_size
+    CMN = np.zeros((nevents, nchips), dtype=np.float32)
+    CMsig = np.zeros((nevents, nchips), dtype=np.float32)
+    nblocks = (nevents + EVENT_BLOCK - 1)//EVENT_BLOCK
+    for block in prange(nblocks):
+        values = np.empty(chip_size, dtype=np.float64)
+        for i in range(block*EVENT_BLOCK, min((block+1)*EVENT_BLOCK, nevents)):
+            for chip in range(nchips):
+                n = 0
+                for ch in range(chip*chip_size, (chip+1)*chip_size):
+                    if good[ch]:
+                        values[n] = events[i, ch] - pedestal[ch]
+                        n += 1
+                if n:
+                    cm, sig = nb_robust_mean(values[:n], method, clip, iterations, trim)
+                    CMN[i, chip] = cm
+                    CMsig[i, chip] = sig
+    return CMN, CMsig
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel, fastmath=Fast)
+def nb_preprocess_chips_into(events, pedestal, noise, good, chip_size, method, clip, iterations,
+                             trim, signal, SN, CMN, CMsig):
+    """
+    The per chip version of nb_preprocess_events: Subtracts the pedestal and
+    the robust common mode of the chip (see nb_chip_common_mode) from every
+    strip and calculates the SN in one loop over the events (parallel blocks of
+    EVENT_BLOCK events with one scratch array each). The results are
+    written into the passed arrays, the strips which are not good (noisy,
+    masked) are set to 0.
+    :param events: The raw events: shape = (events, channels)
     :param pedestal: The pedestal: shape = (channels)
-    :param meanCMN: The mean CMN
-    :param meanCMsig: The mean CMNsig
     :param noise: The noise per channel: shape = (channels)
-    :param numchan: The number of channels
-    :param noisy_strips: The noisy strips: shape = (channels)
-    :return: corrsignal - signal without the garbage: shape = (events, channels)
-             SN - Signal to noise: shape = (events)
-             CMN - Common mode for every event: shape = (events)
-             CMsig - Common mode std for every event: shape = (events)
-
-    Written by Dominic Bloech
+    :param good: Bool array, True for the good strips: shape = (channels)
+    :param chip_size: Number of channels per chip
+    :param method, clip, iterations, trim: See nb_robust_mean
+    :param signal: Output, corrected signal: shape = (events, channels)
+    :param SN: Output, signal to noise: shape = (events, channels)
+    :param CMN, CMsig: Output, mean over the chips with good strips: shape = (events)
     """
-    #Calculate the common mode noise for every channel
-    signal = events - pedestal  # Get the signal from event and subtract pedestal
-
-    # Remove channels which have a signal higher then 5*CMsig+CMN which are not representative
-    removed = np.nonzero(signal[:,] > (5. * meanCMsig + meanCMN))
-    signal[removed[0], removed[1]] = 0 # Set the signals to 0
-    prosignal = signal
-
-    if prosignal.any():
-        # Calculate the mean CMN and CMNsig
-        cmpro = np.mean(prosignal, axis=1)
-        sigpro = np.std(prosignal, axis=1)
-
-        # Subtract the CMN for all channels
-        corrsignal = signal - cmpro[:,None]
-        # Get rid of noisy strips by setting the signal to 0 which are not needed for further calculations
-        corrsignal[:, noisy_strips] = 0
-        # Calculate the actuall SN
-        SN = corrsignal / noise
-
-        return corrsignal, SN, cmpro, sigpro
-    else:
-        return np.zeros(numchan), np.zeros(numchan), 0., 0.  # A default value return if everything fails
-
+    nevents, numchan = events.shape
+    nchips = numchan//chip_size
+    nactive = 0
+    for chip in range(nchips):
+        for ch in range(chip*chip_size, (chip+1)*chip_size):
+            if good[ch]:
+                nactive += 1
+                break
+    nactive = max(nactive, 1)
+
+    nblocks = (nevents + EVENT_BLOCK - 1)//EVENT_BLOCK
+    for block in prange(nblocks):
+        values = np.empty(chip_size, dtype=np.float64)
+        for i in range(block*EVENT_BLOCK, min((block+1)*EVENT_BLOCK, nevents)):
+            # The chip common modes are rounded to float32 like in nb_chip_common_mode
+            cmn = np.float32(0.)
+            cmsig = np.float32(0.)
+            for chip in range(nchips):
+                n = 0
+                for ch in range(chip*chip_size, (chip+1)*chip_size):
+                    if good[ch]:
+                        values[n] = events[i, ch] - pedestal[ch]
+                        n += 1
+                cm = np.float32(0.)
+                if n:
+                    robust_cm, robust_sig = nb_robust_mean(values[:n], method, clip, iterations,
+                                                           trim)
+                    cm = np.float32(robust_cm)
+                    cmn = np.float32(cmn + cm/nactive)
+                    cmsig = np.float32(cmsig + np.float32(robust_sig)/nactive)
+                for ch in range(chip*chip_size, (chip+1)*chip_size):
+                    if good[ch]:
+                        signal[i, ch] = events[i, ch] - pedestal[ch] - cm
+                        SN[i, ch] = signal[i, ch]/noise[ch]
+                    else:
+                        signal[i, ch] = 0.
+                        SN[i, ch] = 0.
+            CMN[i] = cmn
+            CMsig[i] = cmsig
+
+def nb_preprocess_chips(events, pedestal, noise, good, chip_size, method, clip, iterations, trim):
+    """
+    nb_preprocess_chips_into with newly allocated output arrays
+    :return: corrsignal: shape = (events, channels)
+             SN: shape = (events, channels)
+             CMN, CMsig: mean over the chips with good strips: shape = (events)
+    """
+    nevents, numchan = events.shape
+    corrsignal = np.empty((nevents, numchan), dtype=np.float64)
+    SN = np.empty((nevents, numchan), dtype=np.float64)
+    CMN = np.empty(nevents, dtype=np.float32)
+    CMsig = np.empty(nevents, dtype=np.float32)
+    nb_preprocess_chips_into(events, pedestal, noise, good, chip_size, method, clip, iterations,
+                             trim, corrsignal, SN, CMN, CMsig)
+    return corrsignal, SN, CMN, CMsig
+
+def good_strip_mask(numchan, noisy_strips):
+    """Bool array which is True for all strips which are not noisy/masked"""
+    good = np.ones(numchan, dtype=np.bool_)
+    good[np.asarray(noisy_strips, dtype=np.int64)] = False
+    return good
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel)
+def nb_polyval_channels(signals, channels, coeff):
+    """Evaluates the polynomial of the channel of every signal with the Horner
+    scheme like np.polyval, the results are in the order of the signals
+
+    :param signals: The abs values of the signals: shape = (hits)
+    :param channels: The channel of every signal: shape = (hits)
+    :param coeff: Polynomial coefficients of every channel, highest power first: shape = (channels, degree+1)
+    :return: abs value of the polynomials: shape = (hits)
+    """
+    result = np.empty(len(signals))
+    for i in prange(len(signals)):
+        value = 0.
+        for k in range(coeff.shape[1]):
+            value = value*signals[i] + coeff[channels[i], k]
+        result[i] = abs(value)
+    return result
+
+@jit(nopython=True, cache=True, nogil=gil, parallel=parallel)
+def nb_table_channels(signals, channels, table, step, coeff, tabulated):
+    """Looks up the polynomial of the channel of every signal in its table
+    with linear interpolation. Signals beyond the table and signals of
+    channels which are not tabulated are evaluated with the Horner scheme
+    like nb_polyval_channels
+
+    :param signals: The abs values of the signals: shape = (hits)
+    :param channels: The channel of every signal: shape = (hits)
+    :param table: Values of the polynomials at 0, step, 2*step, ...: shape = (channels, entries)
+    :param step: Step of the tables
+    :param coeff: Polynomial coefficients of every channel, highest power first: shape = (channels, degree+1)
+    :param tabulated: Bool array, False for the channels whose table is not used: shape = (channels)
+    :return: abs value of the polynomials: shape = (hits)
+    """
+    result = np.empty(len(signals))
+    last = table.shape[1] - 1
+    for i in prange(len(signals)):
+        position = signals[i]/step
+        if position < last and tabulated[channels[i]]:
+            k = int(position)
+            value = table[channels[i], k] + (position-k)*(table[channels[i], k+1] -
+                                                          table[channels[i], k])
+        else:
+            value = 0.
+            for k in range(coeff.shape[1]):
+                value = value*signals[i] + coeff[channels[i], k]
+        result[i] = abs(value)
+    return result
 
 @jit(nopython=False, nogil=True, cache=True)
 def nb_process_cluster_size(args):
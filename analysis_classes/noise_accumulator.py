@@ -0,0 +1,246 @@
+"""This file contains the streaming accumulator for the pedestal and noise
+calculation. All statistics are collected in one pass over the events with
+memory independent of the number of events (except the per event common mode).
+Accumulators of different chunks or files can be merged exactly (Chan et al.),
+so pedestal runs can be combined or processed in parallel."""
+# pylint: disable=C0103,R0902
+import numpy as np
+from analysis_classes.nb_analysis_funcs import nb_chip_common_mode, CHIP_SIZE
+
+
+class NoiseAccumulator:
+    """Accumulates the mean and the variance of all channels with the pairwise
+    update of Chan et al. The common mode corrected noise of the channels of a
+    set of channels is exact with the covariance of every channel with the
+    common mode of the set, which is accumulated for all channels, the
+    cm_channels and the noise_channels. This costs O(events*channels) for every
+    set. The full covariance matrix (O(events*channels^2)) is only accumulated
+    on request, from it the noise can be calculated for any set of channels, so
+    the noisy strips do not have to be known during the pass.
+
+    The per event common mode (CMN, CMsig) and the noise histogram need the
+    pedestal while the events are read. They are taken relative to a reference
+    pedestal (the mean of the first chunk) and the CMN is corrected exactly
+    with the final pedestal in the end. For CMsig the correction neglects the
+    correlation of the pedestal deviation and the noise of the single event,
+    which is below the precision of the ADC. If a reference pedestal is passed,
+    both are exact. The common mode of the events is calculated over the
+    cm_channels, which have to be known before the pass.
+
+    With cm_settings the robust common mode of every chip (see
+    nb_chip_common_mode) is collected in the same pass. It is corrected with
+    the mean pedestal deviation of the cm_channels of the chip, which is
+    exact for the mean and approximate for the robust estimators (the
+    deviation of the reference pedestal is about noise/sqrt(chunk size)).
+
+    Usage:
+        acc = NoiseAccumulator(256)
+        for chunk in source.chunks():
+            acc.add(chunk.signal)
+        noise, noiseNC = acc.noise(good_strips)
+    """
+    def __init__(self, numchan=256, cm_channels=None, hist_bins=500, hist_range=(-50., 50.),
+                 reference=None, covariance=False, cm_settings=None, noise_channels=()):
+        """
+        :param numchan: Number of channels
+        :param cm_channels: Channels used for the per event common mode, default all
+        :param hist_bins: Number of bins of the noise histogram
+        :param hist_range: (min, max) of the noise histogram in ADC
+        :param reference: A known pedestal, then the per event common mode is exact
+        :param covariance: Accumulate the covariance matrix, needed for the noise
+                           of sets of channels which are not known before the pass
+        :param cm_settings: Settings of the per chip common mode (see common_mode_settings),
+                            None does not collect it
+        :param noise_channels: Further sets of channels for which the common mode
+                               corrected noise is accumulated
+        """
+        self.numchan = numchan
+        self.cm_channels = np.arange(numchan) if cm_channels is None \
+            else np.asarray(cm_channels, dtype=np.int64)
+        self.hist_edges = np.linspace(hist_range[0], hist_range[1], hist_bins+1)
+        self.numevents = 0
+        self.mean = np.zeros(numchan, dtype=np.float64)
+        # Sum of the squared deviations of every channel
+        self.M2 = np.zeros(numchan, dtype=np.float64)
+        # The sets of channels of the common mode corrected noise and, for every
+        # set, the sum of the products of the deviations of every channel and of
+        # the common mode of the set and the sum of the squared deviations of the
+        # common mode of the set
+        self.noise_sets = [np.arange(numchan), self.cm_channels] + \
+            [np.asarray(channels, dtype=np.int64) for channels in noise_channels]
+        self.cross = np.zeros((len(self.noise_sets), numchan), dtype=np.float64)
+        self.cm_M2 = np.zeros(len(self.noise_sets), dtype=np.float64)
+        # The sum of the outer products of the deviations of the channels
+        self.C2 = np.zeros((numchan, numchan), dtype=np.float64) if covariance else None
+        self.hist = np.zeros((numchan, hist_bins), dtype=np.int64)
+        self.reference = None if reference is None else np.asarray(reference, dtype=np.float64)
+        # (reference pedestal, per event moments) of every added chunk, the
+        # moments are mean and mean square of signal-reference over all
+        # channels and over the cm_channels
+        self.segments = []
+        # The per chip common mode and its spread of every added chunk:
+        # shape = (events, chips), relative to the reference pedestal of the segment
+        self.cm_settings = cm_settings
+        self.chip_segments = []
+
+    @property
+    def pedestal(self):
+        """The pedestal (mean signal) of every channel"""
+        return self.mean
+
+    def _merge_moments(self, numevents, mean, M2, cross, cm_M2, C2):
+        """Merges the mean and the sums of the (products of the) deviations
+        (see __init__) of other events into the accumulator"""
+        total = self.numevents + numevents
+        if not numevents:
+            return
+        delta = mean - self.mean
+        weight = self.numevents*numevents/total
+        cm_delta = np.array([delta[channels].mean() for channels in self.noise_sets])
+        self.M2 += M2 + np.square(delta)*weight
+        self.cross += cross + np.outer(cm_delta, delta)*weight
+        self.cm_M2 += cm_M2 + np.square(cm_delta)*weight
+        if self.C2 is not None:
+            self.C2 += C2 + np.outer(delta, delta)*weight
+        self.mean += delta*numevents/total
+        self.numevents = total
+
+    def add(self, signal):
+        """Adds a chunk of events: shape = (events, channels)"""
+        signal = np.asarray(signal, dtype=np.float64)
+        if not len(signal):
+            return self
+        if self.reference is None:
+            self.reference = signal.mean(axis=0)
+
+        chunk_mean = signal.mean(axis=0)
+        centered = signal - chunk_mean
+        cm = np.column_stack([centered[:, channels].mean(axis=1) for channels in self.noise_sets])
+        self._merge_moments(len(signal), chunk_mean, np.square(centered).sum(axis=0),
+                            cm.T @ centered, np.square(cm).sum(axis=0),
+                            None if self.C2 is None else centered.T @ centered)
+
+        # Per event moments relative to the reference pedestal
+        y = signal - self.reference
+        y_cm = y[:, self.cm_channels]
+        moments = np.column_stack((y.mean(axis=1), np.square(y).mean(axis=1),
+                                   y_cm.mean(axis=1), np.square(y_cm).mean(axis=1)))
+        self.segments.append((self.reference, moments))
+        if self.cm_settings is not None:
+            good = np.zeros(self.numchan, dtype=np.bool_)
+            good[self.cm_channels] = True
+            self.chip_segments.append(nb_chip_common_mode(signal, self.reference, good, CHIP_SIZE,
+                                                          *self.cm_settings))
+
+        # Histogram of the common mode corrected signals of every channel
+        y -= moments[:, 2][:, None]
+        nbins = len(self.hist_edges)-1
+        width = self.hist_edges[1]-self.hist_edges[0]
+        bins = np.floor((y - self.hist_edges[0])/width).astype(np.int64)
+        valid = np.logical_and(bins >= 0, bins < nbins)
+        bins += np.arange(self.numchan)*nbins
+        self.hist += np.bincount(bins[valid], minlength=self.numchan*nbins).reshape(self.numchan, nbins)
+        return self
+
+    def merge(self, other):
+        """Merges the events of another accumulator, the events of other are
+        appended after the events of this one"""
+        if other.numchan != self.numchan or \
+                not np.array_equal(other.cm_channels, self.cm_channels) or \
+                not np.array_equal(other.hist_edges, self.hist_edges) or \
+                other.cm_settings != self.cm_settings or \
+                (other.C2 is None) != (self.C2 is None) or \
+                len(other.noise_sets) != len(self.noise_sets) or \
+                not all(np.array_equal(a, b) for a, b in zip(other.noise_sets, self.noise_sets)):
+            raise ValueError("Only accumulators with the same channels, histogram, common "
+                             "mode settings and noise channels can be merged")
+        self._merge_moments(other.numevents, other.mean, other.M2, other.cross, other.cm_M2,
+                            other.C2)
+        self.hist += other.hist
+        self.segments.extend(other.segments)
+        self.chip_segments.extend(other.chip_segments)
+        if self.reference is None:
+            self.reference = other.reference
+        return self
+
+    def covariance(self):
+        """The covariance matrix of the channels (needs covariance)"""
+        if self.C2 is None:
+            raise ValueError("The covariance matrix is only accumulated with covariance")
+        return self.C2/max(self.numevents, 1)
+
+    def noise(self, channels):
+        """Noise of the channels with the common mode of these channels
+        subtracted event by event and without the common mode subtraction.
+        This is exactly the std of signal-pedestal-common mode. The channels
+        must be all channels, the cm_channels or one of the noise_channels,
+        other channels need the covariance matrix.
+
+        :param channels: The channels which are considered
+        :return: noise, noiseNC (only the passed channels long)
+        """
+        channels = np.asarray(channels, dtype=np.int64)
+        if not len(channels):
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32)
+        numevents = max(self.numevents, 1)
+        variance = self.M2[channels]/numevents
+        for index, noise_set in enumerate(self.noise_sets):
+            if np.array_equal(noise_set, channels):
+                # Var(x_c - cm) = Var(x_c) - 2 Cov(x_c, cm) + Var(cm)
+                var = variance - 2*self.cross[index, channels]/numevents + self.cm_M2[index]/numevents
+                break
+        else:
+            if self.C2 is None:
+                raise ValueError("The common mode corrected noise of these channels was not "
+                                 "accumulated, pass them as noise_channels or use covariance")
+            cov = self.covariance()[np.ix_(channels, channels)]
+            var = variance - 2*cov.sum(axis=1)/len(channels) + cov.sum()/len(channels)**2
+        noise = np.sqrt(np.maximum(var, 0)).astype(np.float32)
+        noiseNC = np.sqrt(np.maximum(variance, 0)).astype(np.float32)
+        return noise, noiseNC
+
+    def common_mode(self, raw=False):
+        """The common mode and its std of every event
+
+        :param raw: Over all channels instead of the cm_channels
+        :return: CMnoise, CMsig: shape = (events)
+        """
+        channels = np.arange(self.numchan) if raw else self.cm_channels
+        first = 0 if raw else 2
+        CMnoise, CMsig = [np.zeros(0, dtype=np.float32)], [np.zeros(0, dtype=np.float32)]
+        for reference, moments in self.segments:
+            delta = self.mean[channels] - reference[channels]
+            d1, d2 = delta.mean(), np.square(delta).mean()
+            CMN = moments[:, first] - d1
+            # mean((y-delta)^2) with mean(y*delta) ~ mean(delta^2) + CMN*mean(delta)
+            var = moments[:, first+1] - d2 - 2*CMN*d1 - np.square(CMN)
+            CMnoise.append(CMN.astype(np.float32))
+            CMsig.append(np.sqrt(np.maximum(var, 0)).astype(np.float32))
+        return np.concatenate(CMnoise), np.concatenate(CMsig)
+
+    def chip_common_mode(self):
+        """The per chip common mode and its spread of every event, averaged
+        over the chips with cm_channels (needs cm_settings)
+
+        :return: CMnoise, CMsig: shape = (events)
+        """
+        if self.cm_settings is None:
+            raise ValueError("The per chip common mode is only collected with cm_settings")
+        good = np.zeros(self.numchan, dtype=np.bool_)
+        good[self.cm_channels] = True
+        good = good.reshape(-1, CHIP_SIZE)
+        active = good.any(axis=1)
+        CMnoise, CMsig = [np.zeros(0, dtype=np.float32)], [np.zeros(0, dtype=np.float32)]
+        for (reference, _), (chipCMN, chipCMsig) in zip(self.segments, self.chip_segments):
+            delta = (self.mean - reference).reshape(-1, CHIP_SIZE)
+            chip_delta = np.sum(delta*good, axis=1)/np.maximum(np.sum(good, axis=1), 1)
+            CMnoise.append(np.mean(chipCMN[:, active] - chip_delta[active].astype(np.float32), axis=1))
+            CMsig.append(np.mean(chipCMsig[:, active], axis=1))
+        return np.concatenate(CMnoise), np.concatenate(CMsig)
+
+    def noise_histogram(self, channels):
+        """Histogram of the common mode corrected signals of the channels
+
+        :return: counts, bin edges
+        """
+        return self.hist[np.asarray(channels, dtype=np.int64)].sum(axis=0), self.hist_edges
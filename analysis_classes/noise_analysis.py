@@ -5,8 +5,20 @@ import pdb
 from time import time
 import numpy as np
 from tqdm import tqdm
-from analysis_classes.nb_analysis_funcs import nb_noise_calc
-from analysis_classes.utilities import import_h5, read_binary_Alibava
+from analysis_classes.event_source import open_event_source
+from analysis_classes.noise_accumulator import NoiseAccumulator
+from analysis_classes.nb_analysis_funcs import common_mode_settings, CHIP_SIZE
+from analysis_classes.result_cache import ResultCache
+from analysis_classes.utilities import set_attributes
+
+# The config keys the results depend on
+NOISE_CACHE_KEYS = ("Noise_cut", "Chips", "Manual_mask", "numChan", "single_pass_noise",
+                    "common_mode", "common_mode_clip", "common_mode_iterations", "common_mode_trim")
+# The results which are cached
+CACHED_ATTRIBUTES = ("numchan", "numevents", "noise_cut", "pedestal", "noise", "noiseNCM",
+                     "noise_raw", "noiseNCM_raw", "CMnoise", "CMsig", "CMnoise_raw", "CMsig_raw",
+                     "noisy_strips", "good_strips", "median_noise", "chip_selection",
+                     "masked_channels")
 
 class NoiseAnalysis:
     """This class contains all calculations and data concerning pedestals in
@@ -18,18 +30,23 @@ class NoiseAnalysis:
         self.log = logger or logging.getLogger(__class__.__name__)
 
         self.log.info("Loading pedestal file: %s", path)
-        if not configs["isBinary"]:
-            self.data = import_h5(path)
-        else:
-            self.data = read_binary_Alibava(path)
+        self.cache = ResultCache.from_configs(configs)
+        self.cache_key = self.cache.key(__class__.__name__, path, configs, NOISE_CACHE_KEYS)
+        state = self.cache.get(self.cache_key)
+        if state is not None:
+            self.log.info("Using the cached pedestal and noise of %s", path)
+            self.restore_state(state)
+            self.data = None
+            return
+        self.data = open_event_source(path, configs)
 
         if self.data:
             # Some of the declaration may seem unecessary but it clears things
             # up when you need to know how big some arrays are
 
-            # self.data["events"]["signal"][0] -> array of signals of 0th event of all channels
-            self.numchan = len(self.data["events"]["signal"][0])
-            self.numevents = len(self.data["events"]["signal"])
+            # The events are never loaded at once, they are read in chunks from the event source
+            self.numchan = self.data.numchan
+            self.numevents = self.data.numevents
             self.pedestal = np.zeros(self.numchan, dtype=np.float32)
             self.noise = np.zeros(self.numchan, dtype=np.float32)
             self.noiseNCM = np.zeros(self.numchan, dtype=np.float32)
@@ -39,37 +56,55 @@ class NoiseAnalysis:
             self.which_strips = configs.get("Chips", (1, 2))
             self.max_channels = configs.get("numChan", 256)
             self.mask = configs.get("Manual_mask", [])
-            self.goodevents = np.nonzero(self.data["events"]["time"][:] >= 0)
+            self.cm_settings = common_mode_settings(configs)
+            self.goodevents = np.nonzero(self.data.read_field("time") >= 0)
             self.CMnoise = np.zeros(self.numchan, dtype=np.float32)
             self.CMnoise_raw = np.zeros(self.numchan, dtype=np.float32)
             self.CMsig = np.zeros(self.numchan, dtype=np.float32)
             self.CMsig_raw = np.zeros(self.numchan, dtype=np.float32)
-            self.score = np.zeros((len(self.goodevents[0]), self.numchan),
-                                  dtype=np.float32)
             self.median_noise = None
 
-            # Calculate pedestal
+            # Mask chips of alibava
+            self.chip_selection, self.masked_channels = \
+                    self.mask_alibava_chips(self.which_strips, self.max_channels)
+
+            # Calculate pedestal, noise and common mode in one pass over the events
             self.log.info("Calculating pedestal and Noise...")
+            single_pass = configs.get("single_pass_noise", False)
+            # In a single pass the good strips are not known before, their noise
+            # needs the covariance matrix of the channels
+            self.accumulator = self.accumulate(np.setdiff1d(self.chip_selection, self.mask),
+                                               covariance=single_pass,
+                                               cm_settings=self.cm_settings if single_pass else None)
             # mean signal per channel over all events
-            self.pedestal = np.mean(self.data["events"]["signal"][0:], axis=0)
-            # complete signal matrix (event vs. channel)
-            self.signal = np.array(self.data["events"]["signal"][:], dtype=np.float32)
-
+            self.pedestal = self.accumulator.pedestal
 
             # First Noise calculation without masking to get an idea of the data
-            self.noise_raw, self.noiseNCM_raw, self.CMnoise_raw, self.CMsig_raw = \
-                    nb_noise_calc(self.signal, self.pedestal)
+            self.noise_raw, self.noiseNCM_raw = self.accumulator.noise(np.arange(self.numchan))
+            self.CMnoise_raw, self.CMsig_raw = self.accumulator.common_mode(raw=True)
             self.noisy_strips, self.good_strips = \
                         self.detect_noisy_strips(self.noise_raw, self.noise_cut)
-            # Mask chips of alibava
-            self.chip_selection, self.masked_channels = \
-                    self.mask_alibava_chips(self.which_strips, self.max_channels)
             # Redefine good strips and noisy strips
             self.good_strips = np.intersect1d(self.chip_selection, self.good_strips)
             self.noisy_strips = np.append(self.noisy_strips,self.masked_channels)
-            noise_corr, noiseNCM_corr, self.CMnoise, self.CMsig, self.total_noise = \
-                        nb_noise_calc(self.signal[:, self.good_strips],
-                                      self.pedestal[self.good_strips], True)
+            common_mode = self.accumulator
+            if not single_pass and (self.cm_settings is not None or
+                                    not np.array_equal(self.good_strips, self.accumulator.cm_channels)):
+                # The common mode of the events must not contain the noisy strips,
+                # which are only known now. Get it (and the per chip common mode)
+                # with a second pass, see single_pass_noise in the README
+                common_mode = self.accumulate(self.good_strips, reference=self.pedestal,
+                                              cm_settings=self.cm_settings,
+                                              noise_channels=self.chip_channels(self.good_strips)
+                                              if self.cm_settings is not None else ())
+            # Histogram of the common mode corrected signals of the good strips: counts, bin edges
+            self.noise_hist = common_mode.noise_histogram(self.good_strips)
+            if self.cm_settings is None:
+                noise_corr, noiseNCM_corr = common_mode.noise(self.good_strips)
+                self.CMnoise, self.CMsig = common_mode.common_mode()
+            else:
+                noise_corr, noiseNCM_corr = self.chip_noise(self.good_strips, common_mode)
+                self.CMnoise, self.CMsig = common_mode.chip_common_mode()
 
             # self.noise is only the non masked strips long. Make it to the full 256 strips long array so we can use it
             # Insert the correct noise for the masked strips and for all else insert np.nan --> This way it raises an error
@@ -83,12 +118,25 @@ class NoiseAnalysis:
                 else:
                     self.noise[i] = np.nan
                     self.noiseNCM[i] = np.nan
-
+            self.cache.put(self.cache_key, self.cache_state())
 
 
         else:
             self.log.warning("No valid file, skipping pedestal run")
 
+    def cache_state(self):
+        """The results as dict of arrays for the ResultCache"""
+        state = {name: getattr(self, name) for name in CACHED_ATTRIBUTES}
+        state["noise_hist_counts"], state["noise_hist_edges"] = self.noise_hist
+        return state
+
+    def restore_state(self, state):
+        """Sets the results from a state of the ResultCache"""
+        self.noise_hist = (state.pop("noise_hist_counts"), state.pop("noise_hist_edges"))
+        set_attributes(self, state)
+        self.numchan, self.numevents = int(self.numchan), int(self.numevents)
+        self.noise_cut, self.median_noise = float(self.noise_cut), float(self.median_noise)
+
     def mask_alibava_chips(self, chips_to_keep=(1,2), max_channels = 256):
         """Defines which chips should be considered"""
         final_channels = np.array([], dtype=np.int)
@@ -116,6 +164,50 @@ class NoiseAnalysis:
 
         return high_noise_strips.astype(np.int64), good_strips.astype(np.int64)
 
+    def accumulate(self, cm_channels, reference=None, covariance=False, cm_settings=None,
+                   noise_channels=()):
+        """Collects all statistics of the pedestal run chunk by chunk in a
+        NoiseAccumulator. Only the accumulated sums are kept in memory.
+
+        :param cm_channels: The channels used for the common mode of the events
+        :param reference: A known pedestal, see NoiseAccumulator
+        :param covariance: Accumulate the covariance of the channels
+        :param cm_settings: Collect the per chip common mode with these settings
+        :param noise_channels: Further sets of channels for the noise, see NoiseAccumulator
+        :return: NoiseAccumulator
+        """
+        accumulator = NoiseAccumulator(self.numchan, cm_channels=cm_channels,
+                                       reference=reference, covariance=covariance,
+                                       cm_settings=cm_settings, noise_channels=noise_channels)
+        for chunk in self.data.chunks():
+            accumulator.add(chunk.signal)
+        return accumulator
+
+    def chip_channels(self, channels):
+        """The (sorted) channels split by chip
+
+        :return: list of the channels of every chip
+        """
+        channels = np.asarray(channels, dtype=np.int64)
+        return [channels[channels//CHIP_SIZE == chip] for chip in range(self.numchan//CHIP_SIZE)]
+
+    def chip_noise(self, channels, accumulator):
+        """Noise of the channels with the common mode of every chip subtracted
+        separately. The noise is calculated with the mean of the channels of
+        the chip as common mode, also for the robust estimators.
+
+        :param channels: The (sorted) channels which are considered
+        :param accumulator: NoiseAccumulator with the channels of every chip as
+                            noise_channels or with the covariance
+        :return: noise, noiseNC (only the passed channels long)
+        """
+        noise, noiseNC = [], []
+        for chip_channels in self.chip_channels(channels):
+            chip_noise, chip_noiseNC = accumulator.noise(chip_channels)
+            noise.append(chip_noise)
+            noiseNC.append(chip_noiseNC)
+        return np.concatenate(noise), np.concatenate(noiseNC)
+
     def noise_calc(self, events, pedestal, numevents,
                    numchannels, tot_noise=False):
         """Noise calculation of normal noise (NN) and common mode noise (CMN).
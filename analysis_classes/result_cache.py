@@ -0,0 +1,176 @@
+"""This file contains the cache of the pedestal and calibration results. The
+same pedestal and charge scan files are usually paired with many measurement
+runs, with the cache the NoiseAnalysis and the Calibration of a file are only
+calculated once. The results are kept in memory for the running process and,
+if a cache folder is configured, on disk for later analyses.
+
+The key of a result is built from a fingerprint of the file(s) and the values
+of the config keys the result depends on, so a changed file or config gives a
+new key and old entries simply age out of the cache."""
+# pylint: disable=C0103
+import hashlib
+import json
+import logging
+import os
+from time import time
+import numpy as np
+
+LOG = logging.getLogger("result_cache")
+
+CACHE_VERSION = 4  # Increase if the cached results of the analysis change
+FINGERPRINT_SAMPLES = 8  # Number of blocks read from every file for the fingerprint
+FINGERPRINT_BLOCK = 65536  # Size of these blocks in bytes
+
+
+def file_fingerprint(path):
+    """Fast content fingerprint of a file (or a list of files): the size and
+    some blocks spread over the file are hashed, the file is not read completely.
+
+    :param path: Path of the file or list of paths
+    :return: Hex digest
+    """
+    digest = hashlib.sha1()
+    for part in path if isinstance(path, (list, tuple)) else [path]:
+        size = os.path.getsize(part)
+        digest.update(str(size).encode())
+        with open(part, "rb") as f:
+            for position in np.linspace(0, max(size-FINGERPRINT_BLOCK, 0), FINGERPRINT_SAMPLES):
+                f.seek(int(position))
+                digest.update(f.read(FINGERPRINT_BLOCK))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Cache of the results of the NoiseAnalysis and the Calibration. The
+    results are dicts of numpy arrays and numbers, which are kept in memory
+    (shared by all caches of the process) and written as npz files to the
+    cache folder. The folder is kept below a maximum size and entries which
+    were not used for a certain time are removed.
+
+    Usage:
+        cache = ResultCache.from_configs(configs)
+        key = cache.key("NoiseAnalysis", path, configs, ("Noise_cut",))
+        state = cache.get(key)
+        if state is None:
+            state = calculate()
+            cache.put(key, state)
+    """
+    _memory = {}  # key: state of all results of the running process
+
+    def __init__(self, folder="", max_size_MB=1000., max_age_days=30., enabled=True):
+        """
+        :param folder: Folder of the disk cache, empty for a memory only cache
+        :param max_size_MB: Maximum size of all files in the cache folder
+        :param max_age_days: Files not used for this many days are removed
+        :param enabled: If False, nothing is cached at all
+        """
+        self.folder = os.path.normpath(folder) if folder else ""
+        self.max_size = max_size_MB*1e6
+        self.max_age = max_age_days*86400.
+        self.enabled = enabled
+        if self.folder and self.enabled:
+            os.makedirs(self.folder, exist_ok=True)
+
+    @classmethod
+    def from_configs(cls, configs):
+        """The cache as configured by result_cache, result_cache_folder,
+        result_cache_size_MB and result_cache_max_age_days"""
+        return cls(folder=configs.get("result_cache_folder", ""),
+                   max_size_MB=configs.get("result_cache_size_MB", 1000.),
+                   max_age_days=configs.get("result_cache_max_age_days", 30.),
+                   enabled=configs.get("result_cache", True))
+
+    def key(self, kind, path, configs, config_keys, *arrays):
+        """The key of a result
+
+        :param kind: Name of the result, e.g. the class name
+        :param path: File(s) the result is calculated from
+        :param configs: The configs
+        :param config_keys: The config keys the result depends on
+        :param arrays: Further input arrays the result depends on
+        :return: The key or None if the file cannot be read (nothing is cached then)
+        """
+        if not self.enabled or not path:
+            return None
+        try:
+            fingerprint = file_fingerprint(path)
+        except OSError:
+            return None
+        description = {"kind": kind, "version": CACHE_VERSION, "file": fingerprint,
+                       "configs": {key: configs.get(key) for key in sorted(config_keys)}}
+        digest = hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode())
+        for array in arrays:
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        return "{}_{}".format(kind, digest.hexdigest())
+
+    def _file(self, key):
+        """Path of the cache file of a key"""
+        return os.path.join(self.folder, key + ".npz")
+
+    def get(self, key):
+        """The cached result of the key (a copy) or None"""
+        if key is None:
+            return None
+        state = self._memory.get(key)
+        if state is None and self.folder and os.path.isfile(self._file(key)):
+            try:
+                with np.load(self._file(key), allow_pickle=False) as data:
+                    state = {name: data[name] for name in data.files}
+                # The modification time marks the last use for the eviction
+                os.utime(self._file(key))
+            except (OSError, ValueError) as err:
+                LOG.warning("Could not read the cache file %s: %s", self._file(key), err)
+                return None
+            self._memory[key] = state
+        if state is None:
+            return None
+        return {name: np.array(value) for name, value in state.items()}
+
+    def put(self, key, state):
+        """Caches the result (a dict of arrays and numbers) of the key"""
+        if key is None:
+            return
+        state = {name: np.array(value) for name, value in state.items()}
+        self._memory[key] = state
+        if not self.folder:
+            return
+        # Write to a temporary file first, so other processes never see half files
+        temporary = os.path.join(self.folder, "{}.{}.tmp.npz".format(key, os.getpid()))
+        try:
+            np.savez(temporary, **state)
+            os.replace(temporary, self._file(key))
+        except OSError as err:
+            LOG.warning("Could not write the cache file %s: %s", self._file(key), err)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes the cache files which were not used for max_age and the
+        least recently used ones until the folder is below max_size"""
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".npz") or ".tmp." in name:
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        now = time()
+        for mtime, size, path in entries:
+            if total <= self.max_size and now - mtime <= self.max_age:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                LOG.debug("Removed %s from the result cache", path)
+            except OSError:
+                pass
+
+    @classmethod
+    def clear_memory(cls):
+        """Forgets all results kept in memory"""
+        cls._memory.clear()
@@ -0,0 +1,128 @@
+"""This file contains the quick look into run files. describe only reads the
+file header, the event count and the timing of the events, so it takes
+milliseconds instead of a complete analysis. It is used to plan measurement
+campaigns and to skip empty or broken runs before the analysis starts."""
+# pylint: disable=C0103
+import logging
+import os
+import struct
+import numpy as np
+import h5py
+from analysis_classes.binary_reader import map_file, get_index, load_index, decode_blocks
+from analysis_classes.event_source import SPARSE_FORMAT
+
+LOG = logging.getLogger("run_info")
+
+
+def _to_python(value):
+    """Converts numpy records, arrays and scalars of hdf5 attributes to plain
+    python objects (dicts, lists, numbers)"""
+    if isinstance(value, np.ndarray) and value.dtype.names is None:
+        return value.tolist()
+    if isinstance(value, np.ndarray) and value.shape:
+        return [_to_python(item) for item in value]
+    if isinstance(value, (np.void, np.ndarray)) and value.dtype.names:
+        return {name: _to_python(value[name]) for name in value.dtype.names}
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _time_histogram(eventtiming, bins):
+    """Histogram of the event timing as dict with counts and bin edges"""
+    if not len(eventtiming):
+        return {"counts": [], "edges": [], "min": None, "max": None}
+    counts, edges = np.histogram(eventtiming, bins=bins)
+    return {"counts": counts.tolist(), "edges": edges.tolist(),
+            "min": float(np.min(eventtiming)), "max": float(np.max(eventtiming))}
+
+
+def _describe_h5(path, info, bins, timing):
+    """Fills the info of hdf5 files (ALiBaVa, converted or zero suppressed)"""
+    with h5py.File(path, "r") as f:
+        info["header"] = {key: _to_python(value) for key, value in f.attrs.items()}
+        if "header" in f:
+            info["header"].update({key: _to_python(value)
+                                   for key, value in f["header"].attrs.items()})
+        if "scan" in f:
+            info["header"].update({key: _to_python(value)
+                                   for key, value in f["scan"].attrs.items()})
+            info["scan_values"] = np.array(f["scan"]["value"][:]).tolist()
+        events = f["events"]
+        info["numevents"] = len(events["time"])
+        if f.attrs.get("format", "") == SPARSE_FORMAT:
+            info["format"] = SPARSE_FORMAT
+            info["numchan"] = int(f.attrs["numchan"])
+        else:
+            info["numchan"] = events["signal"].shape[1]
+        if timing:
+            info["time_histogram"] = _time_histogram(np.array(events["time"][:]), bins)
+
+
+def _describe_binary(path, info, bins, timing, create_index):
+    """Fills the info of ALiBaVa binary files"""
+    info["index_used"] = load_index(path) is not None
+    index = get_index(path, create=create_index)
+    info["header"] = {"header": index["header"], "start": index["start"],
+                      "runtype": index["runtype"]}
+    info["numevents"] = index["numevents"]
+    info["numchan"] = 256
+    info["scan_values"] = index["scan_values"].tolist() \
+        if index["scan_values"] is not None else None
+    if timing:
+        eventtiming = decode_blocks(map_file(path), index["offsets"],
+                                    out={"time": np.zeros(index["numevents"], dtype=np.float32)})["time"]
+        info["time_histogram"] = _time_histogram(eventtiming, bins)
+
+
+def describe(path, bins=100, timing=True, create_index=False):
+    """Describes a run file without analysing it. Works for hdf5 and binary
+    files, the type is detected from the file itself. For binary files the
+    index sidecar is used if present.
+
+    :param path: Path to the run file
+    :param bins: Number of bins of the timing histogram
+    :param timing: Read the timing of all events for the histogram
+    :param create_index: Write the index sidecar of binary files if there is none
+    :return: dict with path, format, file_size, valid, error, numevents, numchan,
+             header, scan_values, time_histogram (counts, edges, min, max) and
+             index_used (binary files only)
+    """
+    path = os.path.normpath(path)
+    info = {"path": path, "format": None, "file_size": None, "valid": False,
+            "error": None, "numevents": 0, "numchan": None, "header": {},
+            "scan_values": None, "time_histogram": None, "index_used": None}
+    try:
+        info["file_size"] = os.path.getsize(path)
+        if h5py.is_hdf5(path):
+            info["format"] = "hdf5"
+            _describe_h5(path, info, bins, timing)
+        else:
+            info["format"] = "binary"
+            _describe_binary(path, info, bins, timing, create_index)
+        info["valid"] = True
+    except (OSError, KeyError, ValueError, IndexError, UnicodeDecodeError,
+            struct.error) as err:
+        info["error"] = "{}: {}".format(type(err).__name__, err)
+        LOG.warning("Could not describe %s: %s", path, info["error"])
+    return info
+
+
+def is_usable(path, create_index=False):
+    """True if the file (or all files of a run) can be read and contains events
+
+    :param create_index: Write the index sidecar of binary files if there is none,
+                         it is reused by the analysis (binary_index of the configs)
+    """
+    paths = path if isinstance(path, (list, tuple)) else [path]
+    infos = [describe(part, timing=False, create_index=create_index) for part in paths]
+    for info in infos:
+        if not info["valid"]:
+            LOG.error("Run file %s is broken: %s", info["path"], info["error"])
+            return False
+    if not sum(info["numevents"] for info in infos):
+        LOG.error("Run %s contains no events", path)
+        return False
+    return True
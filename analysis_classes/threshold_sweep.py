@@ -0,0 +1,129 @@
+"""This file contains the sweep over the clustering cuts. The SN of the events
+does not depend on SN_cut, SN_ratio and SN_cluster, so every chunk of a run is
+read and preprocessed only once and then clustered with every combination of
+the cuts. For every combination a summary (clusters, clustersizes, MPV of the
+seed signal, noise occupancy) is collected, which replaces one full analysis
+run per combination when the cuts are tuned."""
+# pylint: disable=C0103,R0913,R0914
+import csv
+import logging
+from itertools import product
+from time import time
+import numpy as np
+from analysis_classes.event_source import open_event_source
+from analysis_classes.nb_analysis_funcs import preprocess_events, cluster_preprocessed_events, \
+    common_mode_settings, clustering_engine, good_strip_mask, PreprocessBuffers
+
+LOG = logging.getLogger("threshold_sweep")
+
+SWEEP_SIZES = 10  # Clustersizes in the summary, the last one counts all bigger clusters too
+# One record per combination of the cuts:
+#   events: processed events, clusters: number of clusters,
+#   events_with_clusters: events with at least one cluster,
+#   mean_clustersize: mean number of channels of the clusters,
+#   sizes: number of clusters of size 1 to SWEEP_SIZES (and bigger),
+#   seed_MPV: most probable abs seed signal of the clusters in ADC,
+#   noise_occupancy: hits of the wrong polarity per good channel and event,
+#                    the noise hits of the correct polarity are about the same
+SWEEP_DTYPE = np.dtype([("SN_cut", np.float64), ("SN_ratio", np.float64),
+                        ("SN_cluster", np.float64), ("events", np.int64),
+                        ("clusters", np.int64), ("events_with_clusters", np.int64),
+                        ("mean_clustersize", np.float64), ("sizes", np.int64, (SWEEP_SIZES,)),
+                        ("seed_MPV", np.float64), ("noise_occupancy", np.float64)])
+
+
+def threshold_sweep(path, configs, noise_analysis=None, SN_cuts=None, SN_ratios=None,
+                    SN_clusters=None, seed_range=(0., 500.), seed_bins=250):
+    """Clusters a run with every combination of the passed cuts, every chunk is
+    read and preprocessed only once.
+
+    :param path: Path to the run file(s), everything open_event_source can open
+    :param configs: The configs, for isBinary, timingWindow, common_mode, clustering etc.
+                    The cuts of the configs are used for every cut which is not passed
+    :param noise_analysis: NoiseAnalysis of the pedestal run, not needed for zero suppressed runs
+    :param SN_cuts: List of the SN_cut values
+    :param SN_ratios: List of the SN_ratio values
+    :param SN_clusters: List of the SN_cluster values
+    :param seed_range: Range of the histogram of the abs seed signals for the MPV in ADC
+    :param seed_bins: Bins of this histogram
+    :return: structured array with SWEEP_DTYPE: shape = (combinations)
+    """
+    grid = list(product(SN_cuts or [configs.get("SN_cut", 6.)],
+                        SN_ratios or [configs.get("SN_ratio", 0.5)],
+                        SN_clusters or [configs.get("SN_cluster", 5.)]))
+    source = open_event_source(path, configs)
+    if not source:
+        raise ValueError("Unable to read the run file {}".format(path))
+    if not source.preprocessed and noise_analysis is None:
+        raise ValueError("The NoiseAnalysis of the pedestal run is needed for {}".format(path))
+
+    start = time()
+    numchan = source.numchan
+    noisy_strips = np.array(noise_analysis.noisy_strips if noise_analysis is not None else [],
+                            dtype=np.int64)
+    # Zero suppressed runs carry the mask of their preprocessing in the header
+    good = source.good if source.preprocessed else good_strip_mask(numchan, noisy_strips)
+    good_channels = int(np.count_nonzero(good))
+    cm_settings = common_mode_settings(configs)
+    engine = clustering_engine(configs)
+    max_clustersize = configs.get("max_cluster_size", 5)
+    masking = configs.get("automasking", True)
+    material = 1 if configs.get("sensor_type", "n-in-p") == "n-in-p" else 0
+    buffers = PreprocessBuffers(numchan)  # Reused for all chunks
+
+    table = np.zeros(len(grid), dtype=SWEEP_DTYPE)
+    for row, (SN_cut, SN_ratio, SN_cluster) in zip(table, grid):
+        row["SN_cut"], row["SN_ratio"], row["SN_cluster"] = SN_cut, SN_ratio, SN_cluster
+    channels = np.zeros(len(grid))
+    wrong_hits = np.zeros(len(grid))
+    seed_hists = np.zeros((len(grid), seed_bins))
+    edges = np.linspace(seed_range[0], seed_range[1], seed_bins+1)
+
+    for chunk in source.chunks(timing=configs.get("timingWindow", None)):
+        if source.preprocessed:
+            noise = source.noise
+            signal, SN, CMN, CMsig = chunk.signal, chunk.SN, chunk.CMN, chunk.CMsig
+        else:
+            noise = noise_analysis.noise
+            signal, SN, CMN, CMsig = preprocess_events(chunk.signal, noise_analysis.pedestal,
+                                                       np.mean(noise_analysis.CMnoise),
+                                                       np.mean(noise_analysis.CMsig), noise,
+                                                       numchan, noisy_strips, cm_settings,
+                                                       buffers.views(len(chunk.signal)))
+        # Every combination of the cuts on the same preprocessed events
+        for k, (SN_cut, SN_ratio, SN_cluster) in enumerate(grid):
+            result = cluster_preprocessed_events(signal, SN, CMN, CMsig, noise, numchan, SN_cut,
+                                                 SN_ratio, SN_cluster, max_clustersize, masking,
+                                                 material, chunk.time, engine, buffers)
+            clusters = result.cluster_table
+            table["events"][k] += len(signal)
+            table["clusters"][k] += len(clusters)
+            table["events_with_clusters"][k] += np.count_nonzero(result.numclus)
+            table["sizes"][k] += np.bincount(np.minimum(clusters["size"], SWEEP_SIZES) - 1,
+                                             minlength=SWEEP_SIZES)
+            channels[k] += np.sum(clusters["size"])
+            seed_hists[k] += np.histogram(np.abs(signal[clusters["event"], clusters["seed"]]),
+                                          bins=edges)[0]
+            hit_signal = result.hit_signal
+            wrong_hits[k] += np.count_nonzero(hit_signal > 0 if material else hit_signal < 0)
+
+    source.close()
+    table["mean_clustersize"] = channels/np.maximum(table["clusters"], 1)
+    centres = (edges[:-1] + edges[1:])/2
+    table["seed_MPV"] = np.where(seed_hists.any(axis=1), centres[np.argmax(seed_hists, axis=1)],
+                                 np.nan)
+    table["noise_occupancy"] = wrong_hits/np.maximum(table["events"]*good_channels, 1)
+    LOG.info("Swept %s cut combinations over %s events of %s in %.1f s", len(grid),
+             table["events"][0] if len(grid) else 0, path, time()-start)
+    return table
+
+
+def write_sweep_csv(table, path):
+    """Writes the table of threshold_sweep as csv file, the sizes are written
+    as the columns size_1 to size_SWEEP_SIZES"""
+    names = [name for name in SWEEP_DTYPE.names if name != "sizes"]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(names + ["size_{}".format(size+1) for size in range(SWEEP_SIZES)])
+        for row in table:
+            writer.writerow([row[name] for name in names] + row["sizes"].tolist())
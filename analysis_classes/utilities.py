@@ -5,7 +5,6 @@ python analysis of ALIBAVA files."""
 import logging
 import logging.config
 import os
-import struct
 import sys
 from pydoc import locate
 import numpy as np
@@ -18,6 +17,8 @@ from matplotlib.backends.backend_pdf import PdfPages
 import scipy.integrate as integrate
 import json
 from copy import deepcopy
+from analysis_classes.binary_reader import read_binary_Alibava
+from analysis_classes.event_results import EventResults
 
 def read_meas_files(cfg):
     """Reads cfg file, returns lists of files and compares their length"""
@@ -129,95 +130,6 @@ def get_xy_data(data, header=0):
             np2Darray[i-header] = np.array(list_data)
     return np2Darray
 
-#@jit(nopython=False)
-def read_binary_Alibava(filepath):
-    """Reads binary alibava files"""
-    with open(os.path.normpath(filepath), "rb") as f:
-        header = f.read(16)
-        Starttime = struct.unpack("II", header[0:8])[0]  # Is a uint32
-        Runtype = struct.unpack("i", header[8:12])[0]  # int32
-        Headerlength = struct.unpack("I", header[12:16])
-        header = f.read(Headerlength[0])
-        Header = struct.unpack("{}s".format(Headerlength[0]), header)[0].decode("Utf-8")
-        Pedestal = np.array(struct.unpack("d" * 256, f.read(8 * 256)), dtype=np.float32)
-        Noise = np.array(struct.unpack("d" * 256, f.read(8 * 256)), dtype=np.float32)
-        byteorder = sys.byteorder
-
-        # Data Blocks
-        # Read all data Blocks
-        # Warning Alibava Binary calibration files have no indicatior how many events are really inside the file
-        # The eventnumber corresponds to the pulse number -->
-        # Readout of files have to be done until end of file is reached
-        # and the eventnumber must be calculated --> Advantage: Damaged files can be read as well
-        #events = Header.split("|")[1].split(";")[0]
-        event_data = []
-        events = 0
-        eof = False
-        #for event in range(int(events)):
-        while not eof:
-            blockheader = f.read(4)  # should be 0xcafe002
-            if blockheader == b'\x02\x00\xfe\xca' or blockheader == b'\xca\xfe\x00\x02':
-                events += 1
-                blocksize = struct.unpack("I", f.read(4))
-                event_data.append(f.read(blocksize[0]))
-            else:
-                LOG.info("Warning: While reading data Block {}. "
-                         "Header was not the 0xcafe0002 it was {!s}"\
-                         .format(events, str(blockheader)))
-                if not blockheader:
-                    LOG.info("Persumably end of binary file reached. "
-                             "Events read: {}".format(events))
-                    eof = True
-        dic = {"header": {"noise": Noise,
-                          "pedestal": Pedestal,
-                          "Attribute:setup": None},
-               "events": {"header": Header,
-                          "signal": np.zeros((int(events),256), dtype=np.float32),
-                          "temperature": np.zeros(int(events), dtype=np.float32),
-                          "time": np.zeros(int(events), dtype=np.float32),
-                          "clock": np.zeros(int(events), dtype=np.float32)},
-               "scan": {"start": Starttime,
-                        "end": None,
-                        "value": None, # Values of cal files for example. eg. 32 pulses for a charge scan steps should be here
-                        "attribute:scan_definition": None}}
-        # Disect the header for the correct informations for values
-        points = Header.split("|")[1].split(";")
-        params = [x.strip("\x00") for x in points]
-
-        # Alibava binary have (unfortunately) a non consistend header format
-        # Therefore, we have to distinguish between the two formats --> len(params) = 4 --> Calibration
-        # len(params) = 2 --> Eventfile
-
-        if len(params) >= 4: # Cal file
-            dic["scan"]["value"] = np.arange(int(params[1]), int(params[2]), int(params[3]))  # aka xdata
-        elif len(params) == 2: # Events file
-            dic["scan"]["value"] = np.arange(0, int(params[0]),step=1)  # aka xdata
-
-        shift1 = int.from_bytes(b'0xFFFF0000',byteorder=byteorder)
-        shift2 = int.from_bytes(b'0xFFFF',byteorder=byteorder)
-        # decode data from data Blocks
-        for i, event in enumerate(event_data):
-            dic["events"]["clock"][i] = struct.unpack("III", event[0:12])[-1]
-            coded_time = struct.unpack("I", event[12:16])[0]
-            #coded_time = event[12:16]
-            ipart = (coded_time & shift1)>>16
-            fpart = (np.sign(ipart))*(coded_time & shift2)
-            time = 100*ipart+fpart
-            dic["events"]["time"][i] = time
-            dic["events"]["temperature"][i] = 0.12*struct.unpack("H", event[16:18])[0]-39.8
-
-            # There seems to be garbage data which needs to be cut out
-            padding = 18+32
-            part1 = list(struct.unpack("h"*128, event[padding:padding+2*128]))
-            padding += 2*130+28
-            part2 = list(struct.unpack("h" * 128, event[padding:padding + 2*128]))
-            part1.extend(part2)
-            dic["events"]["signal"][i] = np.array(part1)
-            #dict["events"]["signal"][i] =struct.unpack("H"*256, event[18:18+2*256])
-            #extra = struct.unpack("d", event[18+2*256:18+2*256+4])[0]
-
-    return dic
-
 def read_file(filepath, binary=False):
     """Just reads a file and returns the content line by line"""
     if os.path.exists(os.path.normpath(filepath)):
@@ -387,7 +299,7 @@ class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
            return obj.tolist()
-        if isinstance(obj, Bdata):
+        if isinstance(obj, (Bdata, EventResults)):
             data = {}
             for key in obj.labels:
                 data[key] = obj[key].tolist()
@@ -0,0 +1,122 @@
+"""This file contains the zero suppression of physics runs. With the pedestal,
+noise and noisy strips of a NoiseAnalysis every event is preprocessed like in
+the BaseAnalysis and only channels above a low SN threshold (plus some
+neighbours) are written to a hdf5 file in CSR form. These files are opened by
+open_event_source like normal hdf5 files and can be clustered again with
+tighter cuts without reading the full ADC data."""
+# pylint: disable=C0103,R0913,R0914
+import logging
+import os
+from time import time
+import numpy as np
+import h5py
+from analysis_classes.event_source import open_event_source, SPARSE_FORMAT
+from analysis_classes.nb_analysis_funcs import preprocess_events, common_mode_settings, \
+    PreprocessBuffers
+
+LOG = logging.getLogger("zero_suppression")
+
+
+def suppression_mask(SN, threshold, margin):
+    """Returns the mask of the channels which are kept: channels with
+    abs(SN) > threshold and margin neighbours on each side of them
+
+    :param SN: The SN of the events: shape = (events, channels)
+    :param threshold: Minimum abs(SN) of a channel to be kept
+    :param margin: Number of neighbours on each side which are kept as well
+    :return: bool array: shape = (events, channels)
+    """
+    above = np.abs(SN) > threshold
+    keep = above.copy()
+    for shift in range(1, margin+1):
+        keep[:, shift:] |= above[:, :-shift]
+        keep[:, :-shift] |= above[:, shift:]
+    return keep
+
+
+def zero_suppress_run(path, noise_analysis, configs, output=None,
+                      threshold=2.5, margin=1, compression="lzf"):
+    """Writes a zero suppressed version of a run.
+
+    The clustering on the zero suppressed file gives the same clusters as on
+    the original file as long as SN_cut*SN_ratio is not below the threshold.
+
+    :param path: Path to the run file(s), everything open_event_source can open
+    :param noise_analysis: NoiseAnalysis of the pedestal run
+    :param configs: The configs, for isBinary, chunk_size, common_mode etc.
+    :param output: Path of the output file, default is the run path with _zs.hdf5 ending
+    :param threshold: Minimum abs(SN) of a channel to be stored
+    :param margin: Number of neighbours on each side of a channel above threshold which are stored as well
+    :param compression: hdf5 compression filter of the datasets
+    :return: dict with the statistics of the suppression
+    """
+    first_file = path[0] if isinstance(path, (list, tuple)) else path
+    if output is None:
+        output = os.path.splitext(os.path.normpath(first_file))[0] + "_zs.hdf5"
+    source = open_event_source(path, configs)
+    if not source:
+        raise ValueError("Unable to read the run file {}".format(path))
+
+    start = time()
+    pedestal = noise_analysis.pedestal
+    noise = noise_analysis.noise
+    noisy_strips = np.array(noise_analysis.noisy_strips, dtype=np.int64)
+    meanCMN = np.mean(noise_analysis.CMnoise)
+    meanCMsig = np.mean(noise_analysis.CMsig)
+    cm_settings = common_mode_settings(configs)
+    buffers = PreprocessBuffers(source.numchan)  # Reused for all chunks
+    stored = 0
+
+    with h5py.File(output, "w") as f:
+        f.attrs["format"] = SPARSE_FORMAT
+        f.attrs["source"] = os.path.basename(str(first_file))
+        f.attrs["threshold"] = threshold
+        f.attrs["margin"] = margin
+        f.attrs["numchan"] = source.numchan
+        f.attrs["meanCMN"] = meanCMN
+        f.attrs["meanCMsig"] = meanCMsig
+        header = f.create_group("header")
+        header.create_dataset("pedestal", data=pedestal)
+        header.create_dataset("noise", data=noise)
+        header.create_dataset("noisy_strips", data=noisy_strips)
+        scan_values = source.scan_values if source.scan_values is not None else []
+        f.create_group("scan").create_dataset("value", data=np.array(scan_values, dtype=np.float32))
+
+        events = f.create_group("events")
+        per_event = {name: events.create_dataset(name, shape=(source.numevents,), dtype=np.float32)
+                     for name in ("time", "CMN", "CMsig")}
+        indptr = events.create_dataset("indptr", shape=(source.numevents+1,), dtype=np.int64)
+        indptr[0] = 0
+        hits = {"channel": events.create_dataset("channel", shape=(0,), maxshape=(None,),
+                                                 dtype=np.uint16, chunks=(65536,),
+                                                 compression=compression),
+                "signal": events.create_dataset("signal", shape=(0,), maxshape=(None,),
+                                                dtype=np.float32, chunks=(65536,),
+                                                compression=compression)}
+
+        for chunk in source.chunks():
+            signal, SN, CMN, CMsig = preprocess_events(chunk.signal, pedestal, meanCMN, meanCMsig,
+                                                       noise, source.numchan, noisy_strips,
+                                                       cm_settings, buffers.views(len(chunk.index)))
+            rows, channels = np.nonzero(suppression_mask(SN, threshold, margin))
+            first, last = chunk.index[0], chunk.index[-1]+1
+            indptr[first+1:last+1] = stored + np.cumsum(np.bincount(rows, minlength=len(chunk.index)))
+            for name, data in (("channel", channels), ("signal", signal[rows, channels])):
+                hits[name].resize((stored+len(rows),))
+                hits[name][stored:] = data
+            stored += len(rows)
+            per_event["time"][first:last] = chunk.time
+            per_event["CMN"][first:last] = CMN
+            per_event["CMsig"][first:last] = CMsig
+
+    stats = {"file": str(path),
+             "output": output,
+             "events": source.numevents,
+             "stored_channels": stored,
+             "occupancy": stored/max(source.numevents*source.numchan, 1),
+             "output_MB": os.path.getsize(output)/1e6,
+             "time_s": time()-start}
+    source.close()
+    LOG.info("Zero suppressed %s (%s events): %.2f %% of the channels stored, %.1f MB",
+             path, stats["events"], 100*stats["occupancy"], stats["output_MB"])
+    return stats
@@ -178,7 +178,9 @@ class PlotData:
         excluding the "ungaussian" parts of the distribution"""
         data = obj["NoiseAnalysis"]
         plot = handle_sub_plots(fig, cfg)
-        n, bins, _ = plot.hist(data.total_noise, bins=500, density=False,
+        # The histogram is already binned by the NoiseAnalysis
+        counts, edges = data.noise_hist
+        n, bins, _ = plot.hist(edges[:-1], bins=edges, weights=counts, density=False,
                                alpha=0.4, color="b", label="Noise")
         plot.set_yscale("log", nonposy='clip')
         plot.set_ylim(1.)
@@ -296,8 +298,7 @@ class PlotData:
         data = obj["MainAnalysis"]["base"]
         clusters_plot = handle_sub_plots(fig, cfg)
 
-        bins, counts = np.unique(np.concatenate(data["Clustersize"]),
-                                 return_counts=True)
+        bins, counts = np.unique(data.cluster_table["size"], return_counts=True)
         clusters_plot.bar(bins, counts, alpha=0.4, color="b")
         clusters_plot.set_xlabel('Clustersize [#]')
         clusters_plot.set_ylabel('Occurance [#]')
@@ -330,19 +331,15 @@ class PlotData:
         # Plot the different clustersizes
         colour = ['green', 'red', 'orange', 'cyan', 'black', 'pink', 'magenta']
 
-        # Get only events with one cluster inside
-        ind_only_one_cluster = np.nonzero(data["Numclus"] == 1)
-        clusters_raw = np.take(data["Clustersize"], ind_only_one_cluster)
-        clusters_flattend = np.concatenate(clusters_raw[0]).ravel()
+        # Get only clusters of events with one cluster inside
+        table = data.cluster_table
+        only_one_cluster = data.numclus[table["event"]] == 1
         max_cluster = self.cfg["hitmap_max_clustersize"]
 
-
         for clus in range(1, max_cluster+1):
-            # Get clusters
-            indizes_clustersize = np.nonzero(clusters_flattend == clus)
-            indizes = np.take(ind_only_one_cluster, indizes_clustersize)[0]
-            hitted = np.take(data["Clusters"], indizes)
-            hitted_flatten = np.concatenate(hitted).ravel()
+            # Channels of the clusters with this size
+            selected = np.logical_and(only_one_cluster, table["size"] == clus)
+            hitted_flatten = data.cluster_channels[selected[data.channel_cluster]]
 
             hit_plot.hist(hitted_flatten, range=(0, 256), bins=256,
                         alpha=0.3, color=colour[clus-1],
@@ -374,6 +371,10 @@ class PlotData:
         # fig = plt.figure("Event number {!s}, from file: {!s}".format(eventnum, file))
         data = obj["MainAnalysis"]["base"]
         eventnum = self.cfg["Plot_single_event"]
+        if "Signal" not in data.keys():
+            self.log.warning("The signals of the events are not stored, set store_signals "
+                             "in the configs to plot single events")
+            return None
         channel_plot = handle_sub_plots(fig, cfg)
         channel_plot.bar(np.arange(len(data["Signal"][0])),
                          data["Signal"][eventnum], 1.,
@@ -387,6 +388,10 @@ class PlotData:
         """Plot signal/Noise"""
         data = obj["MainAnalysis"]["base"]
         eventnum = self.cfg["Plot_single_event"]
+        if "SN" not in data.keys():
+            self.log.warning("The signals of the events are not stored, set store_signals "
+                             "in the configs to plot single events")
+            return None
         SN_plot = handle_sub_plots(fig, cfg)
         SN_plot.bar(np.arange(len(data["Signal"][0])),
                     data["SN"][eventnum], 1.,
@@ -520,12 +525,8 @@ class PlotData:
         timing_plot.set_xlabel('timing [ns]')
         timing_plot.set_ylabel('average signal [ADC]')
         timing_plot.set_title('Average timing signal of seed hits')
-        signal = data["Signal"]
-        channels_hit = data["Channel_hit"]
-        time = data["Timing"].astype(np.float32)
-        sum_singal = np.zeros(len(signal))
-        for i, sig, chan in zip(np.arange(len(signal)), signal, channels_hit):
-            sum_singal[i] = np.sum(sig[chan])
+        time = data.timing.astype(np.float32)
+        sum_singal = data.hit_sum()
         max_time = int(np.max(time)+1)
         timing_data = np.zeros(max_time)
         # var_timing_data = np.zeros(150)
@@ -564,12 +565,8 @@ class PlotData:
         plot.set_ylabel('ADC [#]')
         plot.set_title('2D Histogram of timings with signal')
 
-        signal = data["Signal"]
-        channels_hit = data["Channel_hit"]
-        time = data["Timing"].astype(np.float32)
-        sum_singal = np.zeros(len(signal))
-        for i, sig, chan in zip(np.arange(len(signal)), signal, channels_hit):
-            sum_singal[i] = np.sum(sig[chan])
+        time = data.timing.astype(np.float32)
+        sum_singal = data.hit_sum()
 
 
         counts, xedges, yedges, im = plot.hist2d(time, sum_singal,